@@ -0,0 +1,226 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+# IVF (inverted file) approximate nearest-neighbour index over CLIP embeddings
+#
+# vectors are clustered with spherical k-means into n_lists cells. each cell's
+# vectors are stored contiguously, so a query only scores the centroids plus
+# the vectors in its nprobe closest cells. nprobe is the recall/latency knob:
+# nprobe == n_lists is exact search, small nprobe is fast but may miss matches
+#
+# on-disk layout (one directory, every array memory-mappable with np.load):
+#    centroids.npy     (n_lists, d) float32, L2-normalized
+#    vectors.npy       (n, d) float32, L2-normalized, grouped by cell
+#    row_ids.npy       (n,) int64, row of each vector in the source embeddings
+#    list_offsets.npy  (n_lists + 1,) int64, cell i is vectors[offsets[i]:offsets[i + 1]]
+#    meta.json         sizes, default nprobe and a fingerprint of the sample ids
+
+DEFAULT_INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ann_index")
+
+
+class IVFIndex:
+   def __init__(self, centroids, vectors, row_ids, list_offsets, nprobe=8, ids_fingerprint=None):
+      self.centroids = centroids
+      self.vectors = vectors
+      self.row_ids = row_ids
+      self.list_offsets = list_offsets
+      self.nprobe = nprobe
+      self.ids_fingerprint = ids_fingerprint
+
+   @property
+   def n_lists(self):
+      return len(self.centroids)
+
+   def __len__(self):
+      return len(self.row_ids)
+
+   # returns rows (into the source embeddings) and cosine scores of the
+   # approximate top k, best first
+   def search(self, query_embedding, k, nprobe=None):
+      nprobe = min(nprobe or self.nprobe, self.n_lists)
+      query_embedding = np.asarray(query_embedding, dtype=np.float32)
+
+      # pick the nprobe closest cells
+      centroid_scores = self.centroids @ query_embedding
+      probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+
+      # gather the candidate ranges and score them in one product
+      ranges = [np.arange(self.list_offsets[c], self.list_offsets[c + 1]) for c in probe]
+      candidates = np.concatenate(ranges) if ranges else np.array([], dtype=np.int64)
+      if len(candidates) == 0:
+         return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+      scores = self.vectors[candidates] @ query_embedding
+
+      k = min(k, len(candidates))
+      best = np.argpartition(-scores, k - 1)[:k]
+      best = best[np.argsort(-scores[best], kind="stable")]
+      return np.asarray(self.row_ids[candidates[best]]), scores[best]
+
+   def save(self, index_dir):
+      os.makedirs(index_dir, exist_ok=True)
+      np.save(os.path.join(index_dir, "centroids.npy"), self.centroids)
+      np.save(os.path.join(index_dir, "vectors.npy"), self.vectors)
+      np.save(os.path.join(index_dir, "row_ids.npy"), self.row_ids)
+      np.save(os.path.join(index_dir, "list_offsets.npy"), self.list_offsets)
+      meta = {
+         "num_vectors": len(self.row_ids),
+         "dim": int(self.vectors.shape[1]),
+         "n_lists": self.n_lists,
+         "nprobe": self.nprobe,
+         "ids_fingerprint": self.ids_fingerprint,
+      }
+      with open(os.path.join(index_dir, "meta.json"), "w") as f:
+         json.dump(meta, f, indent=2)
+
+   # memory-map an index written by save(); pages are shared between processes
+   @classmethod
+   def load(cls, index_dir, mmap=True):
+      mmap_mode = "r" if mmap else None
+      with open(os.path.join(index_dir, "meta.json")) as f:
+         meta = json.load(f)
+      return cls(
+         centroids=np.load(os.path.join(index_dir, "centroids.npy")),
+         vectors=np.load(os.path.join(index_dir, "vectors.npy"), mmap_mode=mmap_mode),
+         row_ids=np.load(os.path.join(index_dir, "row_ids.npy"), mmap_mode=mmap_mode),
+         list_offsets=np.load(os.path.join(index_dir, "list_offsets.npy")),
+         nprobe=meta.get("nprobe", 8),
+         ids_fingerprint=meta.get("ids_fingerprint"),
+      )
+
+
+# stable hash of the sample id order, used to detect an index that was built
+# against a different version of the dataset
+def fingerprint_ids(sample_ids):
+   digest = hashlib.sha1()
+   for sample_id in sample_ids:
+      digest.update(str(sample_id).encode("utf-8"))
+      digest.update(b"\0")
+   return digest.hexdigest()
+
+
+# spherical k-means on L2-normalized rows; trains on at most train_size rows
+def train_centroids(embeddings, n_lists, n_iter=20, train_size=50000, seed=0):
+   rng = np.random.default_rng(seed)
+   train = embeddings
+   if len(train) > train_size:
+      train = embeddings[rng.choice(len(embeddings), train_size, replace=False)]
+   train = np.ascontiguousarray(train, dtype=np.float32)
+
+   centroids = train[rng.choice(len(train), n_lists, replace=False)].copy()
+   for _ in range(n_iter):
+      assignments = np.argmax(train @ centroids.T, axis=1)
+      sums = np.zeros_like(centroids)
+      np.add.at(sums, assignments, train)
+      counts = np.bincount(assignments, minlength=n_lists)
+
+      # re-seed empty cells with random training vectors
+      empty = counts == 0
+      if empty.any():
+         sums[empty] = train[rng.choice(len(train), int(empty.sum()), replace=False)]
+
+      norms = np.linalg.norm(sums, axis=1, keepdims=True)
+      norms[norms == 0] = 1
+      centroids = sums / norms
+   return centroids.astype(np.float32)
+
+
+# nearest centroid for every row, computed in chunks to bound memory
+def assign_to_centroids(embeddings, centroids, chunk_size=65536):
+   assignments = np.empty(len(embeddings), dtype=np.int64)
+   for start in range(0, len(embeddings), chunk_size):
+      chunk = np.asarray(embeddings[start:start + chunk_size], dtype=np.float32)
+      assignments[start:start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+   return assignments
+
+
+# takes in an (n, d) matrix of L2-normalized embeddings
+# returns an IVF index; n_lists defaults to ~sqrt(n)
+def build_ivf_index(embeddings, n_lists=None, nprobe=8, n_iter=20, sample_ids=None, seed=0):
+   embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+   if n_lists is None:
+      n_lists = max(1, int(round(np.sqrt(len(embeddings)))))
+   n_lists = min(n_lists, len(embeddings))
+
+   centroids = train_centroids(embeddings, n_lists, n_iter=n_iter, seed=seed)
+   assignments = assign_to_centroids(embeddings, centroids)
+
+   order = np.argsort(assignments, kind="stable")
+   counts = np.bincount(assignments, minlength=n_lists)
+   list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+   return IVFIndex(
+      centroids=centroids,
+      vectors=np.ascontiguousarray(embeddings[order]),
+      row_ids=order.astype(np.int64),
+      list_offsets=list_offsets,
+      nprobe=nprobe,
+      ids_fingerprint=fingerprint_ids(sample_ids) if sample_ids is not None else None,
+   )
+
+
+# fraction of the exact top k that the index also returns, averaged over queries
+# returns (recall, exact seconds per query, ann seconds per query)
+def recall_at_k(index, embeddings, queries, k, nprobe=None):
+   hits = 0
+   exact_time = ann_time = 0.0
+   for query_embedding in queries:
+      start = time.perf_counter()
+      scores = embeddings @ query_embedding
+      exact = np.argpartition(-scores, k - 1)[:k]
+      exact_time += time.perf_counter() - start
+
+      start = time.perf_counter()
+      approx, _ = index.search(query_embedding, k, nprobe=nprobe)
+      ann_time += time.perf_counter() - start
+
+      hits += len(np.intersect1d(exact, approx))
+   return hits / (k * len(queries)), exact_time / len(queries), ann_time / len(queries)
+
+
+# build the index offline from the FiftyOne dataset and report recall@k
+#    python ann_index.py --dataset datasets --out ann_index --evaluate
+# or, from an exported embedding store (see embedding_store.py)
+#    python ann_index.py --store embedding_store --out ann_index
+def main():
+   parser = argparse.ArgumentParser()
+   parser.add_argument("--dataset", default="datasets", help="FiftyOne dataset directory")
+   parser.add_argument("--store", default=None, help="embedding store directory (used instead of --dataset)")
+   parser.add_argument("--out", default=DEFAULT_INDEX_DIR, help="directory to write the index to")
+   parser.add_argument("--n-lists", type=int, default=None, help="number of IVF cells (default ~sqrt(n))")
+   parser.add_argument("--nprobe", type=int, default=8, help="default number of cells probed per query")
+   parser.add_argument("--evaluate", action="store_true", help="report recall@k against exact search")
+   parser.add_argument("-k", type=int, default=10)
+   parser.add_argument("--num-queries", type=int, default=200)
+   args = parser.parse_args()
+
+   import model
+   if args.store:
+      engine = model.ImageSearchEngine.from_store(args.store)
+   else:
+      engine = model.ImageSearchEngine(model.load_clustered_model(args.dataset))
+   embeddings = engine.embeddings
+
+   start = time.time()
+   index = build_ivf_index(embeddings, n_lists=args.n_lists, nprobe=args.nprobe, sample_ids=engine.sample_ids)
+   index.save(args.out)
+   print(f"Built IVF index with {index.n_lists} cells over {len(index)} embeddings "
+         f"in {time.time() - start:.1f}s. Saved to {args.out}")
+
+   if args.evaluate:
+      rng = np.random.default_rng(0)
+      queries = embeddings[rng.choice(len(embeddings), min(args.num_queries, len(embeddings)), replace=False)]
+      index = IVFIndex.load(args.out)
+      print(f"{'nprobe':>6} {'recall@' + str(args.k):>10} {'exact ms':>9} {'ann ms':>8}")
+      for nprobe in sorted({1, 2, 4, 8, 16, 32, index.n_lists}):
+         if nprobe > index.n_lists:
+            continue
+         recall, exact_time, ann_time = recall_at_k(index, embeddings, queries, args.k, nprobe=nprobe)
+         print(f"{nprobe:>6} {recall:>10.3f} {exact_time * 1000:>9.2f} {ann_time * 1000:>8.2f}")
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,168 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+from ann_index import train_centroids, assign_to_centroids, fingerprint_ids
+from embedding_store import EmbeddingStore, DEFAULT_STORE_DIR
+
+# collection-wide clusters over the stored CLIP embeddings
+#
+# an offline job runs spherical k-means (the same mini-batch-sized training
+# the IVF index uses: centroids are fit on a sample, then every vector is
+# assigned in chunks) and stores the centroids plus a cluster id for every
+# sample. labels added to the store later are assigned to their nearest
+# centroid incrementally, without reclustering
+#
+# on-disk layout (one directory):
+#    centroids.npy     (n_clusters, d) float32, L2-normalized
+#    cluster_ids.npy   (n,) int32, cluster of each sample, in store order
+#    sample_ids.json   sample id of each row of cluster_ids
+#    meta.json         sizes and a fingerprint of the clustered sample ids
+#
+#    python clusters.py --store embedding_store --n-clusters 100
+#    python clusters.py --store embedding_store --assign-new
+
+DEFAULT_CLUSTER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clusters")
+
+
+class ClusterIndex:
+   def __init__(self, centroids, cluster_ids, sample_ids, ids_fingerprint=None):
+      self.centroids = centroids
+      self.cluster_ids = cluster_ids
+      self.sample_ids = list(sample_ids)
+      self.ids_fingerprint = ids_fingerprint
+      self._cluster_of = None
+
+   @property
+   def n_clusters(self):
+      return len(self.centroids)
+
+   def __len__(self):
+      return len(self.cluster_ids)
+
+   # number of samples in each cluster
+   def sizes(self):
+      return np.bincount(self.cluster_ids, minlength=self.n_clusters)
+
+   # cluster id of each given sample id (-1 for samples never assigned)
+   def labels_for(self, sample_ids):
+      if self._cluster_of is None:
+         self._cluster_of = dict(zip(self.sample_ids, self.cluster_ids.tolist()))
+      return np.array([self._cluster_of.get(i, -1) for i in sample_ids], dtype=np.int32)
+
+   # groups rows of an embedding matrix by their cluster labels (-1 rows are
+   # left out), closest to the centroid first. returns (members, starts,
+   # scores): the rows of cluster c are members[starts[c]:starts[c + 1]] and
+   # scores are their cosine similarities to its centroid, so sizes and
+   # representatives are O(1) lookups afterwards
+   def group(self, embeddings, labels, chunk_size=65536):
+      rows = np.flatnonzero(labels >= 0)
+      scores = np.empty(len(rows), dtype=np.float32)
+      for start in range(0, len(rows), chunk_size):
+         chunk = rows[start:start + chunk_size]
+         scores[start:start + chunk_size] = np.einsum("ij,ij->i", embeddings[chunk], self.centroids[labels[chunk]])
+      order = np.lexsort((-scores, labels[rows]))
+      starts = np.zeros(self.n_clusters + 1, dtype=np.int64)
+      np.cumsum(np.bincount(labels[rows], minlength=self.n_clusters), out=starts[1:])
+      return rows[order], starts, scores[order]
+
+   # nearest centroid of each L2-normalized embedding
+   def assign(self, embeddings):
+      return assign_to_centroids(embeddings, self.centroids).astype(np.int32)
+
+   # add newly stored samples without touching existing assignments
+   def extend(self, embeddings, sample_ids):
+      new_ids = self.assign(embeddings)
+      self.cluster_ids = np.concatenate([self.cluster_ids, new_ids])
+      self.sample_ids.extend(sample_ids)
+      self.ids_fingerprint = fingerprint_ids(self.sample_ids)
+      self._cluster_of = None
+      return new_ids
+
+   def save(self, cluster_dir):
+      os.makedirs(cluster_dir, exist_ok=True)
+      np.save(os.path.join(cluster_dir, "centroids.npy"), self.centroids)
+      np.save(os.path.join(cluster_dir, "cluster_ids.npy"), self.cluster_ids)
+      with open(os.path.join(cluster_dir, "sample_ids.json"), "w") as f:
+         json.dump([str(i) for i in self.sample_ids], f)
+      meta = {
+         "n_clusters": self.n_clusters,
+         "n": len(self),
+         "dim": int(self.centroids.shape[1]),
+         "ids_fingerprint": self.ids_fingerprint,
+      }
+      # meta.json is written last, so a reader never sees a half-saved index as complete
+      tmp_path = os.path.join(cluster_dir, "meta.json.tmp")
+      with open(tmp_path, "w") as f:
+         json.dump(meta, f, indent=2)
+      os.replace(tmp_path, os.path.join(cluster_dir, "meta.json"))
+
+   @classmethod
+   def load(cls, cluster_dir):
+      with open(os.path.join(cluster_dir, "meta.json")) as f:
+         meta = json.load(f)
+      with open(os.path.join(cluster_dir, "sample_ids.json")) as f:
+         sample_ids = json.load(f)
+      return cls(
+         centroids=np.load(os.path.join(cluster_dir, "centroids.npy")),
+         cluster_ids=np.load(os.path.join(cluster_dir, "cluster_ids.npy")),
+         sample_ids=sample_ids,
+         ids_fingerprint=meta.get("ids_fingerprint"),
+      )
+
+
+# takes in an (n, d) matrix of L2-normalized embeddings and their sample ids
+# returns a ClusterIndex; n_clusters defaults to ~sqrt(n / 2)
+def build_clusters(embeddings, sample_ids, n_clusters=None, n_iter=25, seed=0):
+   embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+   if n_clusters is None:
+      n_clusters = max(1, int(round(np.sqrt(len(embeddings) / 2))))
+   n_clusters = min(n_clusters, len(embeddings))
+
+   centroids = train_centroids(embeddings, n_clusters, n_iter=n_iter, seed=seed)
+   return ClusterIndex(
+      centroids=centroids,
+      cluster_ids=assign_to_centroids(embeddings, centroids).astype(np.int32),
+      sample_ids=sample_ids,
+      ids_fingerprint=fingerprint_ids(sample_ids),
+   )
+
+
+# assign the store's samples that have no cluster yet; the store is
+# append-only, so those are exactly the rows after the ones already clustered
+def assign_new(cluster_dir, store_dir):
+   index = ClusterIndex.load(cluster_dir)
+   embeddings, sample_ids, _, _ = EmbeddingStore(store_dir).load()
+   if fingerprint_ids(sample_ids[:len(index)]) != index.ids_fingerprint:
+      raise ValueError("the embedding store no longer matches the clustered samples; recluster instead")
+   new_ids = index.extend(embeddings[len(index):], sample_ids[len(index):].tolist())
+   index.save(cluster_dir)
+   return len(new_ids)
+
+
+def main():
+   parser = argparse.ArgumentParser()
+   parser.add_argument("--store", default=DEFAULT_STORE_DIR, help="embedding store directory")
+   parser.add_argument("--out", default=DEFAULT_CLUSTER_DIR, help="directory to write the clusters to")
+   parser.add_argument("--n-clusters", type=int, default=None, help="number of clusters (default ~sqrt(n / 2))")
+   parser.add_argument("--assign-new", action="store_true",
+                       help="only assign samples added to the store since the last run")
+   args = parser.parse_args()
+
+   start = time.time()
+   if args.assign_new:
+      num_new = assign_new(args.out, args.store)
+      print(f"Assigned {num_new} new samples to existing clusters in {time.time() - start:.1f}s")
+      return
+
+   embeddings, sample_ids, _, _ = EmbeddingStore(args.store).load()
+   index = build_clusters(embeddings, sample_ids.tolist(), n_clusters=args.n_clusters)
+   index.save(args.out)
+   sizes = index.sizes()
+   print(f"Clustered {len(index)} samples into {index.n_clusters} clusters in {time.time() - start:.1f}s "
+         f"(sizes {sizes.min()}-{sizes.max()}, median {int(np.median(sizes))}). Saved to {args.out}")
+
+
+if __name__ == "__main__":
+   main()
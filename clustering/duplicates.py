@@ -0,0 +1,230 @@
+import argparse
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+import numpy as np
+from tqdm import tqdm
+
+# near-duplicate grouping of pre-printed labels
+#
+# every label gets a 64-bit perceptual hash (pHash): the grayscale image is
+# shrunk to 32x32, transformed with a 2D DCT, and the 8x8 lowest frequencies
+# (without the DC term) are thresholded at their median. only relative
+# brightness of coarse structure survives, so the same printed label in a
+# different ink or paper color hashes to (nearly) the same bits
+#
+# grouping uses LSH banding instead of comparing all pairs: the 64 bits are
+# split into max_distance + 1 bands, and by pigeonhole two hashes within
+# max_distance bits agree exactly on at least one band. only hashes sharing a
+# band value are compared (a vectorized Hamming check per bucket), and pairs
+# within max_distance are merged into duplicate groups as connected components
+#
+# output (one directory):
+#    hashes.npz             filepaths and uint64 hashes of every label
+#    duplicate_groups.json  groups of 2+ labels with their BDR codes
+#
+#    python duplicates.py ../server/segmented_images --max-distance 6
+
+DEFAULT_OUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "duplicates")
+GROUPS_FILENAME = "duplicate_groups.json"
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+HASH_SIZE = 8
+DCT_SIZE = 32
+
+
+def _dct_matrix(n):
+   k = np.arange(n)[:, None]
+   i = np.arange(n)[None, :]
+   matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+   matrix[0] /= np.sqrt(2)
+   return matrix
+
+_DCT = _dct_matrix(DCT_SIZE)
+_BIT_WEIGHTS = (1 << np.arange(HASH_SIZE * HASH_SIZE - 1, -1, -1, dtype=np.uint64)).astype(np.uint64)
+
+
+# BDR code from a label filename like 412661_19.jpg, or None
+def extract_bdr_code(filepath):
+   code_match = re.search(r"(\d+)", os.path.basename(filepath))
+   return code_match.group(1) if code_match else None
+
+
+# 64-bit pHash of a grayscale image array
+def phash_array(gray):
+   freqs = _DCT @ np.asarray(gray, dtype=np.float64) @ _DCT.T
+   low = freqs[:HASH_SIZE, :HASH_SIZE].ravel()
+   bits = low > np.median(low[1:])
+   bits[0] = False  # the DC term only encodes overall brightness
+   return np.uint64(np.sum(_BIT_WEIGHTS[bits], dtype=np.uint64))
+
+
+# returns (filepath, hash) or (filepath, None) if the image can't be read
+def phash_file(filepath):
+   try:
+      with Image.open(filepath) as img:
+         # JPEGs are decoded at reduced resolution; only 32x32 is needed
+         img.draft("L", (DCT_SIZE * 4, DCT_SIZE * 4))
+         gray = img.convert("L").resize((DCT_SIZE, DCT_SIZE), Image.BILINEAR)
+         return filepath, int(phash_array(gray))
+   except OSError:
+      return filepath, None
+
+
+def hash_images(filepaths, workers=None):
+   hashes = {}
+   with ProcessPoolExecutor(max_workers=workers) as executor:
+      for filepath, image_hash in tqdm(executor.map(phash_file, filepaths, chunksize=64), total=len(filepaths)):
+         if image_hash is not None:
+            hashes[filepath] = image_hash
+   return hashes
+
+
+def hamming(a, b):
+   return np.bitwise_count(np.bitwise_xor(a, b))
+
+
+# labels the connected components of the graph with edges (i[k], j[k]) over n
+# nodes by the smallest node of each component. labels are propagated along
+# all edges at once and shortcut by pointer jumping, so the number of numpy
+# passes grows with the log of the component diameter, not with the edges
+def _components(n, i, j):
+   labels = np.arange(n)
+   while True:
+      previous = labels.copy()
+      np.minimum.at(labels, i, labels[j])
+      np.minimum.at(labels, j, labels[i])
+      labels = labels[labels]
+      if np.array_equal(labels, previous):
+         return labels
+
+
+# the (start, width) of each of n_bands bands covering 64 bits
+def _bands(n_bands, n_bits=64):
+   widths = [n_bits // n_bands + (1 if b < n_bits % n_bands else 0) for b in range(n_bands)]
+   starts = np.cumsum([0] + widths[:-1])
+   return list(zip(starts.tolist(), widths))
+
+
+# takes in an array of uint64 hashes, returns a group label per hash such that
+# hashes within max_distance bits (transitively) share a label
+def group_hashes(hashes, max_distance=6, block_size=1024):
+   hashes = np.asarray(hashes, dtype=np.uint64)
+   # identical hashes are compared once, so large buckets of exact duplicates
+   # (e.g. blank labels) don't turn into quadratic comparisons
+   unique, inverse = np.unique(hashes, return_inverse=True)
+   inverse = inverse.reshape(-1)
+
+   pairs_i, pairs_j = [], []
+   for start, width in _bands(max_distance + 1):
+      band = (unique >> np.uint64(64 - start - width)) & np.uint64((1 << width) - 1)
+      order = np.argsort(band, kind="stable")
+      boundaries = np.flatnonzero(np.diff(band[order])) + 1
+      for bucket in np.split(order, boundaries):
+         if len(bucket) < 2:
+            continue
+         # all pairs of the bucket as blocks of a distance matrix, so even
+         # large buckets cost a few vector ops instead of a Python loop
+         bucket_hashes = unique[bucket]
+         for row_start in range(0, len(bucket), block_size):
+            rows = bucket_hashes[row_start:row_start + block_size]
+            distances = hamming(rows[:, None], bucket_hashes[None, :])
+            i, j = np.nonzero(distances <= max_distance)
+            i += row_start
+            upper = j > i
+            pairs_i.append(bucket[i[upper]])
+            pairs_j.append(bucket[j[upper]])
+
+   if pairs_i:
+      unique_labels = _components(len(unique), np.concatenate(pairs_i), np.concatenate(pairs_j))
+   else:
+      unique_labels = np.arange(len(unique))
+   # label each group by its first hash in input order
+   components = unique_labels[inverse]
+   first = np.full(len(unique), len(hashes))
+   np.minimum.at(first, components, np.arange(len(hashes)))
+   return first[components]
+
+
+def find_duplicate_groups(hashes_by_path, max_distance=6):
+   filepaths = sorted(hashes_by_path)
+   labels = group_hashes([hashes_by_path[p] for p in filepaths], max_distance)
+   members = {}
+   for filepath, label in zip(filepaths, labels.tolist()):
+      members.setdefault(label, []).append(filepath)
+   groups = [paths for paths in members.values() if len(paths) > 1]
+   groups.sort(key=len, reverse=True)
+   return [{
+      "id": group_id,
+      "members": [{"filepath": p, "name": os.path.basename(p), "bdr_code": extract_bdr_code(p)} for p in paths],
+   } for group_id, paths in enumerate(groups)]
+
+
+# O(1) lookup of a label's duplicate group, from the job's output
+class DuplicateIndex:
+   def __init__(self, out_dir=DEFAULT_OUT_DIR):
+      with open(os.path.join(out_dir, GROUPS_FILENAME)) as f:
+         data = json.load(f)
+      self.max_distance = data["max_distance"]
+      self.groups = data["groups"]
+      # keyed by resolved path: labels with the same name in different
+      # folders are different labels
+      self.group_of = {os.path.realpath(member["filepath"]): group["id"]
+                       for group in self.groups for member in group["members"]}
+
+   def __len__(self):
+      return len(self.groups)
+
+   # the group (id and members) of a label by path, or None. relative paths
+   # are resolved against the current directory
+   def group_for(self, filepath):
+      group_id = self.group_of.get(os.path.realpath(filepath))
+      return self.groups[group_id] if group_id is not None else None
+
+
+def main():
+   parser = argparse.ArgumentParser()
+   parser.add_argument("image_dirs", nargs="+", help="folders of label images")
+   parser.add_argument("--out", default=DEFAULT_OUT_DIR, help="directory to write hashes and groups to")
+   parser.add_argument("--max-distance", type=int, default=6, help="max differing hash bits for duplicates")
+   parser.add_argument("--workers", type=int, default=None, help="hashing processes (default: all cores)")
+   args = parser.parse_args()
+
+   # resolved paths, so groups can be looked up from any working directory
+   filepaths = [os.path.realpath(os.path.join(d, f)) for d in args.image_dirs for f in sorted(os.listdir(d))
+                if f.lower().endswith(IMAGE_EXTENSIONS)]
+   os.makedirs(args.out, exist_ok=True)
+
+   # hashes from earlier runs are reused (by path), so reruns only hash new labels
+   hashes_path = os.path.join(args.out, "hashes.npz")
+   hashes_by_path = {}
+   if os.path.exists(hashes_path):
+      saved = np.load(hashes_path, allow_pickle=False)
+      hashes_by_path = dict(zip(saved["filepaths"].tolist(), saved["hashes"].tolist()))
+   new_paths = [p for p in filepaths if p not in hashes_by_path]
+
+   start = time.time()
+   hashes_by_path.update(hash_images(new_paths, args.workers))
+   hashes_by_path = {p: hashes_by_path[p] for p in filepaths if p in hashes_by_path}
+   hash_time = time.time() - start
+   np.savez(hashes_path, filepaths=np.array(list(hashes_by_path), dtype=str),
+            hashes=np.array(list(hashes_by_path.values()), dtype=np.uint64))
+
+   start = time.time()
+   groups = find_duplicate_groups(hashes_by_path, args.max_distance)
+   group_time = time.time() - start
+
+   tmp_path = os.path.join(args.out, f"{GROUPS_FILENAME}.tmp")
+   with open(tmp_path, "w") as f:
+      json.dump({"max_distance": args.max_distance, "groups": groups}, f)
+   os.replace(tmp_path, os.path.join(args.out, GROUPS_FILENAME))
+
+   print(f"Hashed {len(new_paths)} new labels in {hash_time:.1f}s; grouped {len(hashes_by_path)} labels "
+         f"in {group_time:.1f}s into {len(groups)} duplicate groups "
+         f"({sum(len(g['members']) for g in groups)} labels). Saved to {args.out}")
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,148 @@
+import argparse
+import hashlib
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import numpy as np
+import torch
+from tqdm import tqdm
+from embedding_store import EmbeddingStore, DEFAULT_STORE_DIR
+from clusters import assign_new
+import model
+
+# headless, incremental CLIP embedding of new label images
+#
+# finds the images in the given folders that have no embedding in the store
+# yet, decodes and preprocesses them on a pool of threads (keeping a few
+# batches prefetched so the model never waits on I/O) and encodes them in
+# large CPU batches. new vectors are appended to the store as new shards;
+# stored vectors are never rewritten. no FiftyOne and no app, so it runs on
+# a server or in cron
+#
+#    python embed.py ../server/segmented_images --batch-size 64 --threads 8
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+# stable id for an image that never was a FiftyOne sample
+def file_sample_id(filepath):
+   return hashlib.sha1(filepath.encode("utf-8")).hexdigest()[:24]
+
+
+# absolute paths of the images in image_dirs that are not in the store
+def find_new_images(image_dirs, store):
+   stored = {os.path.abspath(p) for p in store.stored_filepaths()}
+   new_images = []
+   for image_dir in image_dirs:
+      for f in sorted(os.listdir(image_dir)):
+         filepath = os.path.abspath(os.path.join(image_dir, f))
+         if f.lower().endswith(IMAGE_EXTENSIONS) and filepath not in stored:
+            new_images.append(filepath)
+   return new_images
+
+
+# decode and preprocess one image; returns None if it can't be read
+def load_and_preprocess(filepath, preprocess):
+   try:
+      with Image.open(filepath) as img:
+         return preprocess(img.convert("RGB"))
+   except OSError as e:
+      print(f"Skipping {filepath}: {e}")
+      return None
+
+
+# yields (filepaths, batch tensor) in order, with at most prefetch batches
+# of images being decoded ahead of the one the model is working on
+def prefetched_batches(filepaths, preprocess, batch_size, workers, prefetch):
+   with ThreadPoolExecutor(max_workers=workers) as executor:
+      pending = deque()
+      next_image = 0
+      while next_image < len(filepaths) or pending:
+         while next_image < len(filepaths) and len(pending) < batch_size * (prefetch + 1):
+            pending.append((filepaths[next_image], executor.submit(load_and_preprocess, filepaths[next_image], preprocess)))
+            next_image += 1
+
+         batch_paths, tensors = [], []
+         while pending and len(tensors) < batch_size:
+            filepath, future = pending.popleft()
+            tensor = future.result()
+            if tensor is not None:
+               batch_paths.append(filepath)
+               tensors.append(tensor)
+         if tensors:
+            yield batch_paths, torch.stack(tensors)
+
+
+# embed every new image and append it to the store, flushing a shard every
+# shard_size images so an interrupted run keeps what it already encoded
+# returns (number of images embedded, seconds)
+def embed_new_images(image_dirs, store_dir=DEFAULT_STORE_DIR, batch_size=64, workers=4, prefetch=2,
+                     threads=None, shard_size=10000, dtype=None, limit=None):
+   store = EmbeddingStore(store_dir)
+   filepaths = find_new_images(image_dirs, store)[:limit]
+   if not filepaths:
+      return 0, 0.0
+
+   torch.set_num_threads(threads or os.cpu_count())
+   engine = model.ImageSearchEngine(device="cpu")
+   _, preprocess = engine.load_model()
+
+   start = time.perf_counter()
+   done = 0
+   shard_paths, shard_vectors = [], []
+
+   def flush():
+      if shard_paths:
+         store.append(np.concatenate(shard_vectors), [file_sample_id(p) for p in shard_paths], shard_paths,
+                      dtype=dtype, model_name=engine.model_name)
+         shard_paths.clear()
+         shard_vectors.clear()
+
+   with tqdm(total=len(filepaths), unit="img") as progress:
+      for batch_paths, batch in prefetched_batches(filepaths, preprocess, batch_size, workers, prefetch):
+         shard_vectors.append(engine.encode_preprocessed(batch))
+         shard_paths.extend(batch_paths)
+         done += len(batch_paths)
+         progress.update(len(batch_paths))
+         if len(shard_paths) >= shard_size:
+            flush()
+   flush()
+   return done, time.perf_counter() - start
+
+
+def main():
+   parser = argparse.ArgumentParser()
+   parser.add_argument("image_dirs", nargs="+", help="folders of label images")
+   parser.add_argument("--store", default=DEFAULT_STORE_DIR, help="embedding store directory")
+   parser.add_argument("--batch-size", type=int, default=64, help="images per CLIP forward pass")
+   parser.add_argument("--workers", type=int, default=4, help="threads decoding and preprocessing images")
+   parser.add_argument("--prefetch", type=int, default=2, help="batches to decode ahead of the model")
+   parser.add_argument("--threads", type=int, default=None, help="torch CPU threads (default: all cores)")
+   parser.add_argument("--shard-size", type=int, default=10000, help="images per appended shard")
+   dtype = parser.add_mutually_exclusive_group()
+   dtype.add_argument("--float16", action="store_true", help="store the new vectors as float16 (see embedding_store.py)")
+   dtype.add_argument("--int8", action="store_true", help="store the new vectors as int8 with per-vector scales (see embedding_store.py)")
+   parser.add_argument("--limit", type=int, default=None, help="embed at most this many new images")
+   parser.add_argument("--clusters", default=None,
+                       help="cluster directory to assign the new images to (see clusters.py)")
+   args = parser.parse_args()
+
+   num_images, seconds = embed_new_images(
+      args.image_dirs, args.store, batch_size=args.batch_size, workers=args.workers, prefetch=args.prefetch,
+      threads=args.threads, shard_size=args.shard_size,
+      dtype="float16" if args.float16 else "int8" if args.int8 else None, limit=args.limit,
+   )
+   if num_images == 0:
+      print("No new images to embed")
+      return
+   print(f"Embedded {num_images} images in {seconds:.1f}s ({num_images / seconds:.1f} images/sec). "
+         f"Store {args.store} now holds {len(EmbeddingStore(args.store))} embeddings")
+   if args.clusters:
+      print(f"Assigned {assign_new(args.clusters, args.store)} new images to clusters in {args.clusters}")
+   print("Rebuild the ANN index (ann_index.py --store) to include them; until then search is exact")
+
+
+if __name__ == "__main__":
+   main()
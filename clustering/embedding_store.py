@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+import re
+import numpy as np
+from quantization import quantize_int8, dequantize_int8
+
+# standalone store of CLIP embeddings, exported from the FiftyOne dataset so
+# that image search can start without importing FiftyOne (and MongoDB)
+#
+# on-disk layout (one directory):
+#    store.json          model name, dimension, dtype and the list of shards
+#    shard_00000.npy     (n, d) L2-normalized embeddings, float32 or float16,
+#                        or int8 codes with per-row scales in shard_00000.scales.npy
+#    shard_00000.json    sidecar: sample id, filepath and BDR code of each row
+# shards are only ever appended, so adding images never rewrites the
+# vectors that are already stored. a single shard is memory-mapped as is;
+# several shards are concatenated into one matrix on load
+#
+# a store with float16 or int8 shards loads as a float16 matrix (int8 codes
+# are dequantized shard by shard), so the search engine keeps half the
+# memory of float32 resident and converts rows to float32 in chunks while
+# scoring (see model.score_rows). int8 only saves disk beyond that
+
+DEFAULT_STORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "embedding_store")
+STORE_META = "store.json"
+DTYPES = ("float32", "float16", "int8")
+
+
+# BDR code from a label filename like 412661_19.jpg, or None
+def extract_bdr_code(filepath):
+   code_match = re.search(r"(\d+)", os.path.basename(filepath))
+   return code_match.group(1) if code_match else None
+
+
+class EmbeddingStore:
+   def __init__(self, store_dir=DEFAULT_STORE_DIR):
+      self.store_dir = store_dir
+      try:
+         with open(os.path.join(store_dir, STORE_META)) as f:
+            self.meta = json.load(f)
+      except FileNotFoundError:
+         self.meta = {"model": None, "dim": None, "dtype": "float32", "shards": []}
+
+   def exists(self):
+      return len(self.meta["shards"]) > 0
+
+   def __len__(self):
+      return sum(shard["count"] for shard in self.meta["shards"])
+
+   # returns (embeddings, sample_ids, filepaths, bdr_codes); embeddings is an
+   # (n, d) matrix, float32 if every shard is float32 and float16 otherwise,
+   # the other three are object arrays
+   def load(self, mmap=True):
+      shards = self.meta["shards"]
+      matrices = []
+      sample_ids, filepaths, bdr_codes = [], [], []
+      for shard in shards:
+         vectors = np.load(os.path.join(self.store_dir, shard["vectors"]), mmap_mode="r" if mmap else None)
+         if shard.get("scales"):
+            vectors = dequantize_int8(vectors, np.load(os.path.join(self.store_dir, shard["scales"])), dtype=np.float16)
+         matrices.append(vectors)
+         with open(os.path.join(self.store_dir, shard["sidecar"])) as f:
+            sidecar = json.load(f)
+         sample_ids.extend(sidecar["ids"])
+         filepaths.extend(sidecar["filepaths"])
+         bdr_codes.extend(sidecar["bdr_codes"])
+
+      dtype = np.float32 if all(m.dtype == np.float32 for m in matrices) else np.float16
+      if not matrices:
+         embeddings = np.empty((0, self.meta["dim"] or 0), dtype=np.float32)
+      elif len(matrices) == 1:
+         embeddings = matrices[0]
+      else:
+         embeddings = np.concatenate([np.asarray(m, dtype=dtype) for m in matrices])
+      return (
+         embeddings,
+         np.array(sample_ids, dtype=object),
+         np.array(filepaths, dtype=object),
+         np.array(bdr_codes, dtype=object),
+      )
+
+   # sample ids of every stored row, without loading any vectors
+   def stored_ids(self):
+      return self._sidecar_values("ids")
+
+   # filepaths of every stored row, without loading any vectors
+   def stored_filepaths(self):
+      return self._sidecar_values("filepaths")
+
+   def _sidecar_values(self, key):
+      values = set()
+      for shard in self.meta["shards"]:
+         with open(os.path.join(self.store_dir, shard["sidecar"])) as f:
+            values.update(json.load(f)[key])
+      return values
+
+   # write L2-normalized embeddings and their ids/filepaths as a new shard
+   # dtype defaults to the store's dtype; returns the shard's name
+   def append(self, embeddings, sample_ids, filepaths, dtype=None, model_name="ViT-B/32"):
+      embeddings = np.asarray(embeddings)
+      dtype = dtype or self.meta["dtype"]
+      if dtype not in DTYPES:
+         raise ValueError(f"dtype must be one of {DTYPES}, got {dtype!r}")
+      if self.meta["dim"] is not None and embeddings.shape[1] != self.meta["dim"]:
+         raise ValueError(f"embedding dimension {embeddings.shape[1]} does not match the store's {self.meta['dim']}")
+      if self.meta["model"] is not None and model_name != self.meta["model"]:
+         raise ValueError(f"store holds {self.meta['model']} embeddings, not {model_name}")
+      if not (len(embeddings) == len(sample_ids) == len(filepaths)):
+         raise ValueError("embeddings, sample_ids and filepaths must have the same length")
+
+      os.makedirs(self.store_dir, exist_ok=True)
+      name = f"shard_{len(self.meta['shards']):05d}"
+      shard = {"vectors": f"{name}.npy", "sidecar": f"{name}.json", "count": len(embeddings)}
+      if dtype == "int8":
+         codes, scales = quantize_int8(embeddings)
+         np.save(os.path.join(self.store_dir, f"{name}.npy"), codes)
+         np.save(os.path.join(self.store_dir, f"{name}.scales.npy"), scales)
+         shard["scales"] = f"{name}.scales.npy"
+      else:
+         np.save(os.path.join(self.store_dir, f"{name}.npy"), embeddings.astype(dtype))
+      with open(os.path.join(self.store_dir, f"{name}.json"), "w") as f:
+         json.dump({
+            "ids": [str(i) for i in sample_ids],
+            "filepaths": [str(p) for p in filepaths],
+            "bdr_codes": [extract_bdr_code(str(p)) for p in filepaths],
+         }, f)
+
+      # the shard only becomes visible once store.json lists it
+      meta = dict(self.meta, model=model_name, dim=int(embeddings.shape[1]))
+      if not self.meta["shards"]:
+         meta["dtype"] = dtype
+      meta["shards"] = self.meta["shards"] + [shard]
+      tmp_path = os.path.join(self.store_dir, f"{STORE_META}.tmp")
+      with open(tmp_path, "w") as f:
+         json.dump(meta, f, indent=2)
+      os.replace(tmp_path, os.path.join(self.store_dir, STORE_META))
+      self.meta = meta
+      return name
+
+   # replace the whole store with a single shard
+   @classmethod
+   def create(cls, store_dir, embeddings, sample_ids, filepaths, dtype="float32", model_name="ViT-B/32"):
+      old = cls(store_dir)
+      for shard in old.meta["shards"]:
+         for filename in (shard["vectors"], shard["sidecar"], shard.get("scales")):
+            if filename is None:
+               continue
+            path = os.path.join(store_dir, filename)
+            if os.path.exists(path):
+               os.remove(path)
+      meta_path = os.path.join(store_dir, STORE_META)
+      if os.path.exists(meta_path):
+         os.remove(meta_path)
+
+      store = cls(store_dir)
+      store.append(embeddings, sample_ids, filepaths, dtype=dtype, model_name=model_name)
+      return store
+
+
+# export the embeddings of the FiftyOne dataset (needs FiftyOne installed)
+#    python embedding_store.py --dataset datasets --out embedding_store [--float16 | --int8]
+def main():
+   parser = argparse.ArgumentParser()
+   parser.add_argument("--dataset", default="datasets", help="FiftyOne dataset directory")
+   parser.add_argument("--out", default=DEFAULT_STORE_DIR, help="directory to write the store to")
+   dtype = parser.add_mutually_exclusive_group()
+   dtype.add_argument("--float16", action="store_true", help="store vectors as float16 (half the size on disk and in memory)")
+   dtype.add_argument("--int8", action="store_true", help="store vectors as int8 with per-vector scales (~1/4 the size on disk, loaded as float16)")
+   args = parser.parse_args()
+
+   import model
+   engine = model.ImageSearchEngine(model.load_clustered_model(args.dataset))
+   store = EmbeddingStore.create(args.out, engine.embeddings, engine.sample_ids, engine.filepaths,
+                                 dtype="float16" if args.float16 else "int8" if args.int8 else "float32",
+                                 model_name=engine.model_name)
+   print(f"Exported {len(store)} embeddings ({store.meta['dtype']}, d={store.meta['dim']}) to {args.out}")
+
+
+if __name__ == "__main__":
+   main()
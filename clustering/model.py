@@ -1,21 +1,30 @@
-import fiftyone as fo
-import fiftyone.brain as fob
-from fiftyone import ViewField as F
 import os
 from PIL import Image
 import clip # pip install git+https://github.com/openai/CLIP.git
 import torch
-from sklearn.metrics.pairwise import cosine_similarity
+import threading
 import matplotlib.pyplot as plt
 import numpy as np
+from ann_index import IVFIndex, fingerprint_ids
+from embedding_store import EmbeddingStore
+from quantization import QuantizedIndex
+
+# FiftyOne is only needed to build, visualize and load the clustered dataset;
+# image search can run from an exported EmbeddingStore without it, so it is
+# imported inside the functions that use it
 
 # takes in a directory to the segmented labels
 # returns clustered dataset
 # RUN ON GPU
-def cluster_dataset(segmented_labels_dir):
+# launch_app opens the FiftyOne app, which blocks headless runs; for headless
+# embedding of new labels use embed.py
+def cluster_dataset(segmented_labels_dir, launch_app=True):
+   import fiftyone as fo
+   import fiftyone.brain as fob
    image_files = [os.path.join(segmented_labels_dir, f) for f in os.listdir(segmented_labels_dir) if f.endswith(('.jpg', '.jpeg', '.png'))]
    dataset = fo.Dataset.from_images(image_files, name='labels_test', overwrite=True)
-   session = fo.launch_app(dataset)
+   if launch_app:
+      session = fo.launch_app(dataset)
    # compute features
    res = fob.compute_visualization(
         dataset,
@@ -30,6 +39,7 @@ def cluster_dataset(segmented_labels_dir):
 
 # load in a dataset from a file
 def load_clustered_model(model_dir):
+   import fiftyone as fo
    name = "my-dataset"
 
    # Create the dataset
@@ -43,35 +53,320 @@ def load_clustered_model(model_dir):
 
    return dataset
 
-# takes in a path to the search image and dataset, as well as k, the number of results to return
-# returns top k similar images to the search image, as well as their similarity scores
-def query_image(image_path, dataset, k):
-   model_name = "ViT-B/32"
-   device = "cuda" if torch.cuda.is_available() else "cpu"
+# long-lived image search over the CLIP embeddings of a clustered dataset
+# loads the encoder once and keeps the embeddings resident as an L2-normalized
+# float32 matrix, so each query is one encode plus one matrix-vector product
+# (a float16 matrix from a reduced-precision store is scored in chunks, see
+# score_rows)
+class ImageSearchEngine:
+   def __init__(self, dataset=None, model_name="ViT-B/32", device=None):
+      self.model_name = model_name
+      self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+      self.model = None
+      self.preprocess = None
+      self._model_lock = threading.Lock()
+
+      # (embeddings, sample_ids, filepaths) is swapped as a single tuple on
+      # reload, so a query that already grabbed it keeps a consistent view
+      self._index = (np.empty((0, 0), dtype=np.float32), np.array([], dtype=object), np.array([], dtype=object))
+
+      # optional approximate index; exact search is used while this is None
+      self.ann_index = None
+
+      # optional compressed copy of the embeddings (see quantization.py),
+      # searched when there is no ANN index and the float32 embeddings are
+      # memory-mapped rather than resident, with exact rerank of the top
+      # candidates
+      self.quantized_index = None
+
+      # bumped whenever the embeddings or the ANN index change, so callers
+      # can invalidate anything derived from earlier results
+      self.version = 0
+
+      if dataset is not None:
+         self.reload(dataset)
+
+   # (embeddings, sample_ids, filepaths) as of one moment; reloads replace
+   # the tuple, so the three arrays always belong together
+   def snapshot(self):
+      return self._index
+
+   @property
+   def embeddings(self):
+      return self._index[0]
+
+   @property
+   def sample_ids(self):
+      return self._index[1]
+
+   @property
+   def filepaths(self):
+      return self._index[2]
+
+   def __len__(self):
+      return len(self._index[1])
+
+   # load the CLIP encoder and its preprocess transform (only once)
+   def load_model(self):
+      with self._model_lock:
+         if self.model is None:
+            model, preprocess = clip.load(self.model_name, device=self.device)
+            model.eval()
+            self.model, self.preprocess = model, preprocess
+      return self.model, self.preprocess
+
+   # pull embeddings, ids and filepaths out of the dataset in one scan
+   def reload(self, dataset):
+      sample_ids, filepaths, dataset_embeddings = dataset.values(["id", "filepath", "clip_embeddings"])
+      keep = [i for i, e in enumerate(dataset_embeddings) if e is not None]
+
+      embeddings = np.ascontiguousarray([dataset_embeddings[i] for i in keep], dtype=np.float32)
+      self._set_index(
+         normalize_rows(embeddings),
+         np.array([sample_ids[i] for i in keep], dtype=object),
+         np.array([filepaths[i] for i in keep], dtype=object),
+      )
+      return len(keep)
+
+   # serve search from an exported embedding store (no FiftyOne needed)
+   # the store's vectors are already L2-normalized and are memory-mapped
+   # when possible
+   def reload_from_store(self, store_dir):
+      embeddings, sample_ids, filepaths, _ = EmbeddingStore(store_dir).load()
+      self._set_index(embeddings, sample_ids, filepaths)
+      return len(sample_ids)
+
+   @classmethod
+   def from_store(cls, store_dir, model_name="ViT-B/32", device=None):
+      engine = cls(model_name=model_name, device=device)
+      engine.reload_from_store(store_dir)
+      return engine
+
+   def _set_index(self, embeddings, sample_ids, filepaths):
+      # an ANN index built for a different set of samples would return wrong rows
+      if self.ann_index is not None and self.ann_index.ids_fingerprint != fingerprint_ids(sample_ids):
+         self.ann_index = None
+      if self.quantized_index is not None and self.quantized_index.ids_fingerprint != fingerprint_ids(sample_ids):
+         self.quantized_index = None
+      self._index = (embeddings, sample_ids, filepaths)
+      self.version += 1
+
+   # memory-map an IVF index built offline by ann_index.py
+   # returns False (and keeps exact search) if it was built for other samples
+   def load_ann_index(self, index_dir, nprobe=None):
+      index = IVFIndex.load(index_dir)
+      if index.ids_fingerprint is not None and index.ids_fingerprint != fingerprint_ids(self.sample_ids):
+         print(f"ANN index at {index_dir} does not match the loaded dataset, using exact search")
+         self.ann_index = None
+         return False
+      if nprobe is not None:
+         index.nprobe = nprobe
+      self.ann_index = index
+      self.version += 1
+      return True
+
+   # memory-map a quantized index built offline by quantization.py
+   # returns False (and keeps exact search) if it was built for other samples
+   def load_quantized_index(self, index_dir, rerank=None):
+      index = QuantizedIndex.load(index_dir)
+      if index.ids_fingerprint is not None and index.ids_fingerprint != fingerprint_ids(self.sample_ids):
+         print(f"Quantized index at {index_dir} does not match the loaded dataset, using exact search")
+         self.quantized_index = None
+         return False
+      if rerank is not None:
+         index.rerank = rerank
+      self.quantized_index = index
+      self.version += 1
+      return True
+
+   # load the model and run one dummy forward pass so the first real
+   # query does not pay for lazy initialization
+   def warm_up(self):
+      model, preprocess = self.load_model()
+      blank = Image.new("RGB", (224, 224), "white")
+      self.encode_images([blank])
+
+   # returns an (n, d) float32 matrix of L2-normalized embeddings
+   def encode_images(self, images):
+      model, preprocess = self.load_model()
+      return self.encode_preprocessed(torch.stack([preprocess(img.convert("RGB")) for img in images]))
+
+   # same as encode_images for a batch that already went through preprocess
+   def encode_preprocessed(self, batch):
+      model, _ = self.load_model()
+      with torch.no_grad():
+         features = model.encode_image(batch.to(self.device)).float().cpu().numpy()
+      return normalize_rows(features)
+
+   # returns a (d,) L2-normalized embedding for one image path or PIL image
+   def encode_image(self, image):
+      if isinstance(image, Image.Image):
+         return self.encode_images([image])[0]
+      with Image.open(image) as img:
+         return self.encode_images([img])[0]
 
-   #get image embeddings
-   model, preprocess = clip.load(model_name, device=device)
-   image = preprocess(Image.open(image_path)).unsqueeze(0).to(device)
-   with torch.no_grad():
-      image_embedding = model.encode_image(image).cpu().numpy()
+   # returns indices into the engine arrays and cosine scores of the top k
+   # most similar embeddings, best first
+   # uses the ANN index (or else the quantized index) when one is loaded,
+   # unless exact is set; nprobe trades recall for latency
+   # callers holding a snapshot of the engine arrays (self.snapshot()) pass
+   # its embeddings, so the rows index that snapshot even if the engine reloads
+   def search_embedding(self, query_embedding, k, exact=False, nprobe=None, embeddings=None):
+      if embeddings is None:
+         embeddings = self._index[0]
+      return self._search(embeddings, query_embedding, k, exact, nprobe)
 
-   #get dataset embeddings
-   dataset_embeddings = dataset.values("clip_embeddings")
-   sample_ids = dataset.values("id")
+   # takes in a path to the search image, returns the filepaths, sample ids
+   # and similarity scores of the top k most similar images, best first
+   def query(self, image_path, k, exact=False, nprobe=None):
+      embeddings, sample_ids, filepaths = self._index
+      query_embedding = self.encode_image(image_path)
+      top_k_indices, top_scores = self._search(embeddings, query_embedding, k, exact, nprobe)
+      return filepaths[top_k_indices].tolist(), sample_ids[top_k_indices].tolist(), top_scores
+
+   # takes in a list of image paths or PIL images, returns one
+   # (filepaths, sample_ids, scores) triple per image, best first
+   # the images are encoded in batches of batch_size forward passes and scored
+   # against all embeddings with one matrix-matrix product per chunk
+   def query_batch(self, images, k, exact=False, nprobe=None, batch_size=64):
+      embeddings, sample_ids, filepaths = self._index
+      query_embeddings = np.concatenate(
+         [self._encode_any(images[start:start + batch_size]) for start in range(0, len(images), batch_size)]
+      ) if images else np.empty((0, embeddings.shape[1]), dtype=np.float32)
+      top_indices, top_scores = self._search_batch(embeddings, query_embeddings, k, exact, nprobe)
+      return [(filepaths[rows].tolist(), sample_ids[rows].tolist(), scores)
+              for rows, scores in zip(top_indices, top_scores)]
+
+   # like search_embedding for a (q, d) matrix of query embeddings; returns
+   # lists of per-query indices and scores
+   def search_embeddings(self, query_embeddings, k, exact=False, nprobe=None):
+      return self._search_batch(self._index[0], query_embeddings, k, exact, nprobe)
+
+   def _encode_any(self, images):
+      opened = [img if isinstance(img, Image.Image) else Image.open(img) for img in images]
+      try:
+         return self.encode_images(opened)
+      finally:
+         for img, original in zip(opened, images):
+            if img is not original:
+               img.close()
+
+   # the quantized index only beats exact search when scanning the embeddings
+   # would page them in from disk; with a resident float32 matrix brute force
+   # is both faster and exact
+   @staticmethod
+   def _use_quantized(quantized_index, embeddings):
+      if quantized_index is None or len(quantized_index) != len(embeddings):
+         return False
+      return isinstance(embeddings, np.memmap)
+
+   def _search_batch(self, embeddings, query_embeddings, k, exact, nprobe, chunk_size=256):
+      ann_index = self.ann_index
+      if not exact and ann_index is not None and len(ann_index) == len(embeddings):
+         results = [ann_index.search(q, k, nprobe=nprobe) for q in query_embeddings]
+         return [r[0] for r in results], [r[1] for r in results]
+      quantized_index = self.quantized_index
+      if not exact and self._use_quantized(quantized_index, embeddings):
+         results = [quantized_index.search(q, k, embeddings=embeddings) for q in query_embeddings]
+         return [r[0] for r in results], [r[1] for r in results]
+
+      top_indices, top_scores = [], []
+      query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+      # chunks of queries bound the (chunk, n) score matrix
+      for start in range(0, len(query_embeddings), chunk_size):
+         scores = score_rows(embeddings, query_embeddings[start:start + chunk_size])
+         indices = top_k_rows(scores, k)
+         top_indices.extend(indices)
+         top_scores.extend(np.take_along_axis(scores, indices, axis=1))
+      return top_indices, top_scores
+
+   def _search(self, embeddings, query_embedding, k, exact, nprobe):
+      ann_index = self.ann_index
+      if not exact and ann_index is not None and len(ann_index) == len(embeddings):
+         return ann_index.search(query_embedding, k, nprobe=nprobe)
+      quantized_index = self.quantized_index
+      if not exact and self._use_quantized(quantized_index, embeddings):
+         return quantized_index.search(query_embedding, k, embeddings=embeddings)
+      scores = score_rows(embeddings, np.asarray(query_embedding, dtype=np.float32)[None])[0]
+      top_k_indices = top_k(scores, k)
+      return top_k_indices, scores[top_k_indices]
+
+
+# (q, n) scores of float32 query rows against every embedding. a float32
+# matrix is one product; a float16 one is converted chunk_size rows at a
+# time, so only the half-size copy stays resident
+def score_rows(embeddings, queries, chunk_size=1024):
+   if embeddings.dtype == np.float32:
+      return queries @ embeddings.T
+   scores = np.empty((len(queries), len(embeddings)), dtype=np.float32)
+   for start in range(0, len(embeddings), chunk_size):
+      chunk = np.asarray(embeddings[start:start + chunk_size], dtype=np.float32)
+      scores[:, start:start + chunk_size] = queries @ chunk.T
+   return scores
+
+
+# scale each row to unit length (zero rows are left as zeros)
+def normalize_rows(matrix):
+   matrix = np.asarray(matrix, dtype=np.float32)
+   norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+   norms[norms == 0] = 1
+   return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+
+# indices of the k largest scores, sorted best first
+def top_k(scores, k):
+   k = min(k, len(scores))
+   if k <= 0:
+      return np.array([], dtype=np.int64)
+   candidates = np.argpartition(-scores, k - 1)[:k]
+   return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+# per-row version of top_k for a (q, n) score matrix: returns a (q, k) array
+# of column indices, each row sorted best first
+def top_k_rows(scores, k):
+   k = min(k, scores.shape[1])
+   if k <= 0:
+      return np.empty((len(scores), 0), dtype=np.int64)
+   candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+   order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind="stable")
+   return np.take_along_axis(candidates, order, axis=1)
+
+
+_engines = {}
+
+# returns a shared engine for the dataset, building it on first use
+def get_search_engine(dataset):
+   engine = _engines.get(dataset.name)
+   if engine is None:
+      engine = ImageSearchEngine(dataset)
+      _engines[dataset.name] = engine
+   return engine
+
+
+# takes in a path to the search image and dataset, as well as k, the number of results to return
+# returns top k similar images to the search image, as well as the similarity
+# scores of all samples in dataset order (NaN for samples without an embedding)
+def query_image(image_path, dataset, k):
+   engine = get_search_engine(dataset)
+   embeddings, sample_ids, filepaths = engine.snapshot()
 
    #calculate similarity
-   similarity_scores = cosine_similarity(image_embedding, np.array(dataset_embeddings))[0]
+   query_embedding = engine.encode_image(image_path)
+   scores = score_rows(embeddings, query_embedding[None, :])[0]
 
    #get top k most similar images
-   sorted_indices = np.argsort(similarity_scores)[::-1]
-   top_k_indices = sorted_indices[:k]
-
    top_similar_images = []
-   top_similarity_scores = []
-   for i in top_k_indices:
-      sample = dataset[sample_ids[i]]
-      img = Image.open(sample.filepath)
+   for i in top_k(scores, k):
+      img = Image.open(filepaths[i])
       top_similar_images.append(img)
-      top_similarity_scores.append(similarity_scores[i])
+
+   # the engine only holds samples with an embedding; scatter their scores
+   # back to the dataset's sample positions by id
+   position = {sample_id: i for i, sample_id in enumerate(dataset.values("id"))}
+   rows = np.array([position.get(sample_id, -1) for sample_id in sample_ids.tolist()], dtype=np.int64)
+   in_dataset = rows >= 0
+   similarity_scores = np.full(len(position), np.nan, dtype=np.float32)
+   similarity_scores[rows[in_dataset]] = scores[in_dataset]
 
    return top_similar_images, similarity_scores
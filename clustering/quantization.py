@@ -0,0 +1,301 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+from ann_index import fingerprint_ids
+
+# compressed copies of the CLIP embeddings for search, with optional exact
+# rerank against the float32 vectors
+#
+# methods (bytes per 512-dim vector; float32 is 2048):
+#    float16   1024  half precision, converted back in chunks while scoring
+#    int8       516  per-vector scale: x ~= codes * scale, scale = max|x| / 127
+#    pq        m=64  product quantization: the vector is split into m
+#                    subvectors, each replaced by the id of its nearest of
+#                    256 centroids (one byte)
+#
+# search is asymmetric (ADC): the query stays float32 and only the stored
+# vectors are approximate. for PQ the query's inner product with every
+# centroid of every subspace is computed once into a lookup table. the codes
+# of two neighbouring subspaces are packed into one uint16 and the table is
+# expanded to pairs (65536 entries per pair), so a stored vector's score is
+# m / 2 lookups. codes are stored column-major, so each lookup pass reads
+# one contiguous column. with rerank > 0 the top rerank candidates are
+# rescored exactly against the float32 embeddings, which only touches those
+# rows of a memory-mapped store
+#
+# the codes are held in addition to the engine's embeddings, so they only
+# lower search memory when those come from an embedding store with a single
+# float32 shard, which is memory-mapped: a search then reads the codes and
+# the reranked rows, and the OS can evict the rest of the store. a float16
+# or int8 store is already resident at half size (see embedding_store.py).
+# ImageSearchEngine only searches the index when its embeddings are
+# memory-mapped, and the server only loads it when USE_QUANTIZED_INDEX is
+# set; against a resident matrix brute force is faster and exact
+#
+# on-disk layout (one directory):
+#    codes.npy       (n, d) float16 / int8, or (n, m / 2) uint16 packed PQ code pairs
+#    scales.npy      (n,) float32, int8 only
+#    codebooks.npy   (m, 256, d / m) float32, PQ only
+#    meta.json       method, sizes, default rerank and a fingerprint of the sample ids
+#
+#    python quantization.py --store embedding_store --method pq --out quantized_index
+#    python quantization.py --store embedding_store --report
+
+DEFAULT_QUANTIZED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "quantized_index")
+METHODS = ("float16", "int8", "pq")
+PQ_CENTROIDS = 256
+# rows converted to float32 at a time; small chunks stay in cache
+DENSE_CHUNK = 1024
+PQ_CHUNK = 65536
+
+
+class QuantizedIndex:
+   def __init__(self, method, codes, scales=None, codebooks=None, rerank=0, ids_fingerprint=None):
+      if method not in METHODS:
+         raise ValueError(f"method must be one of {METHODS}, got {method!r}")
+      self.method = method
+      self.codes = codes
+      self.scales = scales
+      self.codebooks = codebooks
+      self.rerank = rerank
+      self.ids_fingerprint = ids_fingerprint
+
+   def __len__(self):
+      return len(self.codes)
+
+   # bytes held by the codes, scales and codebooks
+   @property
+   def nbytes(self):
+      return sum(a.nbytes for a in (self.codes, self.scales, self.codebooks) if a is not None)
+
+   # approximate inner product of the query with every stored vector
+   def scores(self, query_embedding):
+      query_embedding = np.asarray(query_embedding, dtype=np.float32)
+      if self.method == "pq":
+         return self._pq_scores(query_embedding)
+      scores = np.empty(len(self), dtype=np.float32)
+      for start in range(0, len(self), DENSE_CHUNK):
+         scores[start:start + DENSE_CHUNK] = np.asarray(self.codes[start:start + DENSE_CHUNK], dtype=np.float32) @ query_embedding
+      if self.method == "int8":
+         scores *= self.scales
+      return scores
+
+   def _pq_scores(self, query_embedding):
+      m, n_centroids, dsub = self.codebooks.shape
+      table = np.einsum("mcd,md->mc", self.codebooks, query_embedding.reshape(m, dsub))
+      pair_table = (table[0::2, :, None] + table[1::2, None, :]).reshape(m // 2, n_centroids * n_centroids)
+      scores = np.zeros(len(self), dtype=np.float32)
+      looked_up = np.empty(min(PQ_CHUNK, len(self)), dtype=np.float32)
+      for start in range(0, len(self), PQ_CHUNK):
+         chunk_scores = scores[start:start + PQ_CHUNK]
+         out = looked_up[:len(chunk_scores)]
+         for pair in range(m // 2):
+            np.take(pair_table[pair], self.codes[start:start + PQ_CHUNK, pair], out=out)
+            chunk_scores += out
+      return scores
+
+   # returns rows and scores of the top k, best first. with rerank (defaults
+   # to the index's) and the float32 embeddings, the top max(k, rerank)
+   # approximate candidates are rescored exactly
+   def search(self, query_embedding, k, rerank=None, embeddings=None):
+      rerank = self.rerank if rerank is None else rerank
+      scores = self.scores(query_embedding)
+      if rerank and embeddings is not None:
+         candidates = np.sort(_top_k(scores, max(k, rerank)))
+         exact_scores = np.asarray(embeddings[candidates], dtype=np.float32) @ np.asarray(query_embedding, dtype=np.float32)
+         best = _top_k(exact_scores, k)
+         return candidates[best], exact_scores[best]
+      best = _top_k(scores, k)
+      return best, scores[best]
+
+   def save(self, index_dir):
+      os.makedirs(index_dir, exist_ok=True)
+      np.save(os.path.join(index_dir, "codes.npy"), self.codes)
+      if self.scales is not None:
+         np.save(os.path.join(index_dir, "scales.npy"), self.scales)
+      if self.codebooks is not None:
+         np.save(os.path.join(index_dir, "codebooks.npy"), self.codebooks)
+      meta = {
+         "method": self.method,
+         "num_vectors": len(self),
+         "nbytes": self.nbytes,
+         "rerank": self.rerank,
+         "ids_fingerprint": self.ids_fingerprint,
+      }
+      with open(os.path.join(index_dir, "meta.json"), "w") as f:
+         json.dump(meta, f, indent=2)
+
+   # memory-map an index written by save()
+   @classmethod
+   def load(cls, index_dir, mmap=True):
+      with open(os.path.join(index_dir, "meta.json")) as f:
+         meta = json.load(f)
+      optional = {}
+      for name in ("scales", "codebooks"):
+         path = os.path.join(index_dir, f"{name}.npy")
+         optional[name] = np.load(path) if os.path.exists(path) else None
+      return cls(
+         method=meta["method"],
+         codes=np.load(os.path.join(index_dir, "codes.npy"), mmap_mode="r" if mmap else None),
+         rerank=meta.get("rerank", 0),
+         ids_fingerprint=meta.get("ids_fingerprint"),
+         **optional,
+      )
+
+
+# indices of the k largest scores, sorted best first
+def _top_k(scores, k):
+   k = min(k, len(scores))
+   if k <= 0:
+      return np.array([], dtype=np.int64)
+   candidates = np.argpartition(-scores, k - 1)[:k]
+   return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+# returns int8 codes and float32 per-row scales with embeddings ~= codes * scales[:, None]
+def quantize_int8(embeddings):
+   embeddings = np.asarray(embeddings, dtype=np.float32)
+   scales = np.abs(embeddings).max(axis=1) / 127
+   scales[scales == 0] = 1
+   codes = np.clip(np.rint(embeddings / scales[:, None]), -127, 127).astype(np.int8)
+   return codes, scales.astype(np.float32)
+
+
+def dequantize_int8(codes, scales, dtype=np.float32):
+   return (np.asarray(codes, dtype=np.float32) * np.asarray(scales, dtype=np.float32)[:, None]).astype(dtype, copy=False)
+
+
+# euclidean k-means for each of the m subspaces; trains on at most
+# train_size rows and returns (m, n_centroids, d / m) codebooks
+def train_pq(embeddings, m=64, n_centroids=PQ_CENTROIDS, n_iter=20, train_size=50000, seed=0):
+   rng = np.random.default_rng(seed)
+   if m % 2 or embeddings.shape[1] % m:
+      raise ValueError(f"m={m} must be even and divide the dimension {embeddings.shape[1]}")
+   train = embeddings
+   if len(train) > train_size:
+      train = embeddings[np.sort(rng.choice(len(embeddings), train_size, replace=False))]
+   train = np.ascontiguousarray(train, dtype=np.float32)
+   n_centroids = min(n_centroids, len(train))
+   dsub = train.shape[1] // m
+
+   codebooks = np.empty((m, n_centroids, dsub), dtype=np.float32)
+   for j in range(m):
+      sub = np.ascontiguousarray(train[:, j * dsub:(j + 1) * dsub])
+      centroids = sub[rng.choice(len(sub), n_centroids, replace=False)].copy()
+      for _ in range(n_iter):
+         assignments = _nearest(sub, centroids)
+         sums = np.stack([np.bincount(assignments, weights=sub[:, i], minlength=n_centroids)
+                          for i in range(dsub)], axis=1)
+         counts = np.bincount(assignments, minlength=n_centroids)
+
+         # re-seed empty centroids with random training subvectors
+         empty = counts == 0
+         if empty.any():
+            sums[empty] = sub[rng.choice(len(sub), int(empty.sum()), replace=False)]
+            counts[empty] = 1
+         centroids = (sums / counts[:, None]).astype(np.float32)
+      codebooks[j] = centroids
+   return codebooks
+
+
+# index of the nearest (euclidean) centroid of every row
+def _nearest(vectors, centroids):
+   return np.argmin((centroids ** 2).sum(axis=1) - 2 * vectors @ centroids.T, axis=1)
+
+
+# packed PQ codes of every row (see above), computed in chunks to bound memory
+def pq_encode(embeddings, codebooks, chunk_size=65536):
+   m, n_centroids, dsub = codebooks.shape
+   codes = np.empty((len(embeddings), m // 2), dtype=np.uint16, order="F")
+   for start in range(0, len(embeddings), chunk_size):
+      chunk = np.asarray(embeddings[start:start + chunk_size], dtype=np.float32)
+      for pair in range(m // 2):
+         first, second = (_nearest(chunk[:, j * dsub:(j + 1) * dsub], codebooks[j]) for j in (2 * pair, 2 * pair + 1))
+         codes[start:start + chunk_size, pair] = first * n_centroids + second
+   return codes
+
+
+# takes in an (n, d) matrix of L2-normalized embeddings, returns a QuantizedIndex
+def build_quantized_index(embeddings, method, m=64, rerank=0, sample_ids=None, seed=0):
+   fingerprint = fingerprint_ids(sample_ids) if sample_ids is not None else None
+   if method == "float16":
+      return QuantizedIndex(method, np.asarray(embeddings, dtype=np.float16), rerank=rerank, ids_fingerprint=fingerprint)
+   if method == "int8":
+      codes, scales = quantize_int8(embeddings)
+      return QuantizedIndex(method, codes, scales=scales, rerank=rerank, ids_fingerprint=fingerprint)
+   if method == "pq":
+      codebooks = train_pq(embeddings, m=m, seed=seed)
+      return QuantizedIndex(method, pq_encode(embeddings, codebooks), codebooks=codebooks, rerank=rerank,
+                            ids_fingerprint=fingerprint)
+   raise ValueError(f"method must be one of {METHODS}, got {method!r}")
+
+
+# fraction of the exact float32 top k that the index also returns, averaged
+# over queries; returns (recall, exact seconds per query, index seconds per query)
+def recall_at_k(index, embeddings, queries, k, rerank=0):
+   hits = 0
+   exact_time = index_time = 0.0
+   for query_embedding in queries:
+      start = time.perf_counter()
+      exact = _top_k(embeddings @ query_embedding, k)
+      exact_time += time.perf_counter() - start
+
+      start = time.perf_counter()
+      approx, _ = index.search(query_embedding, k, rerank=rerank, embeddings=embeddings)
+      index_time += time.perf_counter() - start
+
+      hits += len(np.intersect1d(exact, approx))
+   return hits / (k * len(queries)), exact_time / len(queries), index_time / len(queries)
+
+
+# memory and recall@k of every method against float32 brute force
+def report(embeddings, k=10, rerank=100, m=64, num_queries=200, seed=0):
+   embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+   rng = np.random.default_rng(seed)
+   queries = embeddings[rng.choice(len(embeddings), min(num_queries, len(embeddings)), replace=False)]
+   print(f"{len(embeddings)} vectors, d={embeddings.shape[1]}; float32 brute force uses "
+         f"{embeddings.nbytes / 2**20:.1f} MiB")
+   print(f"{'method':>8} {'MiB':>8} {'B/vec':>6} {'rerank':>6} {'recall@' + str(k):>10} {'exact ms':>9} {'index ms':>9}")
+   for method in METHODS:
+      start = time.time()
+      index = build_quantized_index(embeddings, method, m=m, seed=seed)
+      build_time = time.time() - start
+      for rerank_size in (0, rerank):
+         recall, exact_time, index_time = recall_at_k(index, embeddings, queries, k, rerank=rerank_size)
+         print(f"{method:>8} {index.nbytes / 2**20:>8.1f} {index.nbytes / len(index):>6.0f} {rerank_size:>6} "
+               f"{recall:>10.3f} {exact_time * 1000:>9.2f} {index_time * 1000:>9.2f}")
+      print(f"{'':>8} (built in {build_time:.1f}s)")
+
+
+def main():
+   from embedding_store import EmbeddingStore, DEFAULT_STORE_DIR
+   parser = argparse.ArgumentParser()
+   parser.add_argument("--store", default=DEFAULT_STORE_DIR, help="embedding store directory")
+   parser.add_argument("--out", default=DEFAULT_QUANTIZED_DIR, help="directory to write the index to")
+   parser.add_argument("--method", choices=METHODS, default="pq")
+   parser.add_argument("--m", type=int, default=64, help="PQ subspaces (bytes per vector)")
+   parser.add_argument("--rerank", type=int, default=100,
+                       help="candidates rescored against float32 per query (0 disables)")
+   parser.add_argument("--report", action="store_true",
+                       help="only report memory and recall@k of every method against float32 brute force")
+   parser.add_argument("-k", type=int, default=10)
+   parser.add_argument("--num-queries", type=int, default=200)
+   args = parser.parse_args()
+
+   embeddings, sample_ids, _, _ = EmbeddingStore(args.store).load()
+   if args.report:
+      report(embeddings, k=args.k, rerank=args.rerank, m=args.m, num_queries=args.num_queries)
+      return
+
+   start = time.time()
+   index = build_quantized_index(embeddings, args.method, m=args.m, rerank=args.rerank, sample_ids=sample_ids)
+   index.save(args.out)
+   print(f"Built {args.method} index over {len(index)} embeddings ({index.nbytes / 2**20:.1f} MiB, "
+         f"float32 is {np.asarray(embeddings).nbytes / 2**20:.1f} MiB) in {time.time() - start:.1f}s. "
+         f"Saved to {args.out}")
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,255 @@
+import argparse
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import numpy as np
+import torch
+from tqdm import tqdm
+import model
+
+# multi-crop index for matching a part of a label (usually a signature)
+#
+# whole-label embeddings are dominated by the printed text and layout, so a
+# small signature crop matches them poorly. here every label is tiled into
+# square overlapping windows at a few scales (fractions of the label's
+# shorter side) and every tile gets its own CLIP embedding. a query crop is
+# scored against all tiles, and each label is ranked by its best tile, whose
+# box is returned so the match can be highlighted
+#
+# vectors are stored as float16 (half the size of the float32 label
+# embeddings) and converted back in chunks while scoring. tiles of one label
+# are stored contiguously, so the best tile per label is one reduceat
+#
+# on-disk layout (one directory):
+#    vectors.npy        (n_tiles, d) float16, L2-normalized
+#    boxes.npy          (n_tiles, 4) int32, x0, y0, x1, y1 in label pixels
+#    label_offsets.npy  (n_labels + 1,) int64, label i is tiles offsets[i]:offsets[i + 1]
+#    labels.json        filepath and (width, height) of every label
+#    meta.json          model, tiling parameters and sizes
+#
+#    python tile_index.py ../server/segmented_images --scales 1.0 0.5 --overlap 0.5
+
+DEFAULT_TILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tile_index")
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+DEFAULT_SCALES = (1.0, 0.5)
+DEFAULT_OVERLAP = 0.5
+MIN_TILE_SIZE = 32
+
+
+class TileIndex:
+   def __init__(self, vectors, boxes, label_offsets, filepaths, sizes, meta):
+      self.vectors = vectors
+      self.boxes = boxes
+      self.label_offsets = label_offsets
+      self.filepaths = np.array(filepaths, dtype=object)
+      self.sizes = np.asarray(sizes, dtype=np.int32).reshape(-1, 2)
+      self.meta = meta
+
+   @property
+   def n_tiles(self):
+      return len(self.vectors)
+
+   def __len__(self):
+      return len(self.filepaths)
+
+   # cosine score of every tile, converting chunk_size float16 rows at a time
+   def tile_scores(self, query_embedding, chunk_size=65536):
+      query_embedding = np.asarray(query_embedding, dtype=np.float32)
+      scores = np.empty(self.n_tiles, dtype=np.float32)
+      for start in range(0, self.n_tiles, chunk_size):
+         scores[start:start + chunk_size] = np.asarray(self.vectors[start:start + chunk_size], dtype=np.float32) @ query_embedding
+      return scores
+
+   # returns label rows, scores and (k, 4) boxes of the best tile of the top
+   # k labels, best first
+   def search(self, query_embedding, k):
+      if len(self) == 0:
+         return np.array([], dtype=np.int64), np.array([], dtype=np.float32), np.empty((0, 4), dtype=np.int32)
+      scores = self.tile_scores(query_embedding)
+      label_scores = np.maximum.reduceat(scores, self.label_offsets[:-1])
+      rows = model.top_k(label_scores, k)
+      best_tiles = np.array([self.label_offsets[row] + np.argmax(scores[self.label_offsets[row]:self.label_offsets[row + 1]])
+                             for row in rows.tolist()], dtype=np.int64)
+      return rows, label_scores[rows], np.asarray(self.boxes[best_tiles]).reshape(-1, 4)
+
+   # takes in a crop (path or PIL image) and an engine with the same CLIP
+   # model, returns filepaths, scores and boxes of the top k labels
+   def query(self, search_engine, image, k):
+      rows, scores, boxes = self.search(search_engine.encode_image(image), k)
+      return self.filepaths[rows].tolist(), scores, boxes
+
+   def save(self, index_dir):
+      os.makedirs(index_dir, exist_ok=True)
+      np.save(os.path.join(index_dir, "vectors.npy"), self.vectors)
+      np.save(os.path.join(index_dir, "boxes.npy"), self.boxes)
+      np.save(os.path.join(index_dir, "label_offsets.npy"), self.label_offsets)
+      with open(os.path.join(index_dir, "labels.json"), "w") as f:
+         json.dump({"filepaths": self.filepaths.tolist(), "sizes": self.sizes.tolist()}, f)
+      meta = dict(self.meta, n_tiles=self.n_tiles, n_labels=len(self), dim=int(self.vectors.shape[1]))
+      # meta.json is written last, so a reader never sees a half-saved index as complete
+      tmp_path = os.path.join(index_dir, "meta.json.tmp")
+      with open(tmp_path, "w") as f:
+         json.dump(meta, f, indent=2)
+      os.replace(tmp_path, os.path.join(index_dir, "meta.json"))
+
+   # memory-map an index written by save()
+   @classmethod
+   def load(cls, index_dir, mmap=True):
+      mmap_mode = "r" if mmap else None
+      with open(os.path.join(index_dir, "meta.json")) as f:
+         meta = json.load(f)
+      with open(os.path.join(index_dir, "labels.json")) as f:
+         labels = json.load(f)
+      return cls(
+         vectors=np.load(os.path.join(index_dir, "vectors.npy"), mmap_mode=mmap_mode),
+         boxes=np.load(os.path.join(index_dir, "boxes.npy"), mmap_mode=mmap_mode),
+         label_offsets=np.load(os.path.join(index_dir, "label_offsets.npy")),
+         filepaths=labels["filepaths"],
+         sizes=labels["sizes"],
+         meta=meta,
+      )
+
+
+# evenly spaced window start positions covering length, at most stride apart
+def _positions(length, window, stride):
+   count = -(-(length - window) // stride) + 1
+   return np.linspace(0, length - window, count).round().astype(int).tolist()
+
+
+# (n, 4) int32 boxes of the square windows tiling a width x height label;
+# window sides are scales of the shorter side, consecutive windows overlap
+# by the given fraction. a label too small to tile is one box
+def tile_boxes(width, height, scales=DEFAULT_SCALES, overlap=DEFAULT_OVERLAP):
+   boxes = []
+   for scale in scales:
+      window = int(round(min(width, height) * scale))
+      if window < MIN_TILE_SIZE:
+         continue
+      stride = max(1, int(round(window * (1 - overlap))))
+      for y in _positions(height, window, stride):
+         for x in _positions(width, window, stride):
+            boxes.append((x, y, x + window, y + window))
+   if not boxes:
+      boxes.append((0, 0, width, height))
+   return np.array(list(dict.fromkeys(boxes)), dtype=np.int32)
+
+
+# decode one label and preprocess all of its tiles
+# returns ((width, height), boxes, list of tensors), or None if it can't be read
+def load_tiles(filepath, preprocess, scales, overlap):
+   try:
+      with Image.open(filepath) as img:
+         img = img.convert("RGB")
+   except OSError as e:
+      print(f"Skipping {filepath}: {e}")
+      return None
+   boxes = tile_boxes(img.width, img.height, scales, overlap)
+   return (img.width, img.height), boxes, [preprocess(img.crop(tuple(box))) for box in boxes.tolist()]
+
+
+# takes in label image paths, returns a TileIndex over all of their tiles
+# labels are decoded and tiled on a pool of threads, a few labels ahead of
+# the model, and the tiles of consecutive labels share batch_size batches
+# a previous index built with the same model and tiling is reused: its
+# labels keep their tiles and only new labels are embedded
+def build_tile_index(filepaths, scales=DEFAULT_SCALES, overlap=DEFAULT_OVERLAP, batch_size=64, workers=4,
+                     prefetch=4, threads=None, previous=None):
+   scales = [float(scale) for scale in scales]
+   torch.set_num_threads(threads or os.cpu_count())
+   engine = model.ImageSearchEngine(device="cpu")
+   meta = {"model": engine.model_name, "scales": scales, "overlap": overlap, "dtype": "float16"}
+
+   kept = {}
+   if previous is not None and all(previous.meta.get(key) == value for key, value in meta.items()):
+      kept = {path: row for row, path in enumerate(previous.filepaths.tolist())}
+   new_paths = [path for path in filepaths if path not in kept]
+
+   label_paths, label_sizes, label_boxes, vectors = [], [], [], []
+   for path in filepaths:
+      row = kept.get(path)
+      if row is not None:
+         start, end = previous.label_offsets[row], previous.label_offsets[row + 1]
+         label_paths.append(path)
+         label_sizes.append(previous.sizes[row].tolist())
+         label_boxes.append(np.asarray(previous.boxes[start:end]))
+         vectors.append(np.asarray(previous.vectors[start:end]))
+
+   if new_paths:
+      _, preprocess = engine.load_model()
+      pending_tiles = []
+
+      def encode(count):
+         batch = torch.stack(pending_tiles[:count])
+         del pending_tiles[:count]
+         vectors.append(engine.encode_preprocessed(batch).astype(np.float16))
+
+      with ThreadPoolExecutor(max_workers=workers) as executor, tqdm(total=len(new_paths), unit="label") as progress:
+         pending = deque()
+         next_label = 0
+         while next_label < len(new_paths) or pending:
+            while next_label < len(new_paths) and len(pending) < workers + prefetch:
+               path = new_paths[next_label]
+               pending.append((path, executor.submit(load_tiles, path, preprocess, scales, overlap)))
+               next_label += 1
+
+            path, future = pending.popleft()
+            tiles = future.result()
+            progress.update(1)
+            if tiles is None:
+               continue
+            size, boxes, tensors = tiles
+            label_paths.append(path)
+            label_sizes.append(list(size))
+            label_boxes.append(boxes)
+            pending_tiles.extend(tensors)
+            while len(pending_tiles) >= batch_size:
+               encode(batch_size)
+         if pending_tiles:
+            encode(len(pending_tiles))
+
+   counts = [len(boxes) for boxes in label_boxes]
+   dim = vectors[0].shape[1] if vectors else 0
+   return TileIndex(
+      vectors=np.concatenate(vectors) if vectors else np.empty((0, dim), dtype=np.float16),
+      boxes=np.concatenate(label_boxes) if label_boxes else np.empty((0, 4), dtype=np.int32),
+      label_offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+      filepaths=label_paths,
+      sizes=label_sizes,
+      meta=meta,
+   )
+
+
+def main():
+   parser = argparse.ArgumentParser()
+   parser.add_argument("image_dirs", nargs="+", help="folders of label images")
+   parser.add_argument("--out", default=DEFAULT_TILE_DIR, help="directory to write the tile index to")
+   parser.add_argument("--scales", type=float, nargs="+", default=list(DEFAULT_SCALES),
+                       help="tile sides as fractions of each label's shorter side")
+   parser.add_argument("--overlap", type=float, default=DEFAULT_OVERLAP, help="overlap of neighbouring tiles (0-1)")
+   parser.add_argument("--batch-size", type=int, default=64, help="tiles per CLIP forward pass")
+   parser.add_argument("--workers", type=int, default=4, help="threads decoding and tiling labels")
+   parser.add_argument("--threads", type=int, default=None, help="torch CPU threads (default: all cores)")
+   parser.add_argument("--rebuild", action="store_true", help="re-embed every label instead of reusing the existing index")
+   args = parser.parse_args()
+   if not 0 <= args.overlap < 1:
+      parser.error("--overlap must be in [0, 1)")
+
+   filepaths = [os.path.abspath(os.path.join(d, f)) for d in args.image_dirs for f in sorted(os.listdir(d))
+                if f.lower().endswith(IMAGE_EXTENSIONS)]
+   previous = None
+   if not args.rebuild and os.path.exists(os.path.join(args.out, "meta.json")):
+      previous = TileIndex.load(args.out, mmap=False)
+
+   start = time.time()
+   index = build_tile_index(filepaths, scales=args.scales, overlap=args.overlap, batch_size=args.batch_size,
+                            workers=args.workers, threads=args.threads, previous=previous)
+   index.save(args.out)
+   print(f"Indexed {index.n_tiles} tiles of {len(index)} labels ({index.vectors.nbytes / 2**20:.0f} MiB) "
+         f"in {time.time() - start:.1f}s. Saved to {args.out}")
+
+
+if __name__ == "__main__":
+   main()
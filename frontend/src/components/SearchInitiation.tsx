@@ -96,12 +96,12 @@ export default function SearchInitiation({ onSubmitComplete }) {
           console.log("Search results:", data);
           
           if (onSubmitComplete && typeof onSubmitComplete === "function") {
-            console.log("submit complete", data.pdf); 
+            console.log("submit complete", data.pdfJob); 
             onSubmitComplete({
               // labelType: variableSelection,
               imagePreview: image,
               results: data.results,
-              pdf: data.pdf
+              pdfJob: data.pdfJob
             });
           } else {
             alert("Search successful!!");
@@ -134,7 +134,7 @@ export default function SearchInitiation({ onSubmitComplete }) {
             // labelType: variableSelection,
             textQuery: inputText.trim(),
             results: data.results,
-            pdf: data.pdf
+            pdfJob: data.pdfJob
         }); }
       }
     } catch (error) {
@@ -2,11 +2,17 @@ import { useState, useEffect } from "react";
 import { ExternalLink, ChevronLeft, X, Download } from "lucide-react";
 import axios from 'axios';
 
+const API_BASE = "http://localhost:5000";
+
+// results carry thumbnail URLs; older responses inline the image as base64
+const resultImageUrl = (item) =>
+  item.thumbnailUrl ? `${API_BASE}${item.thumbnailUrl}` : `data:image/jpeg;base64,${item.image}`;
+
 export default function SearchResultsGallery({ searchData = {}, onBack }) {
   const [results, setResults] = useState([]);
   const [loading, setLoading] = useState(true);
   const [selectedImage, setSelectedImage] = useState(null);
-  const [pdfUrl, setPdfUrl] = useState(null);
+  const [pdfJob, setPdfJob] = useState(null);
   const [downloadLoading, setDownloadLoading] = useState(false);
 
   useEffect(() => {
@@ -19,7 +25,7 @@ export default function SearchResultsGallery({ searchData = {}, onBack }) {
         const fullPlantName = item.metadata?.dwc_accepted_name_usage_ssi || item.filepath.split('/').pop().split('.')[0];
         const yearCollected = item.metadata?.dwc_year_ssi || "Unknown";
         const collectors = item.metadata?.dwc_recorded_by_ssi || "Unknown";
-        const imageUrl = `data:image/jpeg;base64,${item.image}`;
+        const imageUrl = resultImageUrl(item);
 
         return {
           id: index + 1,
@@ -53,8 +59,8 @@ export default function SearchResultsGallery({ searchData = {}, onBack }) {
       // console.log(searchData?.pdf); 
       // console.log(searchData.results); 
 
-      if (searchData?.pdf) {
-        setPdfUrl(searchData.pdf);
+      if (searchData?.pdfJob) {
+        setPdfJob(searchData.pdfJob);
       }
     } else if (searchData?.imagePreview) {
       // image but no results = fetch them from the backend
@@ -105,7 +111,7 @@ export default function SearchResultsGallery({ searchData = {}, onBack }) {
       console.log("Full response data:", data);
 
 
-      console.log("pdf data", data.pdf); 
+      console.log("pdf job", data.pdfJob); 
       
       const formattedResults = data.results.map((item, index) => {
         const catalogNumber = item.metadata?.dwc_catalog_number_ssi || "Unknown";
@@ -115,7 +121,7 @@ export default function SearchResultsGallery({ searchData = {}, onBack }) {
         
         return {
           id: index + 1,
-          imageUrl: `data:image/jpeg;base64,${item.image}`,
+          imageUrl: resultImageUrl(item),
           title: fullPlantName,
           websiteUrl: "https://repository.library.brown.edu/studio/collections/id_643/",
           confidence: `${(item.similarity * 100).toFixed(0)}%`,
@@ -131,9 +137,9 @@ export default function SearchResultsGallery({ searchData = {}, onBack }) {
 
       console.log("SearchResultsGallery received searchData:", searchData);
 
-      if (data.pdf) {
-        setPdfUrl(data.pdf);
-        console.log("data pdf ", data.pdf)
+      if (data.pdfJob) {
+        setPdfJob(data.pdfJob);
+        console.log("data pdf job ", data.pdfJob)
         // setPdfFilename(data.pdf_filename?.split('/').pop())
       }
     } catch (error) {
@@ -145,25 +151,38 @@ export default function SearchResultsGallery({ searchData = {}, onBack }) {
     }
   };
 
-  const downloadPdf = async (base64Data, filename) => {
-    if (!base64Data) {
-      console.error("No PDF data available");
+  // the PDF is generated in the background; wait for the job, then download it
+  const downloadPdf = async (job, filename) => {
+    if (!job) {
+      console.error("No PDF job available");
       return;
     }
 
-    console.log("base 64 data", base64Data); 
-  
     setDownloadLoading(true);
     try {
+      // the server starts rendering on the first status request
+      let status = "pending";
+      for (let attempt = 0; attempt < 120 && status !== "done"; attempt++) {
+        const response = await fetch(`${API_BASE}${job.statusUrl}`);
+        const data = await response.json();
+        status = data.status;
+        if (status === "failed" || !response.ok) {
+          throw new Error(data.error || "PDF generation failed");
+        }
+        if (status !== "done") {
+          await new Promise((resolve) => setTimeout(resolve, 1000));
+        }
+      }
+      if (status !== "done") {
+        throw new Error("Timed out waiting for the PDF to be generated");
+      }
+
       const link = document.createElement('a');
-      link.href = `data:application/pdf;base64,${base64Data}`;
-      console.log("Download link href:", link.href);
+      link.href = `${API_BASE}${job.downloadUrl}`;
       link.setAttribute('download', filename || "results.pdf");
       document.body.appendChild(link);
       link.click();
       document.body.removeChild(link);
-
-      console.log("link", link); 
     } catch (error) {
       console.error("Error downloading PDF:", error);
     } finally {
@@ -191,7 +210,7 @@ export default function SearchResultsGallery({ searchData = {}, onBack }) {
           </div>
           {/* {results.length > 0 && ( */}
             <button
-            onClick={() => {console.log("button clicked"); downloadPdf(pdfUrl, "results.pdf")}}
+            onClick={() => {console.log("button clicked"); downloadPdf(pdfJob, "results.pdf")}}
             // disabled={downloadLoading || !pdfUrl}
             className={`flex items-center px-4 py-2 bg-customPeriwinkle text-white rounded-lg hover:bg-blue-700 transition-colors lexend-deca ${
               downloadLoading ? "opacity-70 cursor-not-allowed" : ""
@@ -0,0 +1,269 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+"""
+BDR CATALOG METADATA
+
+Single place to look up specimen metadata from the Brown Digital Repository.
+Lookups go through two cache layers before touching the network:
+    1) an in-process LRU (no I/O at all)
+    2) a persistent SQLite store keyed by BDR code, shared by every process
+       on the machine and kept across restarts
+Entries expire after a TTL. Items the API reports as missing are cached too
+(negative caching, with a shorter TTL); transient failures are not cached.
+"""
+
+# Override with the environment variable to point at a local stand-in server
+BDR_ITEM_API = os.environ.get("BDR_ITEM_API", "https://repository.library.brown.edu/api/items/bdr:{code}/")
+CACHE_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bdr_metadata_cache.sqlite")
+
+METADATA_TTL = 30 * 24 * 60 * 60  # 30 days
+MISSING_TTL = 24 * 60 * 60        # 1 day
+LRU_SIZE = 4096
+
+MAX_CONCURRENT_REQUESTS = 8
+REQUEST_TIMEOUT = 10  # seconds, per request
+
+# Returned by MetadataCache.get when there is no fresh entry
+NOT_CACHED = object()
+
+
+def parse_item(bdr_code: str, data: dict) -> dict:
+    """
+    Extract the fields we display from a BDR item API response.
+    """
+    metadata = {}
+
+    # Catalog number
+    if "dwc_catalog_number_ssi" in data:
+        metadata["dwc_catalog_number_ssi"] = data["dwc_catalog_number_ssi"]
+
+    # Scientific name
+    if "dwc_accepted_name_usage_ssi" in data:
+        metadata["dwc_accepted_name_usage_ssi"] = data["dwc_accepted_name_usage_ssi"]
+    elif "dwc_scientific_name_ssi" in data:
+        scientific_name = data["dwc_scientific_name_ssi"]
+        if "dwc_scientific_name_authorship_ssi" in data:
+            scientific_name += f" {data['dwc_scientific_name_authorship_ssi']}"
+        metadata["dwc_accepted_name_usage_ssi"] = scientific_name
+
+    # Year
+    if "dwc_year_ssi" in data:
+        metadata["dwc_year_ssi"] = data["dwc_year_ssi"]
+
+    # Collector info
+    if "dwc_recorded_by_ssi" in data:
+        metadata["dwc_recorded_by_ssi"] = data["dwc_recorded_by_ssi"]
+
+    # IIIF image URL
+    if data.get("iiif_resource_bsi", False):
+        metadata["iiif_url"] = f"https://repository.library.brown.edu/iiif/image/bdr:{bdr_code}/info.json"
+
+    return metadata
+
+
+def with_defaults(bdr_code: str, metadata: dict | None) -> dict:
+    """
+    Fill in the catalog number and name fallbacks for a (possibly missing) item.
+    """
+    result = {"dwc_catalog_number_ssi": f"PBRU {bdr_code}"}
+    result.update(metadata or {})
+    if "dwc_accepted_name_usage_ssi" not in result:
+        result["dwc_accepted_name_usage_ssi"] = f"Specimen {bdr_code}"
+    return result
+
+
+class MetadataCache:
+    """
+    LRU in front of a SQLite table of (bdr_code -> metadata or missing).
+    Safe to share between threads.
+    """
+
+    def __init__(
+            self,
+            filename: str = CACHE_FILENAME,
+            ttl: float = METADATA_TTL,
+            missing_ttl: float = MISSING_TTL,
+            lru_size: int = LRU_SIZE
+        ):
+        self.ttl = ttl
+        self.missing_ttl = missing_ttl
+        self.lru_size = lru_size
+        self._lru = OrderedDict()  # K-V pair: (bdr_code, (expires_at, metadata or None))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS metadata ("
+            " bdr_code TEXT PRIMARY KEY,"
+            " found INTEGER NOT NULL,"
+            " data TEXT,"
+            " fetched_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def _remember(self, bdr_code: str, expires_at: float, metadata: dict | None) -> None:
+        self._lru[bdr_code] = (expires_at, metadata)
+        self._lru.move_to_end(bdr_code)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def get(self, bdr_code: str):
+        """
+        Return the cached metadata dict, None if the item is cached as
+        missing, or NOT_CACHED if there is no fresh entry.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._lru.get(bdr_code)
+            if entry is not None and entry[0] > now:
+                self._lru.move_to_end(bdr_code)
+                return entry[1]
+
+            row = self._db.execute(
+                "SELECT found, data, fetched_at FROM metadata WHERE bdr_code = ?", (bdr_code,)
+            ).fetchone()
+            if row is None:
+                return NOT_CACHED
+            found, data, fetched_at = row
+            expires_at = fetched_at + (self.ttl if found else self.missing_ttl)
+            if expires_at <= now:
+                return NOT_CACHED
+            metadata = json.loads(data) if found else None
+            self._remember(bdr_code, expires_at, metadata)
+            return metadata
+
+    def put(self, bdr_code: str, metadata: dict | None) -> None:
+        """
+        Store metadata for a BDR code; None records the item as missing.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO metadata (bdr_code, found, data, fetched_at) VALUES (?, ?, ?, ?)",
+                (bdr_code, metadata is not None, json.dumps(metadata) if metadata is not None else None, now),
+            )
+            self._db.commit()
+            self._remember(bdr_code, now + (self.ttl if metadata is not None else self.missing_ttl), metadata)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> MetadataCache:
+    """
+    Return the process-wide metadata cache, opening it on first use.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = MetadataCache()
+        return _cache
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    Return the process-wide keep-alive session, with a connection pool large
+    enough for MAX_CONCURRENT_REQUESTS parallel requests.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONCURRENT_REQUESTS)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def fetch_item(
+        bdr_code: str,
+        api_url: str | None = None,
+        timeout: float = REQUEST_TIMEOUT
+    ) -> dict | None:
+    """
+    Fetch one item from the BDR API, bypassing the cache. Returns None if
+    the item doesn't exist; raises on network or server errors.
+    """
+    url = (api_url or BDR_ITEM_API).format(code=bdr_code)
+    response = get_session().get(url, timeout=timeout)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return parse_item(bdr_code, response.json())
+
+
+def _fetch_and_cache(bdr_code: str, api_url: str | None, timeout: float) -> dict | None:
+    try:
+        metadata = fetch_item(bdr_code, api_url, timeout)
+    except Exception as e:
+        print(f"Error fetching metadata for BDR:{bdr_code} from API: {e}")
+        return None
+    get_cache().put(bdr_code, metadata)
+    return metadata
+
+
+def fetch_catalog_metadata(bdr_code: str) -> dict:
+    """Fetch catalog metadata for a BDR item, from cache when possible."""
+    return fetch_catalog_metadata_bulk([bdr_code])[0]
+
+
+def fetch_catalog_metadata_bulk(
+        bdr_codes: list[str],
+        max_workers: int = MAX_CONCURRENT_REQUESTS,
+        timeout: float = REQUEST_TIMEOUT,
+        api_url: str | None = None
+    ) -> list[dict]:
+    """
+    Fetch catalog metadata for many BDR items at once.
+
+    Cached items are served from the cache; the rest are fetched
+    concurrently (at most max_workers requests in flight) over a pooled
+    keep-alive session. Duplicate codes are fetched once.
+
+    Parameters
+    ----------
+    bdr_codes : list[str]
+        BDR codes to look up
+    max_workers : int
+        Maximum number of concurrent requests
+    timeout : float
+        Timeout in seconds for each request
+    api_url : str, optional
+        Item URL template with a {code} placeholder; defaults to BDR_ITEM_API
+
+    Returns
+    -------
+    list[dict]
+        Metadata for each code, in the same order as bdr_codes
+    """
+    cache = get_cache()
+    found = {}
+    missing = []
+    for bdr_code in dict.fromkeys(bdr_codes):
+        metadata = cache.get(bdr_code)
+        if metadata is NOT_CACHED:
+            missing.append(bdr_code)
+        else:
+            found[bdr_code] = metadata
+
+    if len(missing) == 1:
+        found[missing[0]] = _fetch_and_cache(missing[0], api_url, timeout)
+    elif missing:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as executor:
+            fetched = executor.map(lambda code: _fetch_and_cache(code, api_url, timeout), missing)
+            found.update(zip(missing, fetched))
+
+    return [with_defaults(bdr_code, found[bdr_code]) for bdr_code in bdr_codes]
@@ -1,55 +1,304 @@
+import hashlib
+import itertools
 import os
+from multiprocessing import Pool
 from tqdm import tqdm
 import json
-from ocr import run_clean_ocr
+from ocr import ocr_text, MYCONFIG, OCR_BACKEND
+from ocr_cleaning import CLEANING_VERSION, extract_phrases_from_texts
+from token_db import BinaryDBWriter, JSONDBWriter, load_label_db
 
-def build_db(image_dir: str, db_filename: str) -> int:
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# Images per worker task; their OCR text is cleaned in one spaCy batch
+OCR_CHUNK_SIZE = 16
+
+"""
+INCREMENTAL BUILDS
+
+Next to the database, a build keeps:
+    <db>.manifest.json  : the OCR config plus a fingerprint (mtime + size, or
+                          a content hash) for every image in the database
+    <db>.journal.jsonl  : one line per image OCRed during the current build,
+                          flushed as it is written. It survives a crash and
+                          is deleted once the build completes.
+
+The database itself is written to a temporary file and moved into place at
+the end, so an interrupted build never leaves a truncated database behind.
+An incremental build carries forward entries whose fingerprint and config
+are unchanged, reuses journal entries from an interrupted build, and OCRs
+everything else.
+"""
+
+
+def _init_worker() -> None:
+    """
+    Pool initializer. spaCy and the OCR config are loaded once per worker
+    when the ocr module is imported (and the tesserocr engine on a worker's
+    first image); Tesseract is limited to one thread so that N workers use
+    N cores instead of oversubscribing them.
+    """
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+
+def _ocr_worker(file_paths: list[str]) -> list[tuple[str, list[str] | None, str | None]]:
+    """
+    Run OCR on a chunk of images, then clean all of their text in a single
+    nlp.pipe call. Returns (file_path, phrases, error) for each image, where
+    exactly one of phrases and error is None.
+    """
+    texts = {}
+    errors = {}
+    for file_path in file_paths:
+        try:
+            texts[file_path] = ocr_text(file_path)
+        except Exception as e:
+            errors[file_path] = f"{type(e).__name__}: {e}"
+    try:
+        phrases = dict(zip(texts, extract_phrases_from_texts(texts.values())))
+    except Exception as e:
+        errors.update(dict.fromkeys(texts, f"{type(e).__name__}: {e}"))
+        phrases = {}
+    return [(file_path, phrases.get(file_path), errors.get(file_path)) for file_path in file_paths]
+
+
+def error_report_filename(db_filename: str) -> str:
+    """
+    Path of the per-image error report written next to the database.
+    """
+    return f"{os.path.splitext(db_filename)[0]}.errors.json"
+
+
+def manifest_filename(db_filename: str) -> str:
+    return f"{os.path.splitext(db_filename)[0]}.manifest.json"
+
+
+def journal_filename(db_filename: str) -> str:
+    return f"{os.path.splitext(db_filename)[0]}.journal.jsonl"
+
+
+def ocr_config_fingerprint() -> str:
+    """
+    Identifies the OCR settings; any change invalidates all previous entries.
+    """
+    return f"tesseract={MYCONFIG};backend={OCR_BACKEND};cleaning={CLEANING_VERSION}"
+
+
+def file_fingerprint(file_path: str, use_hash: bool = False) -> str:
+    """
+    Fingerprint of an image file: its SHA-1 if use_hash, otherwise its
+    modification time and size.
+    """
+    if use_hash:
+        digest = hashlib.sha1()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return f"sha1:{digest.hexdigest()}"
+    stat = os.stat(file_path)
+    return f"mtime:{stat.st_mtime_ns};size:{stat.st_size}"
+
+
+def _load_previous_build(db_filename: str, config: str) -> dict[str, tuple[str, list[str], bool, bool]]:
+    """
+    Return {path: (fingerprint, phrases, from_journal, use_hash)} for entries
+    of the previous build (database + manifest, then journal of an
+    interrupted build) that were made with the same OCR config. use_hash is
+    the fingerprint mode the entry was recorded with.
+    """
+    previous = {}
+    try:
+        with open(manifest_filename(db_filename), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("config") == config:
+            use_hash = manifest.get("use_hash", False)
+            label_db = load_label_db(db_filename)
+            for path, fingerprint in manifest.get("files", {}).items():
+                if path in label_db:
+                    previous[path] = (fingerprint, label_db[path], False, use_hash)
+    except (OSError, ValueError):
+        pass
+
+    # Entries from an interrupted build are newer than the database
+    try:
+        with open(journal_filename(db_filename), "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Line cut short by a crash
+                if entry.get("config") == config:
+                    use_hash = entry.get("use_hash", entry["fingerprint"].startswith("sha1:"))
+                    previous[entry["path"]] = (entry["fingerprint"], entry["phrases"], True, use_hash)
+    except OSError:
+        pass
+
+    return previous
+
+
+def build_db_incremental(
+        image_dir: str,
+        db_filename: str,
+        num_workers: int = 1,
+        incremental: bool = True,
+        use_hash: bool = False,
+        binary: bool = False
+    ) -> dict[str, int]:
+    """
+    Build a text database as a dictionary and stream to a JSON file,
+    OCRing only images that are new or changed since the last build.
+
+    Parameters
+    ----------
+    image_dir : str
+        Path to the label image folder
+    db_filename : str
+        Name of the file to write the database to
+    num_workers : int
+        Number of OCR worker processes. 1 runs in the current process.
+    incremental : bool
+        If False, ignore any previous build and OCR every image
+    use_hash : bool
+        Detect changed images by content hash instead of mtime and size.
+        After a switch, images are compared in the mode they were recorded
+        with and unchanged ones are re-fingerprinted without OCR.
+    binary : bool
+        Write the database in the memory-mappable binary format (see
+        token_db) instead of JSON
+
+    Returns
+    -------
+    dict[str, int]
+        Counts of "entries" written, and of images "skipped" (unchanged),
+        "resumed" (reused from an interrupted build), "added" (new),
+        "reprocessed" (changed), "removed" (no longer present) and "errors"
+    """
+    config = ocr_config_fingerprint()
+    previous_build = _load_previous_build(db_filename, config) if incremental else {}
+    try:
+        with open(manifest_filename(db_filename), "r", encoding="utf-8") as f:
+            previous_files = set(json.load(f).get("files", {}))
+    except (OSError, ValueError):
+        previous_files = set()
+
+    errors = []
+    stats = dict.fromkeys(["entries", "skipped", "resumed", "added", "reprocessed", "removed", "errors"], 0)
+
+    # If just one parent folder, use os.listdir
+    file_paths = []
+    fingerprints = {}
+    for file in sorted(os.listdir(image_dir)):
+        file_path = os.path.join(image_dir, file)
+        if not (os.path.isfile(file_path) and file.lower().endswith(IMAGE_EXTENSIONS)):
+            errors.append({"path": file_path, "error": "Not an image file"})
+            continue
+        file_paths.append(file_path)
+        fingerprints[file_path] = file_fingerprint(file_path, use_hash)
+
+    # Decide what to reuse and what to OCR
+    reused = {}
+    to_process = []
+    for file_path in file_paths:
+        prev = previous_build.get(file_path)
+        if prev is not None and prev[3] != use_hash:
+            # Recorded with the other fingerprint mode: compare in that mode,
+            # then carry the entry forward under the current one without OCR
+            unchanged = prev[0] == file_fingerprint(file_path, prev[3])
+        else:
+            unchanged = prev is not None and prev[0] == fingerprints[file_path]
+        if unchanged:
+            reused[file_path] = prev[1]
+            stats["resumed" if prev[2] else "skipped"] += 1
+        else:
+            to_process.append(file_path)
+            stats["reprocessed" if file_path in previous_files else "added"] += 1
+    stats["removed"] = len(previous_files - set(file_paths))
+
+    chunks = [to_process[i:i + OCR_CHUNK_SIZE] for i in range(0, len(to_process), OCR_CHUNK_SIZE)]
+    if num_workers > 1 and to_process:
+        pool = Pool(num_workers, initializer=_init_worker)
+        results = itertools.chain.from_iterable(pool.imap(_ocr_worker, chunks))
+    else:
+        pool = None
+        results = itertools.chain.from_iterable(map(_ocr_worker, chunks))
+
+    # Entries are streamed to a temporary file that replaces the database when
+    # the writer exits cleanly; on any error (including opening the journal)
+    # the temporary file is removed
+    manifest_files = {}
+    try:
+        with (BinaryDBWriter(db_filename) if binary else JSONDBWriter(db_filename)) as writer, \
+                open(journal_filename(db_filename), "a" if incremental else "w",
+                     encoding="utf-8", buffering=1) as journal:
+            journal.write("\n")  # Terminate a line cut short by a crash
+            progress = tqdm(total=len(to_process))
+            for file_path in file_paths:
+                if file_path in reused:
+                    phrases = reused[file_path]
+                else:
+                    # imap yields in the order of to_process, a subsequence of file_paths
+                    _, phrases, error = next(results)
+                    progress.update(1)
+                    if error is not None:
+                        errors.append({"path": file_path, "error": error})
+                        continue
+                    journal.write(json.dumps({
+                        "path": file_path,
+                        "fingerprint": fingerprints[file_path],
+                        "config": config,
+                        "use_hash": use_hash,
+                        "phrases": phrases,
+                    }, ensure_ascii=False) + "\n")
+
+                writer.add(file_path, phrases)
+                manifest_files[file_path] = fingerprints[file_path]
+            progress.close()
+    finally:
+        # All results have been consumed (or we are unwinding an error)
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    # Commit: database first (above), then its manifest, then drop the journal
+    with open(f"{manifest_filename(db_filename)}.tmp", "w", encoding="utf-8") as f:
+        json.dump({"config": config, "use_hash": use_hash, "files": manifest_files}, f, indent=1)
+    os.replace(f"{manifest_filename(db_filename)}.tmp", manifest_filename(db_filename))
+    os.remove(journal_filename(db_filename))
+
+    with open(error_report_filename(db_filename), "w", encoding="utf-8") as f:
+        json.dump(errors, f, indent=2)
+
+    stats["entries"] = len(manifest_files)
+    stats["errors"] = len(errors)
+    return stats
+
+
+def build_db(image_dir: str, db_filename: str, num_workers: int = 1, binary: bool = False) -> int:
     """
     Build a text database as a dictionary and stream to a JSON file.
 
+    Images are OCRed by a pool of num_workers processes in chunks of
+    OCR_CHUNK_SIZE, and the text of each chunk is cleaned in one spaCy
+    batch. Results are written in sorted file order as they arrive, so the
+    output is deterministic and only a few chunks are held in memory at a
+    time. Images that fail are recorded in an error report next to the
+    database (see error_report_filename) instead of being written to the
+    database.
+
     Parameters
     ----------
     image_dir : str
         Path to the label image folder
     db_filename : str
-        Name of the JSON file to write the database to
+        Name of the file to write the database to
+    num_workers : int
+        Number of OCR worker processes. 1 runs in the current process.
+    binary : bool
+        Write the database in the binary format instead of JSON
 
     Returns
     -------
     int
         The number of entries in the database
     """
-    first_entry = True  # marker for json formatting
-    num_images = len(os.listdir(image_dir))
-
-    with open(db_filename, "w", encoding="utf-8", buffering=1) as f:
-        f.write("{\n")
-
-        # Recursively search all subdirectories for files       
-        # If just one parent folder, use os.listdir
-        for file in tqdm(os.listdir(image_dir)):
-            file_path = os.path.join(image_dir, file)
-        # for dirpath, _, files in os.walk(ROOTDIR):
-        #     for file in tqdm(files):
-        #         file_path = os.path.join(dirpath, file)
-            if not (os.path.isfile(file_path) and file.endswith(('.jpg', '.jpeg', '.png'))):
-                print(f"ERROR: Could not load image at {file_path!r}")
-                continue
-            
-            # Run OCR
-            phrases = run_clean_ocr(file_path)
-            if phrases is None:
-                continue
-            
-            # Stream database pair to a JSON file
-            if first_entry:
-                first_entry = False
-            else:
-                f.write(",\n")
-            f.write(
-                f"  {json.dumps(file_path)}: "
-                f"{json.dumps(phrases, ensure_ascii=False)}"
-            )
-        f.write("\n}\n")
-
-    return num_images
+    stats = build_db_incremental(image_dir, db_filename, num_workers, incremental=False, binary=binary)
+    return stats["entries"]
@@ -1,57 +1,13 @@
 from fpdf import FPDF
+import csv
 import os
 import re
-import requests
+from typing import TextIO
+from bdr_metadata import fetch_catalog_metadata_bulk
 
 _BDR_CODES = re.compile(r'([0-9]{6})')
 
 
-def fetch_catalog_metadata(bdr_code):
-    """Fetch catalog metadata using the direct BDR API endpoint for the item."""
-    metadata = {"dwc_catalog_number_ssi": f"PBRU {bdr_code}"}
-
-    try:
-        # API endpoint for the item
-        api_url = f"https://repository.library.brown.edu/api/items/bdr:{bdr_code}/"
-        response = requests.get(api_url)
-
-        if response.status_code == 200:
-            data = response.json()
-
-            # Catalog number
-            if "dwc_catalog_number_ssi" in data:
-                metadata["dwc_catalog_number_ssi"] = data["dwc_catalog_number_ssi"]
-
-            # Scientific name
-            if "dwc_accepted_name_usage_ssi" in data:
-                metadata["dwc_accepted_name_usage_ssi"] = data["dwc_accepted_name_usage_ssi"]
-            elif "dwc_scientific_name_ssi" in data:
-                scientific_name = data["dwc_scientific_name_ssi"]
-                if "dwc_scientific_name_authorship_ssi" in data:
-                    scientific_name += f" {data['dwc_scientific_name_authorship_ssi']}"
-                metadata["dwc_accepted_name_usage_ssi"] = scientific_name
-
-            # Year
-            if "dwc_year_ssi" in data:
-                metadata["dwc_year_ssi"] = data["dwc_year_ssi"]
-
-            # Collector info
-            if "dwc_recorded_by_ssi" in data:
-                metadata["dwc_recorded_by_ssi"] = data["dwc_recorded_by_ssi"]
-
-            # IIIF image URL
-            if data.get("iiif_resource_bsi", False):
-                metadata["iiif_url"] = f"https://repository.library.brown.edu/iiif/image/bdr:{bdr_code}/info.json"
-
-    except Exception as e:
-        print(f"Error fetching metadata for BDR:{bdr_code} from API: {e}")
-
-    if "dwc_accepted_name_usage_ssi" not in metadata:
-        metadata["dwc_accepted_name_usage_ssi"] = f"Specimen {bdr_code}"
-
-    return metadata
-
-
 class PDFWithFooter(FPDF):
     """
     Define footer method for generating pdf file.
@@ -105,19 +61,20 @@ def generate_pdf(
     num_matches = f"Number of matches found: {len(matched_img_paths)}"
     pdf.cell(200, 10, txt=num_matches, ln=1, align="L") # type: ignore
 
-    for path, score in zip(matched_img_paths, similarity_scores):
+    # Fetch metadata for all matches concurrently up front
+    codes = [re.search(_BDR_CODES, path).group(0) for path in matched_img_paths] # type: ignore
+    all_metadata = fetch_catalog_metadata_bulk(codes)
+
+    for path, score, code, metadata in zip(matched_img_paths, similarity_scores, codes, all_metadata):
         if "/" not in path:
             path = os.path.join(image_dir, path)
 
-        code = re.search(_BDR_CODES, path).group(0) # type: ignore
-        
         # Check remaining space on page
         current_y = pdf.get_y()
         if current_y + image_height + spacing_after_image > pdf.h - pdf.b_margin:
             pdf.add_page()
 
-        # Fetch and add metadata
-        metadata = fetch_catalog_metadata(code)
+        # Add metadata
         catalog_num = metadata.get("dwc_catalog_number_ssi") or "N/A"
         plant_name = metadata.get("dwc_accepted_name_usage_ssi") or "N/A"
         year = metadata.get("dwc_year_ssi") or "N/A"
@@ -172,4 +129,44 @@ def generate_text_file(
     """
     with open(output_path, "w") as f:
         for score, metadata in zip(similarity_scores, all_metadata):
-            f.write(f"{metadata['dwc_catalog_number_ssi']} {score}\n")
\ No newline at end of file
+            f.write(f"{metadata['dwc_catalog_number_ssi']} {score}\n")
+
+def generate_csv_file(
+        query_names: list[str],
+        grouped_paths: list[list[str]],
+        grouped_scores: list[list[float]],
+        grouped_metadata: list[list[dict]],
+        output: str | TextIO,
+    ) -> None:
+    """
+    Generates a CSV file with the matches of several queries (e.g. a batch
+        image search), one row per match: query, rank, PBRU number,
+        similarity score and path of the matched label.
+
+    Parameters
+    ----------
+    query_names : list[str]
+        Name of each query, e.g. the uploaded filename
+    grouped_paths : list[list[str]]
+        For each query, the paths of its matches, best first
+    grouped_scores : list[list[float]]
+        For each query, the match scores corresponding to each path
+    grouped_metadata : list[list[dict]]
+        For each query, the metadata corresponding to each path
+    output : str or file object
+        Path of the output CSV file, or an open text file to write to
+
+    Returns
+    -------
+    None. The CSV is written to output.
+    """
+    if isinstance(output, str):
+        with open(output, "w", newline="") as f:
+            generate_csv_file(query_names, grouped_paths, grouped_scores, grouped_metadata, f)
+        return
+
+    writer = csv.writer(output)
+    writer.writerow(["query", "rank", "catalog_number", "similarity", "filepath"])
+    for name, paths, scores, all_metadata in zip(query_names, grouped_paths, grouped_scores, grouped_metadata):
+        for rank, (path, score, metadata) in enumerate(zip(paths, scores, all_metadata), start=1):
+            writer.writerow([name, rank, metadata['dwc_catalog_number_ssi'], f"{score:.4f}", path])
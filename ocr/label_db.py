@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+from collections.abc import Mapping
+from typing import NamedTuple
+from phrase_index import PhraseIndex
+from phrase_scoring import PhraseScorer
+from token_db import load_label_db
+
+
+class LabelDBSnapshot(NamedTuple):
+    """
+    An immutable view of a loaded token database. A request should take one
+    snapshot and use it throughout, so a reload can never hand it a database
+    and an index that belong to different builds.
+    """
+    label_db: Mapping[str, list[str]]
+    index: PhraseIndex
+    scorer: PhraseScorer
+    mtime: float
+    size: int
+    version: int
+
+
+class LabelDatabase:
+    """
+    Shared, load-once token database with hot reload.
+
+    The file (JSON or binary, see token_db) is loaded and indexed once; a
+    binary file stores its phrase index, which is memory-mapped instead of
+    built, so loading it is near-instant. snapshot() checks the file's mtime
+    and size (at most every check_interval seconds) and, if they changed,
+    loads the rebuilt database in the calling thread and swaps it in
+    atomically. If the new file can't be loaded (e.g. it is still being
+    written), the previous snapshot is kept.
+    """
+
+    def __init__(self, filename: str, check_interval: float = 1.0):
+        self.filename = filename
+        self.check_interval = check_interval
+        self._reload_lock = threading.Lock()
+        self._last_check = 0.0
+        self._snapshot = None
+        self.reload()
+
+    def _stat(self) -> tuple[float, int]:
+        stat = os.stat(self.filename)
+        return stat.st_mtime, stat.st_size
+
+    def _load(self, mtime: float, size: int, version: int) -> LabelDBSnapshot:
+        label_db = load_label_db(self.filename)
+        index = PhraseIndex(label_db)
+        return LabelDBSnapshot(label_db, index, PhraseScorer(index), mtime, size, version)
+
+    @property
+    def version(self) -> int:
+        """
+        Number of times the database has been (re)loaded.
+        """
+        return self._snapshot.version if self._snapshot else 0
+
+    def reload(self) -> LabelDBSnapshot:
+        """
+        Unconditionally reload the database from disk and return the new snapshot.
+        """
+        with self._reload_lock:
+            mtime, size = self._stat()
+            self._snapshot = self._load(mtime, size, self.version + 1)
+            self._last_check = time.monotonic()
+            return self._snapshot
+
+    def snapshot(self) -> LabelDBSnapshot:
+        """
+        Return the current snapshot, reloading first if the file changed.
+        """
+        current = self._snapshot
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return current
+
+        # Only one thread checks and reloads; the others keep serving the
+        # current snapshot in the meantime
+        if not self._reload_lock.acquire(blocking=False):
+            return current
+        try:
+            self._last_check = now
+            mtime, size = self._stat()
+            if (mtime, size) != (current.mtime, current.size):
+                try:
+                    self._snapshot = self._load(mtime, size, current.version + 1)
+                    print(f"Reloaded label database {self.filename!r} "
+                          f"({len(self._snapshot.label_db)} images)")
+                except (OSError, ValueError) as e:
+                    print(f"ERROR: Could not reload label database {self.filename!r}: {e}")
+        except OSError as e:
+            print(f"ERROR: Could not stat label database {self.filename!r}: {e}")
+        finally:
+            self._reload_lock.release()
+        return self._snapshot
+
+
+_databases: dict[str, LabelDatabase] = {}
+_databases_lock = threading.Lock()
+
+
+def get_label_database(filename: str) -> LabelDatabase:
+    """
+    Return the process-wide LabelDatabase for filename, loading it on first use.
+    """
+    key = os.path.abspath(filename)
+    with _databases_lock:
+        if key not in _databases:
+            _databases[key] = LabelDatabase(filename)
+        return _databases[key]
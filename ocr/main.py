@@ -2,7 +2,8 @@ import argparse
 import os
 import time
 from ocr import run_clean_ocr
-from build_db import build_db
+from build_db import build_db, build_db_incremental, error_report_filename
+from token_db import BINARY_DB_EXTENSION
 from query import query_by_image, query_by_label
 
 # Arguments for build_db
@@ -15,7 +16,7 @@ def main():
     Central place to run different OCR-related tasks.
 
     Command line usage:
-    - python3 main.py -t build_db
+    - python3 main.py -t build_db [--workers 8] [--incremental [--hash]] [--binary]
     - python3 main.py -t ocr -i ./images/label_1.jpg
     - python3 main.py -t query (--image ./images/label_1.jpg | --text "label name")
 
@@ -23,6 +24,13 @@ def main():
     -t | --task   : Required. One of ['ocr', 'build_db', 'query']
     -i | --image  : Required for 'ocr'. Optional for 'query' if --text is provided.
     --text        : Required for 'query' if --image is not provided.
+    -w | --workers: Optional for 'build_db'. Number of OCR worker processes.
+    --incremental : Optional for 'build_db'. Only OCR new or changed images and
+                    resume an interrupted build.
+    --hash        : Optional with --incremental. Detect changes by content hash
+                    instead of modification time and size.
+    --binary      : Optional for 'build_db'. Write the memory-mappable binary
+                    database (DATABASE_FILENAME with a .tokdb extension).
     """
 
     parser = argparse.ArgumentParser()
@@ -34,6 +42,14 @@ def main():
 
     parser.add_argument("-i", "--image", help="Path to image to query")
     parser.add_argument("--text", help="Text string to query")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of OCR worker processes for 'build_db'")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only OCR new or changed images in 'build_db'")
+    parser.add_argument("--hash", action="store_true",
+                        help="Detect changed images by content hash in 'build_db --incremental'")
+    parser.add_argument("--binary", action="store_true",
+                        help="Write a binary token database in 'build_db'")
 
     args = parser.parse_args()
 
@@ -64,12 +80,24 @@ def main():
 
     # if build database
     elif args.task == 'build_db':
-        print(f'Building text database. Writing to {DATABASE_FILENAME}...')
+        db_filename = DATABASE_FILENAME
+        if args.binary:
+            db_filename = os.path.splitext(DATABASE_FILENAME)[0] + BINARY_DB_EXTENSION
+        print(f'Building text database. Writing to {db_filename}...')
         logic_start = time.time()
-        num_images = build_db(LABEL_DIR, DATABASE_FILENAME)
+        if args.incremental:
+            stats = build_db_incremental(LABEL_DIR, db_filename, num_workers=args.workers,
+                                         use_hash=args.hash, binary=args.binary)
+            num_images = stats["added"] + stats["reprocessed"]
+            print(f'Skipped {stats["skipped"]} unchanged images, resumed {stats["resumed"]}, '
+                  f'added {stats["added"]}, re-processed {stats["reprocessed"]}, '
+                  f'removed {stats["removed"]}. {stats["errors"]} errors.')
+        else:
+            num_images = build_db(LABEL_DIR, db_filename, num_workers=args.workers, binary=args.binary)
         logic_end = time.time()
         print('Finished building text database. Average runtime per image out of ' 
-              f'{num_images} images: {(logic_end - logic_start) / num_images:.5f}')
+              f'{num_images} images: {(logic_end - logic_start) / max(num_images, 1):.5f}')
+        print(f'Per-image errors were written to {error_report_filename(db_filename)}')
     
     # if query
     elif args.task == 'query':
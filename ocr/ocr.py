@@ -1,5 +1,12 @@
+import importlib.util
+import os
+import queue
+import threading
+from contextlib import contextmanager
 import pytesseract
 import cv2
+import numpy as np
+from PIL import Image
 from typing import Any
 from ocr_cleaning import extract_phrases_from_text
 
@@ -32,6 +39,71 @@ OCR Engine modes (OEM):
 
 MYCONFIG = r"--psm 6 --oem 3"
 
+# OCR backend: "tesserocr" keeps a small pool of initialized Tesseract APIs
+# shared by all threads and passes images in memory; "pytesseract" starts a
+# tesseract process (and reloads the language model) for every image.
+# tesserocr is only imported on first use, so build_db's pool workers can
+# still set OMP_THREAD_LIMIT before libtesseract is loaded.
+# tesserocr is the default whenever it is installed: on 500 labels from
+# clustering/datasets/data (testing/benchmark_ocr.py, Tesseract 5.5, one
+# thread) it took 17.1 ms/image against 91.1 ms/image for pytesseract, with
+# identical text for every image.
+OCR_BACKEND = "tesserocr" if importlib.util.find_spec("tesserocr") else "pytesseract"
+
+# At most this many tesserocr APIs are created per process; a thread that
+# needs one while all are busy waits for one to be returned. This bounds
+# memory and start-up cost under a threaded server, where every request
+# runs on a new thread.
+TESSERACT_POOL_SIZE = min(4, os.cpu_count() or 1)
+
+_api_pool = queue.LifoQueue()
+_api_count = 0
+_api_lock = threading.Lock()
+
+
+@contextmanager
+def tesseract_api():
+    """
+    Borrow a tesserocr API instance (PSM 6, OEM 3, as in MYCONFIG) from the
+    shared pool, creating it if fewer than TESSERACT_POOL_SIZE exist.
+    """
+    global _api_count
+    try:
+        api = _api_pool.get_nowait()
+    except queue.Empty:
+        with _api_lock:
+            create = _api_count < TESSERACT_POOL_SIZE
+            if create:
+                _api_count += 1
+        if create:
+            try:
+                import tesserocr
+                api = tesserocr.PyTessBaseAPI(psm=tesserocr.PSM.SINGLE_BLOCK, oem=tesserocr.OEM.DEFAULT)
+            except BaseException:
+                with _api_lock:
+                    _api_count -= 1
+                raise
+        else:
+            api = _api_pool.get()
+    try:
+        yield api
+    finally:
+        api.Clear()
+        _api_pool.put(api)
+
+
+def image_to_string(image: np.ndarray, backend: str | None = None) -> str:
+    """
+    Run Tesseract on a (grayscale) image array with MYCONFIG and return the
+    raw text. backend overrides OCR_BACKEND.
+    """
+    if (backend or OCR_BACKEND) == "pytesseract":
+        return pytesseract.image_to_string(image, config=MYCONFIG)
+    with tesseract_api() as api:
+        api.SetImage(Image.fromarray(image))
+        return api.GetUTF8Text()
+
+
 def read_image_and_preprocess(file_path):
     """
     Read and preprocess image.
@@ -44,17 +116,36 @@ def read_image_and_preprocess(file_path):
     return gray_image
 
 
-def run_clean_ocr(file_path: str, print_text: bool = False) -> Any:
+def ocr_text(file_path: str) -> str:
     """
-    Run tesseract OCR on the input image and return a list of cleaned text phrases
+    Run tesseract OCR on the input image and return the raw text. Raises
+    OSError if the image can't be loaded.
     """
     image = read_image_and_preprocess(file_path)
     if image is None:
+        raise OSError(f"Could not load image at {file_path!r}")
+    return image_to_string(image)
+
+
+def ocr_image(file_path: str) -> tuple[str, list[str]]:
+    """
+    Run tesseract OCR on the input image and return the raw text together
+    with the cleaned text phrases. Raises OSError if the image can't be loaded.
+    """
+    raw = ocr_text(file_path)
+    return raw, extract_phrases_from_text(raw)
+
+
+def run_clean_ocr(file_path: str, print_text: bool = False) -> Any:
+    """
+    Run tesseract OCR on the input image and return a list of cleaned text phrases
+    """
+    try:
+        raw, cleaned_phrases = ocr_image(file_path)
+    except OSError:
         print(f"ERROR: Could not load image at {file_path!r}")
         return None
-    raw = pytesseract.image_to_string(image, config=MYCONFIG)
-    cleaned_phrases = extract_phrases_from_text(raw)
     if print_text:
         print("Raw text detected by OCR:\n", raw)
         print("Cleaned extracted text:\n", cleaned_phrases)
-    return cleaned_phrases
\ No newline at end of file
+    return cleaned_phrases
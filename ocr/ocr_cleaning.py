@@ -1,4 +1,6 @@
 import re
+from collections.abc import Iterable
+from functools import lru_cache
 # import nltk
 # nltk.download('stopwords')
 from nltk.corpus import stopwords
@@ -14,6 +16,15 @@ NOTE: Install language models:
 # Load spaCy’s small English model
 nlp = spacy.load("en_core_web_sm", disable=["parser","tagger","lemmatizer","attribute_ruler"])
 
+# Bump whenever the cleaning rules change, so incremental OCR builds redo
+# every image instead of carrying forward entries cleaned the old way
+CLEANING_VERSION = "1"
+
+# Number of distinct (token text, min_length) keep decisions to memoize
+TOKEN_CACHE_SIZE = 100_000
+# Lines per spaCy batch in extract_phrases_from_texts
+PIPE_BATCH_SIZE = 256
+
 # Pre-compile regex patterns
 _REPLACE_SANDWICHED_NON_ALNUMS, _CLEAN_NON_ALNUMS, \
     _CLEAN_WORDS_WITH_DIGITS, _CLEAN_5_DIGIT_NUMS = (
@@ -50,6 +61,31 @@ def is_common_english(token: str, threshold: float = 3) -> bool:
     return zipf_frequency(token.lower(), "en") >= threshold
 
 
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def _keep_text(text: str, min_length: int) -> bool | None:
+    """
+    The part of should_keep that only depends on the token's text, memoized
+    since the same words recur across thousands of labels. Returns None when
+    the answer depends on whether the token is a named entity.
+    """
+    if text.isnumeric() and len(text) >= 2:
+        return True
+
+    if len(text) < min_length:
+        return False
+
+    # Explicit list of names
+    if text.lower() in KNOWN_NAMES:
+        return True
+
+    # Not a stopword and common in English
+    if text not in STOP_WORDS and is_common_english(text):
+        return True
+
+    # Otherwise only named entities are kept
+    return None
+
+
 def should_keep(token: spacy.tokens.Token, min_length: int) -> bool:
     """
     Check if a token is "important" and should be kept. Criteria:
@@ -70,20 +106,10 @@ def should_keep(token: spacy.tokens.Token, min_length: int) -> bool:
     bool
         True if the token passes any of the above criteria. False otherwise.
     """
-    text = token.text.strip()
-    
-    if text.isnumeric() and len(text) >= 2:
-        return True
-    
-    if len(text) < min_length:
-        return False
-
-    # Named-entity or explicit list of names
-    if token.ent_type_ or text.lower() in KNOWN_NAMES:
-        return True
-
-    # Otherwise: not a stopword and common in English
-    return text not in STOP_WORDS and is_common_english(text)
+    keep = _keep_text(token.text.strip(), min_length)
+    if keep is None:
+        return bool(token.ent_type_)
+    return keep
 
 
 def normalize_doc(doc: spacy.tokens.Doc, min_length: int = 4) -> str:
@@ -102,15 +128,9 @@ def normalize_doc(doc: spacy.tokens.Doc, min_length: int = 4) -> str:
     return " ".join(kept)
 
 
-def extract_phrases_from_text(
-    text: str,
-    exclude_phrases: set[str] = {"copyright", "reserved"},
-) -> list[str]:
+def clean_lines(text: str) -> list[str]:
     """
-    1) Check for named entities (original case)
-    2) If not a name, reject gibberish
-    3) Normalize and lowercase
-    4) Exclude duplicates & unwanted
+    Split raw OCR text into lines and apply the regex cleaning to each one.
     """
     raw_phrases = []
     for line in text.splitlines():
@@ -123,10 +143,14 @@ def extract_phrases_from_text(
         phrase = _CLEAN_WORDS_WITH_DIGITS.sub("", phrase)
         phrase = _CLEAN_5_DIGIT_NUMS.sub("", phrase)
         raw_phrases.append(phrase)
+    return raw_phrases
 
+
+def _collect_phrases(docs, exclude_phrases: set[str]) -> list[str]:
+    """Normalize and lowercase each doc, dropping duplicates & unwanted"""
     cleaned_norms = []
     seen = set()
-    for doc in nlp.pipe(raw_phrases):
+    for doc in docs:
         norm = normalize_doc(doc).lower()
         if not norm or norm in seen:
             continue
@@ -136,3 +160,60 @@ def extract_phrases_from_text(
         cleaned_norms.append(norm)
 
     return cleaned_norms
+
+
+def extract_phrases_from_text(
+    text: str,
+    exclude_phrases: set[str] = {"copyright", "reserved"},
+) -> list[str]:
+    """
+    1) Check for named entities (original case)
+    2) If not a name, reject gibberish
+    3) Normalize and lowercase
+    4) Exclude duplicates & unwanted
+    """
+    return _collect_phrases(nlp.pipe(clean_lines(text)), exclude_phrases)
+
+
+def extract_phrases_from_texts(
+    texts: Iterable[str],
+    exclude_phrases: set[str] = {"copyright", "reserved"},
+    batch_size: int = PIPE_BATCH_SIZE,
+    n_process: int = 1,
+) -> list[list[str]]:
+    """
+    Batch version of extract_phrases_from_text for many images at once.
+
+    The lines of every text go through a single nlp.pipe call, so spaCy can
+    batch across images instead of starting a new pipe per label.
+
+    Parameters
+    ----------
+    texts : Iterable[str]
+        Raw OCR text of each image
+    exclude_phrases : set[str]
+        Phrases containing any of these are dropped
+    batch_size : int
+        Number of lines spaCy processes per batch
+    n_process : int
+        Number of spaCy worker processes; only worth raising for large batches
+
+    Returns
+    -------
+    list[list[str]]
+        Cleaned phrases of each text, identical to calling
+        extract_phrases_from_text on it
+    """
+    texts = list(texts)
+    lines = []
+    owners = []
+    for i, text in enumerate(texts):
+        for phrase in clean_lines(text):
+            lines.append(phrase)
+            owners.append(i)
+
+    docs_per_text = [[] for _ in texts]
+    for owner, doc in zip(owners, nlp.pipe(lines, batch_size=batch_size, n_process=n_process)):
+        docs_per_text[owner].append(doc)
+
+    return [_collect_phrases(docs, exclude_phrases) for docs in docs_per_text]
@@ -0,0 +1,261 @@
+from array import array
+from collections import Counter
+import numpy as np
+from rapidfuzz import fuzz
+
+"""
+N-GRAM INVERTED INDEX OVER OCR PHRASES
+
+All phrases of the label database are flattened into one list (in database
+order), and each phrase gets an id. For every n-gram size the index maps a key
+(gram, k) to the ids of the phrases that contain that gram at least k times.
+Counting how many of a query's keys hit a phrase therefore gives the size of
+the multiset intersection of their grams.
+
+Two candidate filters are built on top of that count, both exact:
+    - Substring: a phrase containing the query contains every query trigram
+      at least as often as the query does, so it must hit all query keys.
+    - Fuzzy: fuzz.ratio is 200 * LCS / (len(a) + len(b)), and the LCS is at
+      most the number of characters the two strings share. Phrases whose
+      shared character count cannot reach the threshold are skipped.
+      (Shared trigram counts have no usable lower bound at ratio 70, so the
+      fuzzy filter uses the unigram postings.)
+
+Postings are stored as sorted arrays (see Postings) rather than a dict, so
+the binary token database (token_db) can persist them and a server can
+memory-map them instead of rebuilding the index at startup.
+"""
+
+NGRAM_SIZE = 3
+
+
+def index_dtype(max_value: int) -> np.dtype:
+    """
+    Smallest little-endian unsigned integer type that holds max_value, so
+    ids, offsets and lengths of a small database take 2 or 4 bytes each.
+    """
+    for dtype in ("<u2", "<u4"):
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype("<u8")
+
+
+def _gram_keys(text: str, n: int) -> list[tuple[str, int]]:
+    """
+    Return the (gram, occurrence) keys of all n-grams in text, e.g. the
+    second "ab" in "abab" gives the key ("ab", 2).
+    """
+    counts = Counter(text[i:i + n] for i in range(len(text) - n + 1))
+    return [(gram, k) for gram, count in counts.items() for k in range(1, count + 1)]
+
+
+class Postings:
+    """
+    Phrase ids for every (gram, k) key, in CSR form: grams are sorted UTF-8
+    byte strings, the keys of gram g are rows gram_rows[g] .. gram_rows[g+1]-1
+    (k = 1, 2, ...), and row r's phrase ids are ids[offsets[r]:offsets[r+1]].
+    The arrays can be memory-mapped.
+    """
+
+    def __init__(self, grams: np.ndarray, gram_rows: np.ndarray, offsets: np.ndarray, ids: np.ndarray):
+        self.grams = grams
+        self.gram_rows = gram_rows
+        self.offsets = offsets
+        self.ids = ids
+
+    def arrays(self) -> dict[str, np.ndarray]:
+        return {"grams": self.grams, "gram_rows": self.gram_rows, "offsets": self.offsets, "ids": self.ids}
+
+    def lookup(self, keys: list[tuple[str, int]]) -> list[np.ndarray]:
+        """
+        Return the phrase ids of every key that has postings.
+        """
+        if not keys or len(self.grams) == 0:
+            return []
+        encoded = [gram.encode("utf-8") for gram, _ in keys]
+        positions = np.searchsorted(self.grams, np.array(encoded, dtype=self.grams.dtype)).tolist()
+        hits = []
+        for gram, (_, k), g in zip(encoded, keys, positions):
+            if g >= len(self.grams) or self.grams[g] != gram:
+                continue
+            row = int(self.gram_rows[g]) + k - 1
+            if row < self.gram_rows[g + 1]:
+                hits.append(self.ids[self.offsets[row]:self.offsets[row + 1]])
+        return hits
+
+
+class PostingsBuilder:
+    """
+    Collects the n-gram keys of phrases added in id order and builds Postings.
+    """
+
+    def __init__(self, n: int):
+        self.n = n
+        self._ids = {}  # K-V pair: ((gram, k), array of phrase ids)
+
+    def add(self, phrase_id: int, phrase: str) -> None:
+        for key in _gram_keys(phrase, self.n):
+            ids = self._ids.get(key)
+            if ids is None:
+                ids = self._ids[key] = array("i")
+            ids.append(phrase_id)
+
+    def build(self) -> Postings:
+        keys = sorted(self._ids, key=lambda key: (key[0].encode("utf-8"), key[1]))
+        grams, gram_rows = [], []
+        for row, (gram, k) in enumerate(keys):
+            if k == 1:
+                grams.append(gram.encode("utf-8"))
+                gram_rows.append(row)
+        gram_rows.append(len(keys))
+        counts = [len(self._ids[key]) for key in keys]
+        offsets = np.zeros(len(keys) + 1, dtype=index_dtype(sum(counts)))
+        np.cumsum(counts, out=offsets[1:])
+        ids = np.frombuffer(b"".join(self._ids[key].tobytes() for key in keys), dtype=np.int32)
+        ids = ids.astype(index_dtype(int(ids.max(initial=0))))
+        width = max((len(gram) for gram in grams), default=1)
+        return Postings(np.array(grams, dtype=f"S{width}"), np.array(gram_rows, dtype=index_dtype(len(keys))),
+                        offsets, ids)
+
+
+class PhraseIndex:
+    """
+    Inverted index from character n-grams to OCR phrases, used to prefilter
+    the phrases that fuzzy matching has to score.
+
+    An index over a binary token database that stores the index (see
+    token_db) is memory-mapped from the file instead of being built; its
+    paths and phrases are then decoded from the file on access.
+
+    Attributes
+    ----------
+    paths : Sequence[str]
+        Image paths, in database order
+    phrases : Sequence[str]
+        All phrases of all images, flattened in database order
+    owners : np.ndarray
+        For each phrase, the index of its image in paths
+    lengths : np.ndarray
+        For each phrase, its length in characters
+    """
+
+    def __init__(self, label_db: dict[str, list[str]], n: int = NGRAM_SIZE):
+        self.n = n
+        self._all_phrases = None
+        stored = label_db.stored_index(n) if hasattr(label_db, "stored_index") else None
+        if stored is not None:
+            self.paths = label_db.path_list()
+            self.phrases = label_db.phrase_list()
+            self.owners, self.lengths, self._postings = stored
+            return
+
+        self.paths = list(label_db.keys())
+        self.phrases = []
+        owners = []
+        for image_idx, phrases in enumerate(label_db.values()):
+            self.phrases.extend(phrases)
+            owners.extend([image_idx] * len(phrases))
+        self.owners = np.array(owners, dtype=np.int32)
+        self.lengths = np.array([len(p) for p in self.phrases], dtype=np.int32)
+
+        builders = {size: PostingsBuilder(size) for size in (1, n)}
+        for phrase_id, phrase in enumerate(self.phrases):
+            for builder in builders.values():
+                builder.add(phrase_id, phrase)
+        self._postings = {size: builder.build() for size, builder in builders.items()}
+
+    def __len__(self) -> int:
+        return len(self.phrases)
+
+    def phrase_list(self, phrase_ids: np.ndarray) -> list[str]:
+        """
+        The phrases with the given ids. Asking for all of them decodes a
+        memory-mapped database once and keeps the list.
+        """
+        if len(phrase_ids) == len(self.phrases):
+            if self._all_phrases is None:
+                self._all_phrases = list(self.phrases)
+            return self._all_phrases
+        return [self.phrases[i] for i in phrase_ids.tolist()]
+
+    def shared_grams(self, query: str, n: int) -> tuple[np.ndarray, int]:
+        """
+        Count, for every phrase, how many of the query's n-grams it shares
+        (as a multiset).
+
+        Returns
+        -------
+        tuple (counts, num_query_grams)
+            counts[i] is the number of shared n-grams for phrase i
+        """
+        keys = _gram_keys(query, n)
+        hits = self._postings[n].lookup(keys)
+        if not hits:
+            return np.zeros(len(self.phrases), dtype=np.int64), len(keys)
+        counts = np.bincount(np.concatenate(hits), minlength=len(self.phrases))
+        return counts, len(keys)
+
+    def substring_candidates(self, query: str) -> np.ndarray:
+        """
+        Return ids of the phrases that may contain query as a substring.
+        """
+        n = self.n if len(query) >= self.n else 1
+        counts, num_keys = self.shared_grams(query, n)
+        return np.flatnonzero(counts == num_keys)
+
+    def fuzzy_candidates(self, query: str, threshold: float) -> np.ndarray:
+        """
+        Return ids of the phrases whose fuzz.ratio with query may reach the
+        threshold. Every phrase outside this set is guaranteed to score below.
+        """
+        shared, _ = self.shared_grams(query, 1)
+        max_ratio = 200 * shared / np.maximum(np.add(self.lengths, len(query), dtype=np.int64), 1)
+        return np.flatnonzero(max_ratio >= threshold - 1e-6)
+
+    def search(
+            self,
+            query: str,
+            threshold=70
+        ) -> tuple[list[str], list[float]]:
+        """
+        Same contract and results as query.search_text_phrase: for each image,
+        the first phrase that contains the query (score 100) or reaches the
+        fuzzy threshold decides its score.
+
+        Parameters
+        ----------
+        query : str
+            The input phrase
+        threshold : float
+            Minimum fuzz.ratio for a fuzzy match
+
+        Returns
+        -------
+        tuple (matched_paths, similarity_scores)
+        """
+        if not query:
+            # The empty string is a substring of everything
+            candidates = np.arange(len(self.phrases))
+        else:
+            candidates = np.union1d(
+                self.substring_candidates(query),
+                self.fuzzy_candidates(query, threshold),
+            )
+
+        # Phrase ids follow database order, so the smallest matching id per
+        # image is the phrase the linear scan would have stopped at
+        best = {}  # K-V pair: (image_idx, (phrase_id, similarity_score))
+        for phrase_id in candidates.tolist():
+            image_idx = int(self.owners[phrase_id])
+            if image_idx in best:
+                continue
+            phrase = self.phrases[phrase_id]
+            if query in phrase:
+                best[image_idx] = (phrase_id, 100)
+                continue
+            similarity_score = fuzz.ratio(query, phrase, score_cutoff=threshold)
+            if similarity_score >= threshold:
+                best[image_idx] = (phrase_id, similarity_score)
+
+        matched = sorted(best.items())
+        return [self.paths[i] for i, _ in matched], [score for _, (_, score) in matched]
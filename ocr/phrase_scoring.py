@@ -0,0 +1,118 @@
+import numpy as np
+from rapidfuzz import fuzz, process
+from phrase_index import PhraseIndex
+
+"""
+BATCHED PHRASE SCORING
+
+Instead of calling a fuzz scorer once per (query, phrase) pair from Python,
+every phrase of the database lives in one flat list with a parallel owner
+array (phrase -> image). The query is scored against the whole list in a
+single rapidfuzz.process.cdist call that runs natively on all cores, and
+the per-image best score is reduced with NumPy.
+"""
+
+SCORERS = {
+    "ratio": fuzz.ratio,
+    "partial_ratio": fuzz.partial_ratio,
+    "token_set_ratio": fuzz.token_set_ratio,
+}
+
+
+class PhraseScorer:
+    """
+    Ranks images of a label database by their best-matching phrase.
+
+    Parameters
+    ----------
+    index : PhraseIndex
+        Index over the label database. Its flattened phrase/owner arrays are
+        shared; its candidate filter is used to skip phrases that can't reach
+        the threshold when the scorer is "ratio".
+    workers : int
+        Number of threads for cdist; -1 uses all cores
+    """
+
+    def __init__(self, index: PhraseIndex, workers: int = -1):
+        self.index = index
+        self.workers = workers
+
+    @classmethod
+    def from_label_db(cls, label_db: dict[str, list[str]], **kwargs) -> "PhraseScorer":
+        return cls(PhraseIndex(label_db), **kwargs)
+
+    def score_images(
+            self,
+            query: str,
+            threshold=70,
+            scorer: str = "ratio"
+        ) -> np.ndarray:
+        """
+        Score the query against every phrase and keep the best score per image.
+        Phrases containing the query score 100.
+
+        Returns
+        -------
+        np.ndarray
+            Best score for each image in index.paths, or -1 if no phrase of
+            that image reached the threshold
+        """
+        if scorer not in SCORERS:
+            raise ValueError(f"Unknown scorer {scorer!r}, expected one of {sorted(SCORERS)}")
+        index = self.index
+        best = np.full(len(index.paths), -1, dtype=np.float64)
+        if len(index) == 0:
+            return best
+
+        # Only the ratio scorer has a safe candidate bound
+        if scorer == "ratio" and query:
+            candidates = np.union1d(
+                index.substring_candidates(query),
+                index.fuzzy_candidates(query, threshold),
+            )
+        else:
+            candidates = np.arange(len(index))
+        if len(candidates) == 0:
+            return best
+        phrases = index.phrase_list(candidates)
+
+        scores = process.cdist(
+            [query], phrases,
+            scorer=SCORERS[scorer],
+            score_cutoff=threshold,
+            dtype=np.float64,
+            workers=self.workers,
+        )[0]
+
+        # Substring fast path, only for phrases that have all of the query's
+        # n-grams (always among the candidates) and didn't already score 100
+        rows = np.searchsorted(candidates, index.substring_candidates(query))
+        rows = rows[scores[rows] < 100]
+        contains = np.fromiter((query in phrases[row] for row in rows.tolist()), dtype=bool, count=len(rows))
+        scores[rows[contains]] = 100
+
+        matched = scores >= threshold
+        np.maximum.at(best, index.owners[candidates[matched]], scores[matched])
+        return best
+
+    def search(
+            self,
+            query: str,
+            threshold=70,
+            scorer: str = "ratio",
+            top_k: int | None = None
+        ) -> tuple[list[str], list[float]]:
+        """
+        Return images whose best phrase reaches the threshold, ranked by
+        score (ties keep database order), optionally cut to the top k.
+
+        Returns
+        -------
+        tuple (matched_paths, similarity_scores)
+        """
+        best = self.score_images(query, threshold, scorer)
+        matched = np.flatnonzero(best >= 0)
+        order = matched[np.lexsort((matched, -best[matched]))]
+        if top_k is not None:
+            order = order[:top_k]
+        return [self.index.paths[i] for i in order.tolist()], best[order].tolist()
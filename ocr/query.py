@@ -1,8 +1,11 @@
-import json
 from rapidfuzz import fuzz
 import os
+from collections.abc import Mapping
 from ocr import run_clean_ocr
 from generate_output import generate_pdf
+from phrase_index import PhraseIndex
+from label_db import get_label_database
+from token_db import load_label_db
 
 DATABASE_FILENAME = "./past_db/db_labels.json"
 OUTPUT_DIR = "./"
@@ -21,8 +24,9 @@ label_db = {
 """
 def search_text_phrase(
         query: str, 
-        label_db: dict[str, list[str]], 
-        threshold=70
+        label_db: Mapping[str, list[str]] | str, 
+        threshold=70,
+        index: PhraseIndex | None = None
     ) -> tuple[list[str], list[float]]:
     """
     Given an input_phrase, search the label database for images that contain that phrase.
@@ -31,13 +35,22 @@ def search_text_phrase(
     ----------
     input_phrase : str
         The input phrase
-    label_db : dict[str, list[str]]
-        The dictionary database that stores pairs of (image_path, list_of_phrases)
+    label_db : Mapping[str, list[str]] | str
+        The dictionary database that stores pairs of (image_path, list_of_phrases),
+        or the filename of a JSON or binary token database to load it from
+    index : PhraseIndex, optional
+        An n-gram index built over label_db. If given, only the phrases it
+        selects as candidates are scored; the results are the same.
         
     Returns
     -------
     tuple (matched_paths, similarity_scores)
     """
+    if index is not None:
+        return index.search(query, threshold)
+    if isinstance(label_db, str):
+        label_db = load_label_db(label_db)
+
     search_output = dict()  # K-V pair: (matched_path, similarity_score)
 
     for image_path, phrases in label_db.items():
@@ -102,13 +115,14 @@ def query_by_label(text_label: str) -> tuple[list[str], list[float]]:
     tuple (matched_paths, similarity_scores)
         A list of matched paths with a corresponding list of similarity scores
     """
-    # Load text database
-    with open(DATABASE_FILENAME, "rb") as f:
-        database = json.load(f)
+    # Load text database (cached across calls)
+    database = get_label_database(DATABASE_FILENAME).snapshot()
 
     # Search database and get a list of paths
     cleaned_label = text_label.strip().lower()
-    matched_paths, similarity_scores = search_text_phrase(cleaned_label, database)
+    matched_paths, similarity_scores = search_text_phrase(
+        cleaned_label, database.label_db, index=database.index
+    )
     
     # Generate PDf
     query = text_label.replace(" ", "_")
@@ -129,9 +143,8 @@ def query_by_image(file_path: str) -> tuple[list[str], list[float]]:
     tuple (matched_paths, similarity_scores)
         A list of matched paths with a corresponding list of similarity scores
     """
-    # Load text database
-    with open(DATABASE_FILENAME, "rb") as f:
-        database = json.load(f)
+    # Load text database (cached across calls)
+    database = get_label_database(DATABASE_FILENAME).snapshot()
 
     # Run OCR on recognized labels and get a list of phrases
     input_phrases = run_clean_ocr(file_path)
@@ -139,7 +152,7 @@ def query_by_image(file_path: str) -> tuple[list[str], list[float]]:
         raise FileNotFoundError(f"Could not load image at {file_path!r}")
 
     # Search database and get a list of paths
-    matched_paths, similarity_scores = search_image_phrase(input_phrases, database)
+    matched_paths, similarity_scores = search_image_phrase(input_phrases, database.label_db)
 
     # Generate PDF
     query, _ = os.path.splitext(os.path.basename(file_path))
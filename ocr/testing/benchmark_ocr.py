@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ocr
+from ocr_cleaning import extract_phrases_from_text
+
+"""
+OCR THROUGHPUT BENCHMARK
+
+Times the pytesseract path (one tesseract process per image) against the
+in-process tesserocr engine on the same preprocessed images, and checks that
+both produce the same cleaned phrases.
+
+Results on the first 500 labels in clustering/datasets/data (Tesseract 5.5,
+fast eng model, OMP_THREAD_LIMIT=1):
+
+    pytesseract : 500 images in 45.57s (11.0 images/sec, 91.1 ms/image)
+    tesserocr   : 500 images in 8.55s (58.5 images/sec, 17.1 ms/image)
+    Identical cleaned phrases for 500/500 images
+
+Usage (from the ocr folder):
+    python testing/benchmark_ocr.py ../image_download/db_labels --limit 200
+"""
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def time_backend(images: list, backend: str) -> tuple[float, list[str]]:
+    """
+    OCR every image with a backend. Returns (seconds, raw texts).
+    """
+    # First call outside the timing: loads the tesserocr engine once, as a
+    # long-running worker would
+    ocr.image_to_string(images[0], backend=backend)
+
+    start = time.perf_counter()
+    texts = [ocr.image_to_string(image, backend=backend) for image in images]
+    return time.perf_counter() - start, texts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image_dir", help="Folder of label images")
+    parser.add_argument("--limit", type=int, default=100, help="Number of images to OCR")
+    args = parser.parse_args()
+
+    file_paths = [os.path.join(args.image_dir, f) for f in sorted(os.listdir(args.image_dir))
+                  if f.lower().endswith(IMAGE_EXTENSIONS)][:args.limit]
+    images = [image for image in map(ocr.read_image_and_preprocess, file_paths) if image is not None]
+    if not images:
+        sys.exit(f"No readable images in {args.image_dir!r}")
+
+    backends = ["pytesseract"]
+    if ocr.OCR_BACKEND == "tesserocr":
+        backends.append("tesserocr")
+    else:
+        print("tesserocr is not installed; only timing pytesseract")
+
+    results = {}
+    for backend in backends:
+        seconds, texts = time_backend(images, backend)
+        results[backend] = texts
+        print(f"{backend:12s}: {len(images)} images in {seconds:.2f}s "
+              f"({len(images) / seconds:.1f} images/sec, {1000 * seconds / len(images):.1f} ms/image)")
+
+    if len(results) == 2:
+        same = sum(extract_phrases_from_text(a) == extract_phrases_from_text(b)
+                   for a, b in zip(results["pytesseract"], results["tesserocr"]))
+        print(f"Identical cleaned phrases for {same}/{len(images)} images")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import argparse
+import json
+import os
+import sys
+import time
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ocr
+from ocr_cleaning import extract_phrases_from_text
+from metrics import evaluate_ocr_accuracy
+
+"""
+PREPROCESSING EVALUATION
+
+OCRs the ground-truth test images under several preprocessing settings and
+reports the time per image and the OCR accuracy (evaluate_ocr_accuracy
+against gt_test_db.json) of each, relative to the original full-resolution
+grayscale path (ocr.read_image_and_preprocess).
+
+The candidate is resolution normalization: rescale each label so that a
+line of text is about target_line_height pixels tall (line height estimated
+from the horizontal projection profile), optionally Otsu-binarized.
+
+Results on the 99 ground-truth images in clustering/datasets/data (label
+crops around 300x150 px), Tesseract 5.5 with the fast eng model,
+OMP_THREAD_LIMIT=1, tesserocr backend. Accuracy was computed on
+line-normalized raw OCR text because the spaCy model used by
+extract_phrases_from_text was not available:
+
+    original              :  21.1 ms/image ( +0.0% time saved), accuracy 54.15
+    normalized (40px)     :  25.8 ms/image (-21.9% time saved), accuracy 45.81
+    normalized+binarized  :  25.4 ms/image (-20.3% time saved), accuracy 43.98
+    normalized (30px)     :  23.1 ms/image ( -9.1% time saved), accuracy 40.73
+    normalized (50px)     :  27.4 ms/image (-29.9% time saved), accuracy 45.29
+
+Normalization is slower and less accurate on these labels, so ocr.py keeps
+the original path. Rerun this on full-size scans before revisiting it.
+
+Usage (from the ocr folder):
+    python testing/evaluate_preprocessing.py /path/to/test_images
+"""
+
+GT_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gt_test_db.json")
+
+MIN_SCALE, MAX_SCALE = 0.2, 3.0
+
+# name -> normalize keyword arguments (None is ocr.read_image_and_preprocess)
+SETTINGS = {
+    "original": None,
+    "normalized": {"target_line_height": 40},
+    "normalized+binarized": {"target_line_height": 40, "binarize": True},
+}
+
+
+def estimate_line_height(gray_image: np.ndarray) -> float | None:
+    """
+    Estimate the height of a line of text from the horizontal projection
+    profile: rows containing ink form runs, one per text line, and the median
+    run length is the line height. Returns None if no text lines are found.
+    """
+    _, ink = cv2.threshold(gray_image, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    profile = ink.sum(axis=1)
+    if profile.max() == 0:
+        return None
+    # A low cutoff keeps ascenders and descenders attached to their line
+    is_text = np.concatenate([[0], profile > 0.02 * profile.max(), [0]]).astype(np.int8)
+    edges = np.flatnonzero(np.diff(is_text))
+    heights = edges[1::2] - edges[::2]
+    # Specks, ruled lines and fragments of a line aren't text lines
+    heights = heights[(heights >= 4) & (heights >= heights.max() / 2)]
+    if len(heights) == 0:
+        return None
+    return float(np.median(heights))
+
+
+def normalize(gray_image: np.ndarray, target_line_height: int, binarize: bool = False) -> np.ndarray:
+    """
+    Rescale so text lines are about target_line_height pixels tall and
+    optionally binarize.
+    """
+    line_height = estimate_line_height(gray_image)
+    scale = 1.0 if line_height is None else target_line_height / line_height
+    scale = min(max(scale, MIN_SCALE), MAX_SCALE)
+    if abs(scale - 1.0) > 0.1:
+        gray_image = cv2.resize(gray_image, None, fx=scale, fy=scale,
+                                interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC)
+    if binarize:
+        _, gray_image = cv2.threshold(gray_image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return gray_image
+
+
+def run_setting(image_dir: str, image_names: list[str], preprocess: dict | None) -> tuple[float, dict[str, list[str]]]:
+    """
+    OCR every image with the given preprocessing. Returns (seconds, results)
+    where results maps image name to cleaned phrases.
+    """
+    results = {}
+    start = time.perf_counter()
+    for name in image_names:
+        image = ocr.read_image_and_preprocess(os.path.join(image_dir, name))
+        if image is not None:
+            if preprocess is not None:
+                image = normalize(image, **preprocess)
+            results[name] = extract_phrases_from_text(ocr.image_to_string(image))
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image_dir", help="Folder containing the ground-truth test images")
+    parser.add_argument("--gt", default=GT_FILENAME, help="Ground-truth database")
+    args = parser.parse_args()
+
+    with open(args.gt, "r", encoding="utf-8") as f:
+        ground_truth = json.load(f)
+    image_names = [name for name in ground_truth if os.path.exists(os.path.join(args.image_dir, name))]
+    if not image_names:
+        sys.exit(f"None of the ground-truth images are in {args.image_dir!r}")
+    ground_truth = {name: ground_truth[name] for name in image_names}
+
+    baseline_seconds = None
+    for setting, preprocess in SETTINGS.items():
+        seconds, results = run_setting(args.image_dir, image_names, preprocess)
+        accuracy = evaluate_ocr_accuracy(results, ground_truth)
+        if baseline_seconds is None:
+            baseline_seconds = seconds
+        print(f"{setting:22s}: {1000 * seconds / len(image_names):7.1f} ms/image "
+              f"({100 * (1 - seconds / baseline_seconds):+5.1f}% time saved), "
+              f"accuracy {accuracy:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from token_db import json_to_binary, load_label_db
+from phrase_index import PhraseIndex
+from phrase_scoring import PhraseScorer
+
+"""
+BINARY TOKEN DATABASE CHECKS
+
+Converts the sample token database to the binary format and checks that it
+round-trips, that search over the stored index matches search over the
+JSON, and that the file stays small relative to the JSON it replaces.
+
+Usage (from the ocr folder):
+    python -m pytest testing/token_db_test.py
+    python testing/token_db_test.py
+"""
+
+JSON_FILENAME = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "token_db_6719.json")
+
+# Largest allowed binary size as a multiple of the JSON size. The stored
+# index is dominated by the unigram postings (one entry per character)
+MAX_SIZE_RATIO = 3.0
+MAX_SIZE_RATIO_NO_INDEX = 1.0
+
+QUERIES = ["", "x", "ab", "flora", "herbarium", "stephen olney", "james bennett"]
+
+
+def _convert(index: bool) -> tuple[str, int]:
+    filename = os.path.join(tempfile.mkdtemp(), "token_db.tokdb")
+    json_to_binary(JSON_FILENAME, filename, index=index)
+    return filename, os.path.getsize(filename)
+
+
+def test_round_trip():
+    with open(JSON_FILENAME, "r", encoding="utf-8") as f:
+        label_db = json.load(f)
+    for index in (True, False):
+        filename, _ = _convert(index)
+        assert list(load_label_db(filename).items()) == list(label_db.items())
+
+
+def test_stored_index_search_matches_json():
+    with open(JSON_FILENAME, "r", encoding="utf-8") as f:
+        json_index = PhraseIndex(json.load(f))
+    filename, _ = _convert(index=True)
+    binary_db = load_label_db(filename)
+    assert binary_db.stored_index(json_index.n) is not None
+    binary_index = PhraseIndex(binary_db)
+    for query in QUERIES:
+        assert binary_index.search(query) == json_index.search(query), query
+        for scorer in ("ratio", "partial_ratio", "token_set_ratio"):
+            assert (PhraseScorer(binary_index).search(query, scorer=scorer)
+                    == PhraseScorer(json_index).search(query, scorer=scorer)), (query, scorer)
+
+
+def test_size():
+    json_size = os.path.getsize(JSON_FILENAME)
+    _, size = _convert(index=True)
+    assert size <= MAX_SIZE_RATIO * json_size, f"{size} B with index, JSON is {json_size} B"
+    _, size = _convert(index=False)
+    assert size <= MAX_SIZE_RATIO_NO_INDEX * json_size, f"{size} B without index, JSON is {json_size} B"
+
+
+if __name__ == "__main__":
+    test_round_trip()
+    test_stored_index_search_matches_json()
+    test_size()
+    print("All token database checks passed")
@@ -0,0 +1,430 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+from array import array
+from collections.abc import ItemsView, Iterator, Mapping, Sequence, ValuesView
+import numpy as np
+from phrase_index import NGRAM_SIZE, Postings, PostingsBuilder, index_dtype
+
+"""
+BINARY TOKEN DATABASE
+
+A compact, memory-mappable alternative to the JSON token database. Opening
+one only maps the file and reads its header and section table, so startup
+doesn't depend on the size of the collection, and worker processes that
+open the same file share its pages through the OS page cache. Offsets, ids
+and lengths use the smallest unsigned type that fits, so without an index
+the file is about the size of the JSON.
+
+By default the file also stores the phrase index (phrase_index.PhraseIndex:
+phrase lengths and n-gram postings), so search can start without building
+it. The unigram postings needed for the fuzzy bound have one entry per
+character, which roughly triples the file; write with index=False to leave
+the index out and build it in memory on load instead.
+
+Layout (little-endian, sections 8-byte aligned, in any order):
+    header          MAGIC, FORMAT_VERSION, num_images, num_phrases, table_offset
+    section table   at table_offset: a count, then (name, dtype, count, offset)
+                    for every section
+    path_offsets    uint[num_images + 1]  : path i is path_blob[off[i]:off[i+1]]
+    phrase_ranges   uint[num_images + 1]  : image i owns phrases [r[i], r[i+1])
+    phrase_offsets  uint[num_phrases + 1] : phrase j is phrase_blob[off[j]:off[j+1]]
+    path_blob       UTF-8 paths, concatenated
+    phrase_blob     UTF-8 phrases, concatenated, in database order
+  index only:
+    lengths         uint[num_phrases]     : length of every phrase in characters
+    <name>_<n>      Postings arrays (grams, gram_rows, offsets, ids) for n = 1
+                    and n = NGRAM_SIZE
+Each uint is the smallest of uint16/32/64 that fits (see index_dtype); the
+section table records the dtype.
+
+BinaryLabelDB implements Mapping[str, list[str]], so it can be used wherever
+the dict loaded from JSON is. load_label_db opens either format. Version 1
+files (no section table, no stored index) can still be read.
+"""
+
+MAGIC = b"DPTOKDB\x00"
+FORMAT_VERSION = 2
+BINARY_DB_EXTENSION = ".tokdb"
+
+_HEADER = struct.Struct("<8sIQQQ")
+_SECTION = struct.Struct("<24s8sQQ")
+_HEADER_V1 = struct.Struct("<8sIQQQQ")
+
+
+def _aligned(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+def _v1_sections(num_images: int, num_phrases: int, path_blob_size: int,
+                 phrase_blob_size: int) -> dict[str, tuple[str, int, int]]:
+    """
+    (dtype, count, offset) of every section of a version 1 file.
+    """
+    path_offsets = _aligned(_HEADER_V1.size)
+    phrase_ranges = path_offsets + 8 * (num_images + 1)
+    phrase_offsets = phrase_ranges + 8 * (num_images + 1)
+    path_blob = phrase_offsets + 8 * (num_phrases + 1)
+    return {
+        "path_offsets": ("<u8", num_images + 1, path_offsets),
+        "phrase_ranges": ("<u8", num_images + 1, phrase_ranges),
+        "phrase_offsets": ("<u8", num_phrases + 1, phrase_offsets),
+        "path_blob": ("|u1", path_blob_size, path_blob),
+        "phrase_blob": ("|u1", phrase_blob_size, path_blob + path_blob_size),
+    }
+
+
+class BinaryDBWriter:
+    """
+    Streams a label database to the binary format one image at a time.
+    Phrases go straight to the file; only the offsets, the paths and (with
+    index) the n-gram postings are kept in memory. The file is written under
+    a temporary name and moved into place by commit().
+
+    Use as a context manager: the database is committed on success and the
+    temporary file removed on error.
+    """
+
+    def __init__(self, filename: str, index: bool = True):
+        self.filename = filename
+        self._tmp_filename = f"{filename}.tmp"
+        self._file = open(self._tmp_filename, "wb")
+        self._file.write(b"\0" * _aligned(_HEADER.size))
+        self._phrase_blob_offset = self._file.tell()
+        self._phrase_blob_size = 0
+        self._path_blob = bytearray()
+        self._path_offsets = array("Q", [0])
+        self._phrase_ranges = array("Q", [0])
+        self._phrase_offsets = array("Q", [0])
+        self._lengths = array("Q")
+        self._postings = {n: PostingsBuilder(n) for n in (1, NGRAM_SIZE)} if index else {}
+
+    def add(self, path: str, phrases: list[str]) -> None:
+        self._path_blob += path.encode("utf-8")
+        self._path_offsets.append(len(self._path_blob))
+        for phrase in phrases:
+            phrase_id = len(self._phrase_offsets) - 1
+            encoded = phrase.encode("utf-8")
+            self._file.write(encoded)
+            self._phrase_blob_size += len(encoded)
+            self._phrase_offsets.append(self._phrase_blob_size)
+            if self._postings:
+                self._lengths.append(len(phrase))
+            for builder in self._postings.values():
+                builder.add(phrase_id, phrase)
+        self._phrase_ranges.append(len(self._phrase_offsets) - 1)
+
+    def commit(self) -> None:
+        sections = {"path_blob": np.frombuffer(bytes(self._path_blob), dtype=np.uint8)}
+        for name in ("path_offsets", "phrase_ranges", "phrase_offsets") + (("lengths",) if self._postings else ()):
+            values = np.frombuffer(getattr(self, f"_{name}"), dtype=np.uint64)
+            sections[name] = values.astype(index_dtype(int(values.max(initial=0))))
+        for n, builder in self._postings.items():
+            for name, data in builder.build().arrays().items():
+                sections[f"{name}_{n}"] = data
+
+        f = self._file
+        table = [("phrase_blob", "|u1", self._phrase_blob_size, self._phrase_blob_offset)]
+        for name, data in sections.items():
+            data = np.ascontiguousarray(data)
+            f.write(b"\0" * (_aligned(f.tell()) - f.tell()))
+            table.append((name, data.dtype.str, len(data), f.tell()))
+            f.write(data.tobytes())
+
+        f.write(b"\0" * (_aligned(f.tell()) - f.tell()))
+        table_offset = f.tell()
+        f.write(struct.pack("<Q", len(table)))
+        for name, dtype, count, offset in table:
+            f.write(_SECTION.pack(name.encode("ascii"), dtype.encode("ascii"), count, offset))
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(self._path_offsets) - 1, len(self._phrase_offsets) - 1,
+                             table_offset))
+        f.close()
+        os.replace(self._tmp_filename, self.filename)
+
+    def abort(self) -> None:
+        self._file.close()
+        if os.path.exists(self._tmp_filename):
+            os.remove(self._tmp_filename)
+
+    def __enter__(self) -> "BinaryDBWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+class JSONDBWriter:
+    """
+    Streams a label database to JSON one image at a time, in the layout
+    build_db has always written (one image per line). Same interface as
+    BinaryDBWriter.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._tmp_filename = f"{filename}.tmp"
+        self._file = open(self._tmp_filename, "w", encoding="utf-8")
+        self._file.write("{\n")
+        self._first_entry = True
+
+    def add(self, path: str, phrases: list[str]) -> None:
+        if not self._first_entry:
+            self._file.write(",\n")
+        self._first_entry = False
+        self._file.write(f"  {json.dumps(path)}: {json.dumps(phrases, ensure_ascii=False)}")
+
+    def commit(self) -> None:
+        self._file.write("\n}\n")
+        self._file.close()
+        os.replace(self._tmp_filename, self.filename)
+
+    def abort(self) -> None:
+        self._file.close()
+        if os.path.exists(self._tmp_filename):
+            os.remove(self._tmp_filename)
+
+    def __enter__(self) -> "JSONDBWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+def write_binary_db(label_db: Mapping[str, list[str]], filename: str, index: bool = True) -> None:
+    """
+    Write a label database to filename in the binary format, with the phrase
+    index unless index is False. The file is written under a temporary name
+    and moved into place.
+    """
+    with BinaryDBWriter(filename, index) as writer:
+        for path, phrases in label_db.items():
+            writer.add(path, phrases)
+
+
+def is_binary_db(filename: str) -> bool:
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class _BinaryValuesView(ValuesView):
+    def __iter__(self):
+        db = self._mapping
+        for i in range(len(db)):
+            yield db.phrases_at(i)
+
+
+class _BinaryItemsView(ItemsView):
+    def __iter__(self):
+        db = self._mapping
+        for i in range(len(db)):
+            yield db.path_at(i), db.phrases_at(i)
+
+
+class _DecodedSequence(Sequence):
+    """
+    Read-only sequence of strings decoded from the mapped file on access.
+    """
+
+    def __init__(self, length: int, decode):
+        self._length = length
+        self._decode = decode
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._decode(j) for j in range(*i.indices(self._length))]
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError(i)
+        return self._decode(i)
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(self._length):
+            yield self._decode(i)
+
+
+class BinaryLabelDB(Mapping):
+    """
+    Read-only, memory-mapped label database: a Mapping from image path to its
+    list of phrases, in the order the database was written.
+
+    Iteration decodes entries straight from the mapped file. Lookup by path
+    builds a path -> index table on first use.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < _HEADER.size:
+            raise ValueError(f"{filename!r} is not a binary token database")
+        magic, version = struct.unpack_from("<8sI", self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{filename!r} is not a binary token database")
+        if version == 1:
+            _, _, num_images, num_phrases, path_blob_size, phrase_blob_size = _HEADER_V1.unpack_from(self._mmap)
+            table = _v1_sections(num_images, num_phrases, path_blob_size, phrase_blob_size)
+        elif version == FORMAT_VERSION:
+            _, _, num_images, num_phrases, table_offset = _HEADER.unpack_from(self._mmap)
+            table = self._read_table(table_offset)
+        else:
+            raise ValueError(f"{filename!r} has unsupported format version {version}")
+
+        for dtype, count, offset in table.values():
+            if offset + np.dtype(dtype).itemsize * count > len(self._mmap):
+                raise ValueError(f"{filename!r} is truncated")
+        self._sections = {name: np.frombuffer(self._mmap, dtype=dtype, count=count, offset=offset)
+                          for name, (dtype, count, offset) in table.items()}
+        self._path_offsets = self._sections["path_offsets"]
+        self._phrase_ranges = self._sections["phrase_ranges"]
+        self._phrase_offsets = self._sections["phrase_offsets"]
+        self._path_blob = table["path_blob"][2]
+        self._phrase_blob = table["phrase_blob"][2]
+        self._path_lookup = None
+
+    def _read_table(self, table_offset: int) -> dict[str, tuple[str, int, int]]:
+        if table_offset + 8 > len(self._mmap):
+            raise ValueError(f"{self.filename!r} is truncated")
+        (count,) = struct.unpack_from("<Q", self._mmap, table_offset)
+        if table_offset + 8 + count * _SECTION.size > len(self._mmap):
+            raise ValueError(f"{self.filename!r} is truncated")
+        table = {}
+        for i in range(count):
+            name, dtype, length, offset = _SECTION.unpack_from(self._mmap, table_offset + 8 + i * _SECTION.size)
+            table[name.rstrip(b"\0").decode("ascii")] = (dtype.rstrip(b"\0").decode("ascii"), length, offset)
+        return table
+
+    def __len__(self) -> int:
+        return len(self._path_offsets) - 1
+
+    @property
+    def num_phrases(self) -> int:
+        return len(self._phrase_offsets) - 1
+
+    def path_at(self, i: int) -> str:
+        start, end = self._path_offsets[i:i + 2].tolist()
+        return self._mmap[self._path_blob + start:self._path_blob + end].decode("utf-8")
+
+    def phrase_at(self, j: int) -> str:
+        start, end = self._phrase_offsets[j:j + 2].tolist()
+        return self._mmap[self._phrase_blob + start:self._phrase_blob + end].decode("utf-8")
+
+    def phrases_at(self, i: int) -> list[str]:
+        first, last = self._phrase_ranges[i:i + 2].tolist()
+        offsets = self._phrase_offsets[first:last + 1].tolist()
+        base = self._phrase_blob
+        return [self._mmap[base + start:base + end].decode("utf-8")
+                for start, end in zip(offsets, offsets[1:])]
+
+    def path_list(self) -> Sequence[str]:
+        """
+        All image paths, decoded on access.
+        """
+        return _DecodedSequence(len(self), self.path_at)
+
+    def phrase_list(self) -> Sequence[str]:
+        """
+        All phrases of all images, flattened in database order, decoded on access.
+        """
+        return _DecodedSequence(self.num_phrases, self.phrase_at)
+
+    def stored_index(self, n: int) -> tuple[np.ndarray, np.ndarray, dict[int, Postings]] | None:
+        """
+        The phrase index stored in the file as (owners, lengths, {size: Postings})
+        for unigrams and n-grams, or None if the file doesn't store postings
+        for n. Everything but owners (expanded from phrase_ranges) is
+        memory-mapped.
+        """
+        sections = self._sections
+        if "lengths" not in sections or any(f"ids_{size}" not in sections for size in (1, n)):
+            return None
+        postings = {size: Postings(*(sections[f"{name}_{size}"] for name in ("grams", "gram_rows", "offsets", "ids")))
+                    for size in (1, n)}
+        owners = np.repeat(np.arange(len(self), dtype=index_dtype(len(self))), np.diff(self._phrase_ranges).astype(np.int64))
+        return owners, sections["lengths"], postings
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self.path_at(i)
+
+    def __getitem__(self, path: str) -> list[str]:
+        if self._path_lookup is None:
+            self._path_lookup = {p: i for i, p in enumerate(self)}
+        return self.phrases_at(self._path_lookup[path])
+
+    def values(self):
+        return _BinaryValuesView(self)
+
+    def items(self):
+        return _BinaryItemsView(self)
+
+    def close(self) -> None:
+        # The NumPy views must go before the map can be closed
+        self._path_offsets = self._phrase_ranges = self._phrase_offsets = self._sections = None
+        self._mmap.close()
+
+
+def load_label_db(filename: str) -> Mapping[str, list[str]]:
+    """
+    Load a label database in either format: a BinaryLabelDB for binary files,
+    otherwise the dict parsed from JSON.
+    """
+    if is_binary_db(filename):
+        return BinaryLabelDB(filename)
+    with open(filename, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def json_to_binary(json_filename: str, binary_filename: str, index: bool = True) -> int:
+    """
+    Convert a JSON label database to the binary format, with the phrase index
+    unless index is False. Returns the number of images.
+    """
+    with open(json_filename, "r", encoding="utf-8") as f:
+        label_db = json.load(f)
+    write_binary_db(label_db, binary_filename, index)
+    return len(label_db)
+
+
+def binary_to_json(binary_filename: str, json_filename: str) -> int:
+    """
+    Convert a binary label database back to JSON, in the layout build_db
+    writes. Returns the number of images.
+    """
+    label_db = BinaryLabelDB(binary_filename)
+    with JSONDBWriter(json_filename) as writer:
+        for path, phrases in label_db.items():
+            writer.add(path, phrases)
+    return len(label_db)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a token database between JSON and binary formats")
+    parser.add_argument("source", help="Database to convert; its format is detected")
+    parser.add_argument("dest", help="File to write the converted database to")
+    parser.add_argument("--no-index", action="store_true",
+                        help="Leave the phrase index out of a binary database (smaller file, index built on load)")
+    args = parser.parse_args()
+
+    if is_binary_db(args.source):
+        num_images = binary_to_json(args.source, args.dest)
+        print(f"Wrote {num_images} images to JSON database {args.dest}")
+    else:
+        num_images = json_to_binary(args.source, args.dest, index=not args.no_index)
+        print(f"Wrote {num_images} images to binary database {args.dest}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+import numpy as np
+from rapidfuzz import fuzz, process
+
+"""
+Hybrid image + OCR text search.
+
+Instead of scoring the whole collection twice, each signal contributes a
+bounded set of cheap candidates:
+    - CLIP: the top clip_candidates images by cosine similarity (through the
+      ANN index when one is loaded)
+    - OCR: the top text_candidates images by best phrase match, found with
+      the phrase index's candidate filter for each query phrase
+The union is then reranked with a weighted fusion of the CLIP cosine and the
+token_set_ratio between the query text and each candidate's full OCR text.
+
+The OCR database keys images by filename while the embedding index keys them
+by full path, so the two are joined on the basename. The join tables and the
+joined OCR text of every image are precomputed once per (embedding version,
+token DB version) pair.
+"""
+
+DEFAULT_IMAGE_DIR = "segmented_images"
+
+
+class HybridFeatures:
+    """Per-image features shared by every hybrid query against one version
+    of the embeddings and the token DB"""
+
+    def __init__(self, engine_snapshot, label_db, image_dir=DEFAULT_IMAGE_DIR):
+        self.engine_snapshot = engine_snapshot
+        self.embeddings, _, self.filepaths = engine_snapshot
+        self.label_db = label_db
+        self.image_dir = image_dir
+        self.rows_by_name = {os.path.basename(path): row for row, path in enumerate(self.filepaths)}
+        self.text_paths = label_db.index.paths
+        self.text_ids_by_name = {os.path.basename(path): i for i, path in enumerate(self.text_paths)}
+        self.joined_texts = [" ".join(phrases) for phrases in label_db.label_db.values()]
+
+    def filepath_for(self, name):
+        """Prefer the embedding index's path; OCR-only images live in image_dir"""
+        row = self.rows_by_name.get(name)
+        return self.filepaths[row] if row is not None else os.path.join(self.image_dir, name)
+
+
+class HybridSearcher:
+    def __init__(self, search_engine, label_database, image_dir=DEFAULT_IMAGE_DIR):
+        self.search_engine = search_engine
+        self.label_database = label_database
+        self.image_dir = image_dir
+        self._features = None
+        self._lock = threading.Lock()
+
+    def features(self):
+        """Return the precomputed features, rebuilding them if the embeddings
+        or the token DB were reloaded. Everything is read from one snapshot
+        of the engine's arrays"""
+        engine_snapshot = self.search_engine.snapshot()
+        label_db = self.label_database.snapshot()
+        with self._lock:
+            features = self._features
+            if (features is None or features.engine_snapshot is not engine_snapshot
+                    or features.label_db.version != label_db.version):
+                features = self._features = HybridFeatures(engine_snapshot, label_db, self.image_dir)
+            return features
+
+    def text_candidates(self, features, query_phrases, limit, threshold):
+        """Indices (into the token DB) of the images whose best phrase match
+        against any query phrase is highest"""
+        scorer = features.label_db.scorer
+        best = np.full(len(features.text_paths), -1, dtype=np.float32)
+        for phrase in query_phrases:
+            np.maximum(best, scorer.score_images(phrase, threshold), out=best)
+        matched = np.flatnonzero(best >= 0)
+        if len(matched) > limit:
+            matched = matched[np.argpartition(-best[matched], limit - 1)[:limit]]
+        return matched
+
+    def search(self, query_embedding, query_phrases, k=100, clip_weight=0.6,
+               clip_candidates=200, text_candidates=200, text_threshold=70,
+               exact=False, nprobe=None):
+        """Return (filepaths, scores, timings) of the top k fused matches, best
+        first. timings has the milliseconds spent in each stage"""
+        timings = {}
+        start = time.perf_counter()
+        features = self.features()
+        timings["features"] = (time.perf_counter() - start) * 1000
+
+        # stage 1: bounded candidate sets from each index
+        start = time.perf_counter()
+        clip_rows, _ = self.search_engine.search_embedding(query_embedding, clip_candidates, exact=exact,
+                                                           nprobe=nprobe, embeddings=features.embeddings)
+        timings["clipCandidates"] = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        query_phrases = [phrase for phrase in query_phrases if phrase]
+        text_ids = self.text_candidates(features, query_phrases, text_candidates, text_threshold)
+        timings["textCandidates"] = (time.perf_counter() - start) * 1000
+
+        # stage 2: merge on filename and rerank the union
+        start = time.perf_counter()
+        names = list(dict.fromkeys(
+            [os.path.basename(features.filepaths[row]) for row in np.asarray(clip_rows).tolist()]
+            + [os.path.basename(features.text_paths[i]) for i in text_ids.tolist()]
+        ))
+
+        clip_scores = np.zeros(len(names), dtype=np.float32)
+        rows = [features.rows_by_name.get(name) for name in names]
+        has_row = np.array([row is not None for row in rows], dtype=bool)
+        if has_row.any():
+            row_ids = np.array([row for row in rows if row is not None], dtype=np.int64)
+            clip_scores[has_row] = features.embeddings[row_ids] @ np.asarray(query_embedding, dtype=np.float32)
+
+        text_scores = np.zeros(len(names), dtype=np.float32)
+        text_rows = [features.text_ids_by_name.get(name) for name in names]
+        has_text = np.array([i is not None for i in text_rows], dtype=bool)
+        query_text = " ".join(query_phrases)
+        if query_text and has_text.any():
+            texts = [features.joined_texts[i] for i in text_rows if i is not None]
+            text_scores[has_text] = process.cdist([query_text], texts, scorer=fuzz.token_set_ratio,
+                                                  dtype=np.float32, workers=-1)[0] / 100
+
+        fused = clip_weight * clip_scores + (1 - clip_weight) * text_scores
+        k = min(k, len(names))
+        order = np.argsort(-fused, kind="stable")[:k]
+        timings["rerank"] = (time.perf_counter() - start) * 1000
+
+        return [features.filepath_for(names[i]) for i in order.tolist()], fused[order].tolist(), timings
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import generate_output
+
+"""
+Background PDF report generation.
+
+Search endpoints register a job and return its ID right away, but nothing
+is rendered until the client first asks for the job's status or download:
+most searches never download a PDF. The PDF is then built on a worker
+thread and served from PDF_DIRECTORY once done. The job ID is a hash of the
+result set (paths and scores), so running the same search again reuses the
+PDF that was already generated.
+
+At most max_pending renders are queued or running; a job requested while
+the queue is full stays pending and is started by a later status request.
+Generated PDFs are deleted pdf_ttl seconds after they were written, and at
+most max_jobs registered jobs are remembered.
+"""
+
+PENDING, QUEUED, RUNNING, DONE, FAILED = "pending", "queued", "running", "done", "failed"
+
+JOB_ID = re.compile(r"^[0-9a-f]{24}$")
+
+
+def result_set_id(matched_img_paths, similarity_scores, image_dir=""):
+    """Stable ID for a list of results"""
+    payload = json.dumps({
+        "paths": list(matched_img_paths),
+        "scores": [round(float(score), 6) for score in similarity_scores],
+        "image_dir": image_dir,
+    })
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:24]
+
+
+class PDFJobQueue:
+    def __init__(self, pdf_dir, max_workers=2, max_pending=8, max_jobs=1024, pdf_ttl=24 * 60 * 60,
+                 cleanup_interval=10 * 60):
+        self.pdf_dir = pdf_dir
+        os.makedirs(pdf_dir, exist_ok=True)
+        self.max_pending = max_pending
+        self.max_jobs = max_jobs
+        self.pdf_ttl = pdf_ttl
+        self.cleanup_interval = cleanup_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pdf")
+        # K-V pair: (job_id, {"status": ..., "error": ..., "request": (paths, scores, image_dir)})
+        self._jobs = OrderedDict()
+        self._in_flight = 0  # queued or running renders
+        self._next_cleanup = 0.0
+        self._lock = threading.Lock()
+
+    def pdf_path(self, job_id):
+        return os.path.join(self.pdf_dir, f"search_results_{job_id}.pdf")
+
+    def submit(self, matched_img_paths, similarity_scores, image_dir=""):
+        """Register a PDF for the results without rendering it; it is started
+        by the first status() call. Returns the job ID"""
+        self._cleanup_if_due()
+        job_id = result_set_id(matched_img_paths, similarity_scores, image_dir)
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job["status"] != FAILED:
+                self._jobs.move_to_end(job_id)
+                return job_id
+            request = (list(matched_img_paths), [float(score) for score in similarity_scores], image_dir)
+            self._jobs[job_id] = {"status": PENDING, "error": None, "request": request}
+            self._evict()
+        return job_id
+
+    def _evict(self):
+        # forget the least recently used jobs that aren't being rendered
+        for job_id in list(self._jobs):
+            if len(self._jobs) <= self.max_jobs:
+                break
+            if self._jobs[job_id]["status"] not in (QUEUED, RUNNING):
+                del self._jobs[job_id]
+
+    def _start(self, job_id):
+        """Queue a pending or failed job's render if there is room. Call with the lock held"""
+        job = self._jobs[job_id]
+        if os.path.exists(self.pdf_path(job_id)):
+            job.update(status=DONE, error=None)
+            return
+        if self._in_flight >= self.max_pending:
+            return
+        self._in_flight += 1
+        job.update(status=QUEUED, error=None)
+        self._executor.submit(self._run, job_id, *job["request"])
+
+    def _run(self, job_id, matched_img_paths, similarity_scores, image_dir):
+        self._set(job_id, RUNNING)
+        pdf_path = self.pdf_path(job_id)
+        tmp_path = f"{pdf_path}.tmp"
+        try:
+            generate_output.generate_pdf(matched_img_paths, similarity_scores, tmp_path, image_dir)
+            os.replace(tmp_path, pdf_path)
+            self._set(job_id, DONE)
+        except Exception as e:
+            print(f"Error generating PDF for job {job_id}: {e}")
+            self._set(job_id, FAILED, str(e))
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _set(self, job_id, status, error=None):
+        with self._lock:
+            job = self._jobs.setdefault(job_id, {"request": None})
+            job.update(status=status, error=error)
+
+    def status(self, job_id):
+        """Return the job's status dict, or None for an unknown job. A job
+        that hasn't been rendered yet is started"""
+        if not JOB_ID.match(job_id):
+            return None
+        self._cleanup_if_due()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job["status"] == PENDING:
+                self._start(job_id)
+            if job is not None:
+                return {"status": job["status"], "error": job["error"], "id": job_id}
+        if os.path.exists(self.pdf_path(job_id)):
+            return {"status": DONE, "error": None, "id": job_id}
+        return None
+
+    def _cleanup_if_due(self):
+        now = time.time()
+        with self._lock:
+            if now < self._next_cleanup:
+                return
+            self._next_cleanup = now + self.cleanup_interval
+        self.cleanup(now)
+
+    def cleanup(self, now=None):
+        """Delete PDFs (and leftover partial files) older than pdf_ttl. Returns
+        the number of files removed"""
+        cutoff = (now or time.time()) - self.pdf_ttl
+        removed = 0
+        for filename in os.listdir(self.pdf_dir):
+            path = os.path.join(self.pdf_dir, filename)
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+                os.remove(path)
+                removed += 1
+            except OSError:
+                continue  # Removed concurrently
+            # a registered job can be rendered again if it is requested later
+            job_id = filename[len("search_results_"):-len(".pdf")]
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is not None and job["status"] == DONE:
+                    if job["request"] is not None:
+                        job.update(status=PENDING, error=None)
+                    else:
+                        del self._jobs[job_id]
+        return removed
@@ -0,0 +1,58 @@
+import threading
+import time
+from collections import OrderedDict
+
+"""
+Bounded LRU + TTL cache for ranked search results.
+
+Each entry remembers the generation of the data it was computed from (e.g.
+the token DB and embedding index versions). A lookup with a different
+generation is a miss, so reloading either one invalidates every entry
+computed from the old data without having to find them.
+"""
+
+
+class QueryCache:
+    def __init__(self, max_entries=512, ttl=30 * 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # K-V pair: (key, (expires_at, generation, value))
+        self._lock = threading.Lock()
+
+    def get(self, key, generation):
+        """Return the cached value for key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, entry_generation, value = entry
+                if expires_at > time.monotonic() and entry_generation == generation:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, generation, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, generation, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+            }
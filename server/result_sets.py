@@ -0,0 +1,78 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+"""
+Server-side ranked result sets for cursor pagination.
+
+A search computes its ranked (filepath, score) list once and stores it under
+an opaque token. Pages are then hydrated (images, metadata) lazily as the
+client asks for them. The store is bounded: sets expire after a TTL and the
+least recently used sets are dropped once max_sets is reached.
+"""
+
+
+class ResultSet:
+    def __init__(self, filepaths, similarity_scores, pdf_job_id=None, details=None):
+        self.filepaths = list(filepaths)
+        self.similarity_scores = [float(score) for score in similarity_scores]
+        self.pdf_job_id = pdf_job_id
+        # optional per-result fields (e.g. a matching box) added to every hydrated result
+        self.details = list(details) if details is not None else None
+
+    def __len__(self):
+        return len(self.filepaths)
+
+    def page(self, cursor, limit):
+        """Return (filepaths, scores, next_cursor) for the page starting at cursor.
+        next_cursor is None on the last page"""
+        end = min(cursor + limit, len(self.filepaths))
+        next_cursor = end if end < len(self.filepaths) else None
+        return self.filepaths[cursor:end], self.similarity_scores[cursor:end], next_cursor
+
+    def page_details(self, cursor, limit):
+        """Per-result fields of the page starting at cursor, or None"""
+        if self.details is None:
+            return None
+        return self.details[cursor:cursor + limit]
+
+
+class ResultSetStore:
+    def __init__(self, max_sets=256, ttl=60 * 60):
+        self.max_sets = max_sets
+        self.ttl = ttl
+        self._sets = OrderedDict()  # K-V pair: (token, (expires_at, ResultSet))
+        self._lock = threading.Lock()
+
+    def add(self, result_set):
+        """Store a result set and return its token"""
+        token = secrets.token_urlsafe(16)
+        with self._lock:
+            self._sets[token] = (time.monotonic() + self.ttl, result_set)
+            while len(self._sets) > self.max_sets:
+                self._sets.popitem(last=False)
+        return token
+
+    def get(self, token):
+        """Return the result set for a token, or None if unknown or expired"""
+        with self._lock:
+            entry = self._sets.get(token)
+            if entry is None:
+                return None
+            expires_at, result_set = entry
+            if expires_at <= time.monotonic():
+                del self._sets[token]
+                return None
+            self._sets.move_to_end(token)
+            return result_set
+
+
+def parse_cursor(cursor):
+    """Cursors are offsets into the ranked list; None or "" is the first page"""
+    if cursor in (None, ""):
+        return 0
+    cursor = int(cursor)
+    if cursor < 0:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return cursor
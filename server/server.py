@@ -2,25 +2,34 @@ import sys
 sys.path.append('../clustering')
 sys.path.append('../ocr')
 import model
-import query as querySearch
+from label_db import get_label_database
+from phrase_scoring import SCORERS
+from bdr_metadata import fetch_catalog_metadata_bulk
+from thumbnails import ThumbnailStore
+from pdf_jobs import PDFJobQueue, DONE
+from result_sets import ResultSet, ResultSetStore, parse_cursor
+from result_cache import QueryCache
+from hybrid_search import HybridSearcher
+from duplicates import DuplicateIndex
+from clusters import ClusterIndex
+from tile_index import TileIndex
+from ocr import ocr_image
+import hashlib
 import json
 import re
 from flask import Flask, request, jsonify, url_for
 from flask_cors import CORS
-from io import BytesIO
+import io
 import base64
 from PIL import Image
-import model  
 import tempfile
+import threading
+import time
 import os
-import requests
-import numpy as np
 import urllib.parse
-from flask import send_file
+from flask import send_file, Response, stream_with_context
 import generate_output
-import uuid
 from flask_cors import cross_origin
-import base64
 
 app = Flask(__name__)
 CORS(app, 
@@ -29,71 +38,302 @@ CORS(app,
      allow_headers=["Content-Type", "Authorization", "Access-Control-Allow-Origin"],
      methods=["GET", "POST", "OPTIONS", "HEAD", "DELETE"])
 
-clustered_dataset = model.load_clustered_model("../clustering/datasets")
-
-generated_pdfs = {}
-
+# build the image search engine once at startup so queries don't reload CLIP.
+# embeddings come from the exported store (clustering/embedding_store.py) when
+# there is one, which avoids loading FiftyOne; otherwise from the dataset
+EMBEDDING_STORE_DIR = "../clustering/embedding_store"
+if os.path.exists(os.path.join(EMBEDDING_STORE_DIR, "store.json")):
+    search_engine = model.ImageSearchEngine.from_store(EMBEDDING_STORE_DIR)
+else:
+    search_engine = model.ImageSearchEngine(model.load_clustered_model("../clustering/datasets"))
+ANN_INDEX_DIR = "../clustering/ann_index"
+if os.path.exists(ANN_INDEX_DIR):
+    search_engine.load_ann_index(ANN_INDEX_DIR)
+# compressed embeddings (clustering/quantization.py). Opt-in: it only pays
+# off when the embeddings are memory-mapped rather than resident (see
+# ImageSearchEngine._use_quantized); otherwise exact search is faster and
+# more accurate
+USE_QUANTIZED_INDEX = False
+QUANTIZED_INDEX_DIR = "../clustering/quantized_index"
+if USE_QUANTIZED_INDEX and os.path.exists(os.path.join(QUANTIZED_INDEX_DIR, "meta.json")):
+    search_engine.load_quantized_index(QUANTIZED_INDEX_DIR)
+search_engine.warm_up()
+
+# token DB is loaded once and hot-reloaded when the file is rebuilt
+TOKEN_DB_FILENAME = "../ocr/token_db_6719.json"
+label_database = get_label_database(TOKEN_DB_FILENAME)
+
+# precomputed thumbnails (see thumbnails.py) served by /api/images/<name>
+thumbnail_store = ThumbnailStore()
+
+# PDF reports are registered with each search but only rendered (in the
+# background, bounded queue) once the client asks for their status; old
+# PDFs are deleted after a day
 PDF_DIRECTORY = "generated_pdfs"
-if not os.path.exists(PDF_DIRECTORY):
-    os.makedirs(PDF_DIRECTORY)
+pdf_jobs = PDFJobQueue(PDF_DIRECTORY)
+
+def pdf_job_response(job_id):
+    """Job info returned with search results"""
+    return {
+        "id": job_id,
+        "statusUrl": f"/api/pdf/{job_id}",
+        "downloadUrl": f"/api/pdf/{job_id}/download",
+    }
+
+# CLIP + OCR candidates reranked together; features are rebuilt when either
+# the embeddings or the token DB are reloaded
+hybrid_searcher = HybridSearcher(search_engine, label_database)
+
+# near-duplicate label groups from the offline job in clustering/duplicates.py
+DUPLICATES_DIR = "../clustering/duplicates"
+# labels are looked up by their path under this folder
+LABEL_IMAGE_DIR = "segmented_images"
+duplicate_index = DuplicateIndex(DUPLICATES_DIR) if os.path.exists(DUPLICATES_DIR) else None
+
+# collection-wide clusters from the offline job in clustering/clusters.py
+CLUSTER_DIR = "../clustering/clusters"
+cluster_index = ClusterIndex.load(CLUSTER_DIR) if os.path.exists(os.path.join(CLUSTER_DIR, "meta.json")) else None
+_engine_clusters = (None, None)
+_engine_clusters_lock = threading.Lock()
+
+def engine_clusters():
+    """Search engine rows grouped by cluster, closest to the centroid first,
+    as (members, starts, scores, filepaths); see ClusterIndex.group. Computed
+    once per engine snapshot, under a lock so concurrent requests after a
+    reload don't each regroup it"""
+    global _engine_clusters
+    engine_snapshot = search_engine.snapshot()
+    with _engine_clusters_lock:
+        cached_snapshot, clusters = _engine_clusters
+        if cached_snapshot is not engine_snapshot:
+            embeddings, sample_ids, filepaths = engine_snapshot
+            members, starts, scores = cluster_index.group(embeddings, cluster_index.labels_for(sample_ids))
+            clusters = (members, starts, scores, filepaths)
+            _engine_clusters = (engine_snapshot, clusters)
+        return clusters
+
+# tiled label embeddings from clustering/tile_index.py, for matching a crop
+# (e.g. a signature) against parts of labels
+TILE_INDEX_DIR = "../clustering/tile_index"
+tile_index = TileIndex.load(TILE_INDEX_DIR) if os.path.exists(os.path.join(TILE_INDEX_DIR, "meta.json")) else None
+if tile_index is not None and tile_index.meta["model"] != search_engine.model_name:
+    print(f"Tile index at {TILE_INDEX_DIR} was built with {tile_index.meta['model']}, region search disabled")
+    tile_index = None
+
+# ranked result lists kept server-side for cursor pagination and streaming
+result_sets = ResultSetStore()
+
+# ranked results of repeated queries; entries are tied to the token DB and
+# embedding index versions, so a reload of either invalidates them
+query_cache = QueryCache()
+
+def extract_bdr_code(filepath):
+    """Extract the BDR code from a label filename like 412661_19.jpg"""
+    code_match = re.search(r"(\d+)", os.path.basename(filepath))
+    return code_match.group(1) if code_match else "000000"
+
+def encode_image_base64(filepath):
+    """Re-encode a full-size image as base64 JPEG for inline responses"""
+    with Image.open(filepath) as img:
+        buffered = io.BytesIO()
+        img.convert("RGB").save(buffered, format = "JPEG")
+        return base64.b64encode(buffered.getvalue()).decode()
+
+def hydrate_results(filepaths, similarity_scores, inline_images=False, details=None):
+    """Build the JSON result entries for ranked (filepath, score) pairs.
+    Metadata for all results is fetched in one concurrent bulk call.
+    Images are returned as thumbnail URLs; inline_images (or a missing
+    thumbnail) falls back to the full image inlined as base64. details are
+    extra per-result fields merged into each entry."""
+    all_metadata = fetch_catalog_metadata_bulk([extract_bdr_code(path) for path in filepaths])
+    details = details or [{}] * len(filepaths)
+
+    results = []
+    for filepath, score, metadata, detail in zip(filepaths, similarity_scores, all_metadata, details):
+        try:
+            if not os.path.exists(filepath):
+                print(f"File not found: {filepath}")
+                continue
+
+            result = {}
+            thumbnail_urls = thumbnail_store.urls_for(filepath)
+            if thumbnail_urls:
+                result["thumbnailUrl"] = thumbnail_urls["small"]
+                result["imageUrl"] = thumbnail_urls["large"]
+            if inline_images or not thumbnail_urls:
+                result["image"] = encode_image_base64(filepath)
 
-BDR_API_BASE = "https://repository.library.brown.edu/api/search/"
+            filename = os.path.basename(filepath)
+            bdr_code = extract_bdr_code(filepath)
+            website_url = f"https://repository.library.brown.edu/studio/item/bdr:{bdr_code}/"
 
-def fetch_catalog_metadata(bdr_code):
-    """Fetch catalog metadata using the direct BDR API endpoint for the item"""
-    metadata = {"dwc_catalog_number_ssi": f"PBRU {bdr_code}"}
-    
-    try:
-        # API endpoint for the item
-        api_url = f"https://repository.library.brown.edu/api/items/bdr:{bdr_code}/"
-        response = requests.get(api_url)
-        
-        if response.status_code == 200:
-            data = response.json()
-            
-            if "dwc_catalog_number_ssi" in data:
-                metadata["dwc_catalog_number_ssi"] = data["dwc_catalog_number_ssi"]
-            
-            # scientific name
-            if "dwc_accepted_name_usage_ssi" in data:
-                metadata["dwc_accepted_name_usage_ssi"] = data["dwc_accepted_name_usage_ssi"]
-            elif "dwc_scientific_name_ssi" in data:
-                scientific_name = data["dwc_scientific_name_ssi"]
-                if "dwc_scientific_name_authorship_ssi" in data:
-                    scientific_name += " " + data["dwc_scientific_name_authorship_ssi"]
-                metadata["dwc_accepted_name_usage_ssi"] = scientific_name
-            
-            # get year
-            if "dwc_year_ssi" in data:
-                metadata["dwc_year_ssi"] = data["dwc_year_ssi"]
-            
-            # get collector info
-            if "dwc_recorded_by_ssi" in data:
-                metadata["dwc_recorded_by_ssi"] = data["dwc_recorded_by_ssi"]
-            
-            if data.get("iiif_resource_bsi", False):
-                metadata["iiif_url"] = f"https://repository.library.brown.edu/iiif/image/bdr:{bdr_code}/info.json"
-    
-    except Exception as e:
-        print(f"Error fetching metadata for BDR:{bdr_code} from API: {e}")
+            if not metadata.get("dwc_accepted_name_usage_ssi"):
+                name_parts = filename.split("_")
+                if len(name_parts) >= 2:
+                    metadata["dwc_accepted_name_usage_ssi"] = " ".join(name_parts[1:]).replace(".jpg", "").title()
+                else:
+                    metadata["dwc_accepted_name_usage_ssi"] = filename.replace(".jpg", "").title()
 
-    if "dwc_accepted_name_usage_ssi" not in metadata:
-        metadata["dwc_accepted_name_usage_ssi"] = f"Specimen {bdr_code}"
-        
-    return metadata
+            result.update({
+                "similarity": float(score),
+                "filepath": filepath,
+                "websiteUrl": website_url,
+                "metadata": metadata,
+            })
+            result.update(detail)
+            results.append(result)
 
-def generate_and_save_pdf(matched_img_paths, similarity_scores, search_type, image_dir=""):
-    """Generate PDF and return the filename and URL"""
-    pdf_filename = f"search_results_{uuid.uuid4()}.pdf"
-    pdf_path = os.path.join(PDF_DIRECTORY, pdf_filename)
-    
-    generate_output.generate_pdf(matched_img_paths, similarity_scores, pdf_path, image_dir)
+        except Exception as img_err:
+            print(f"Error processing {filepath}: {img_err}")
 
-    with open(pdf_path, "rb") as pdf_file:
-        encoded_pdf = base64.b64encode(pdf_file.read()).decode('utf-8')
-    
-    return pdf_path, encoded_pdf
+    return results
     
+def ranked_response(filepaths, similarity_scores, pdf_job_id, page_size=None, inline_images=False, details=None):
+    """Store the ranked results under a result-set token and hydrate the first
+    page (all results if page_size is None)"""
+    result_set = ResultSet(filepaths, similarity_scores, pdf_job_id, details)
+    token = result_sets.add(result_set)
+    limit = page_size or len(result_set)
+    page_paths, page_scores, next_cursor = result_set.page(0, limit)
+    return {
+        "resultSet": token,
+        "total": len(result_set),
+        "results": hydrate_results(page_paths, page_scores, inline_images, result_set.page_details(0, limit)),
+        "nextCursor": next_cursor,
+        "pdfJob": pdf_job_response(pdf_job_id) if pdf_job_id else None,
+    }
+
+@app.route("/api/results/<token>", methods=["GET"])
+def results_page(token):
+    """One page of a stored result set: ?cursor=<from nextCursor>&limit=<n>"""
+    result_set = result_sets.get(token)
+    if result_set is None:
+        return jsonify({'error': 'Unknown or expired result set'}), 404
+    try:
+        cursor = parse_cursor(request.args.get("cursor"))
+        limit = max(1, min(int(request.args.get("limit", 20)), 500))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    inline_images = request.args.get("inline_images", "false").lower() == "true"
+
+    page_paths, page_scores, next_cursor = result_set.page(cursor, limit)
+    return jsonify({
+        "resultSet": token,
+        "total": len(result_set),
+        "results": hydrate_results(page_paths, page_scores, inline_images, result_set.page_details(cursor, limit)),
+        "nextCursor": next_cursor,
+    })
+
+@app.route("/api/results/<token>/stream", methods=["GET"])
+def results_stream(token):
+    """Stream a stored result set as NDJSON, hydrating batch_size results at a
+    time so the first results can render while later ones are prepared"""
+    result_set = result_sets.get(token)
+    if result_set is None:
+        return jsonify({'error': 'Unknown or expired result set'}), 404
+    try:
+        cursor = parse_cursor(request.args.get("cursor"))
+        batch_size = max(1, min(int(request.args.get("batch_size", 10)), 100))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    inline_images = request.args.get("inline_images", "false").lower() == "true"
+
+    def generate():
+        yield json.dumps({"type": "meta", "resultSet": token, "total": len(result_set)}) + "\n"
+        next_cursor = cursor
+        while next_cursor is not None:
+            page_details = result_set.page_details(next_cursor, batch_size)
+            page_paths, page_scores, next_cursor = result_set.page(next_cursor, batch_size)
+            for result in hydrate_results(page_paths, page_scores, inline_images, page_details):
+                yield json.dumps({"type": "result", "result": result}) + "\n"
+        yield json.dumps({"type": "end"}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+@app.route("/api/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify(query_cache.stats())
+
+@app.route("/api/duplicates/<path:name>", methods=["GET"])
+def duplicates(name):
+    """The near-duplicate group of a label, by its path under LABEL_IMAGE_DIR (e.g. 412661_19.jpg)"""
+    if duplicate_index is None:
+        return jsonify({'error': 'Duplicate groups have not been computed'}), 404
+    group = duplicate_index.group_for(os.path.join(LABEL_IMAGE_DIR, name))
+    if group is None:
+        return jsonify({'error': 'Label has no near-duplicates'}), 404
+    members = []
+    for member in group["members"]:
+        thumbnail_urls = thumbnail_store.urls_for(member["filepath"])
+        members.append(dict(member, thumbnailUrl=thumbnail_urls["small"] if thumbnail_urls else None))
+    return jsonify({"group": group["id"], "maxDistance": duplicate_index.max_distance, "members": members})
+
+@app.route("/api/clusters", methods=["GET"])
+def list_clusters():
+    """All clusters with their size and the label closest to each centroid"""
+    if cluster_index is None:
+        return jsonify({'error': 'Clusters have not been computed'}), 404
+    members, starts, _, filepaths = engine_clusters()
+
+    clusters = []
+    for cluster_id, (start, end) in enumerate(zip(starts[:-1].tolist(), starts[1:].tolist())):
+        representative = None
+        if end > start:
+            filepath = filepaths[members[start]]
+            thumbnail_urls = thumbnail_store.urls_for(filepath)
+            representative = {
+                "filepath": filepath,
+                "thumbnailUrl": thumbnail_urls["small"] if thumbnail_urls else None,
+            }
+        clusters.append({"id": cluster_id, "size": end - start, "representative": representative})
+    return jsonify({"clusters": clusters})
+
+@app.route("/api/clusters/<int:cluster_id>", methods=["GET"])
+def browse_cluster(cluster_id):
+    """Members of a cluster, closest to the centroid first, as a paged result
+    set: ?page_size=<n>, further pages from /api/results/<token>"""
+    if cluster_index is None:
+        return jsonify({'error': 'Clusters have not been computed'}), 404
+    if not 0 <= cluster_id < cluster_index.n_clusters:
+        return jsonify({'error': 'Unknown cluster'}), 404
+    page_size = request.args.get("page_size", 50, type=int)
+    inline_images = request.args.get("inline_images", "false").lower() == "true"
+
+    members, starts, scores, filepaths = engine_clusters()
+    start, end = starts[cluster_id], starts[cluster_id + 1]
+    response = ranked_response(filepaths[members[start:end]].tolist(), scores[start:end].tolist(),
+                               None, page_size, inline_images)
+    response["cluster"] = cluster_id
+    return jsonify(response)
+
+@app.route("/api/images/<name>", methods=["GET"])
+def get_image(name):
+    """Serve a thumbnail. Names are content hashes, so responses never change"""
+    path = thumbnail_store.path_for(name)
+    if path is None:
+        return jsonify({'error': 'Image not found'}), 404
+    response = send_file(os.path.abspath(path), mimetype="image/jpeg", etag=name.split(".")[0],
+                         max_age=365 * 24 * 60 * 60, conditional=True)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+@app.route("/api/pdf/<job_id>", methods=["GET"])
+def pdf_status(job_id):
+    status = pdf_jobs.status(job_id)
+    if status is None:
+        return jsonify({'error': 'Unknown PDF job'}), 404
+    return jsonify(dict(status, **pdf_job_response(job_id)))
+
+@app.route("/api/pdf/<job_id>/download", methods=["GET"])
+def pdf_download(job_id):
+    status = pdf_jobs.status(job_id)
+    if status is None:
+        return jsonify({'error': 'Unknown PDF job'}), 404
+    if status["status"] != DONE:
+        return jsonify(dict(status, **pdf_job_response(job_id))), 409
+    return send_file(os.path.abspath(pdf_jobs.pdf_path(job_id)), mimetype="application/pdf",
+                     as_attachment=True, download_name="search_results.pdf")
+
 @app.route("/api/search/text", methods=["POST", "OPTIONS"])
 def search_text():
     if request.method == "OPTIONS":
@@ -104,76 +344,42 @@ def search_text():
         if not data or "query" not in data:
             return jsonify({'error': 'No query provided'}), 400
         
-        query = data["query"].strip().lower()
+        # collapse runs of whitespace so equivalent queries share a cache entry
+        query = " ".join(data["query"].split()).lower()
+        threshold = float(data.get("threshold", 70))
+        scorer = data.get("scorer", "ratio")
+        k = data.get("k")
+        if scorer not in SCORERS:
+            return jsonify({'error': f'Unknown scorer: {scorer}'}), 400
+
+        # one consistent snapshot of the token DB for this request
+        label_db = label_database.snapshot()
+
+        # rank images by their best-matching phrase
+        cache_key = ("text", query, threshold, scorer, int(k) if k else None)
+        cached = query_cache.get(cache_key, label_db.version)
+        if cached is None:
+            cached = label_db.scorer.search(
+                query, threshold=threshold, scorer=scorer, top_k=int(k) if k else None
+            )
+            query_cache.put(cache_key, label_db.version, cached)
+        matched_paths, similarity_scores = cached
 
-        # load the token DB
-        with open("../ocr/token_db_6719.json", "r") as f:
-            label_db = json.load(f)
-
-        # search text
-        matched_paths, similarity_scores = querySearch.search_text_phrase(query, label_db)
-
-        results = []
         image_directory = "segmented_images/"
-        
-        # full paths for PDF gen
-        full_matched_paths = []
-        normalized_similarity_scores = []
-        
-        for path, score in zip(matched_paths, similarity_scores):
-            try:
-                full_path = os.path.join(image_directory, path)
-                full_matched_paths.append(full_path)
-                normalized_similarity_scores.append(score / 100)
-                
-                if not os.path.exists(full_path):
-                    print(f"File not found: {full_path}")
-                    continue 
-                
-                with Image.open(full_path) as img:
-                    buffered = BytesIO()
-                    img.save(buffered, format = "JPEG")
-                    img_str = base64.b64encode(buffered.getvalue()).decode()
-
-                filename = os.path.basename(full_path)
-                bdr_match = re.search(r"(\d+)", filename)
-                bdr_code = bdr_match.group(1) if bdr_match else "000000"
-                website_url = f"https://repository.library.brown.edu/studio/item/bdr:{bdr_code}/"
-
-                metadata = fetch_catalog_metadata(bdr_code)
-                if not metadata.get("dwc_catalog_number_ssi"):
-                    metadata["dwc_catalog_number_ssi"] = f"PBRU {bdr_code}"
-                
-                if not metadata.get("dwc_accepted_name_usage_ssi"):
-                    name_parts = filename.split("_")
-                    if len(name_parts) >= 2:
-                        metadata["dwc_accepted_name_usage_ssi"] = " ".join(name_parts[1:]).replace(".jpg", "").title()
-                    else:
-                        metadata["dwc_accepted_name_usage_ssi"] = filename.replace(".jpg", "").title()
 
-                results.append({
-                    "image": img_str,
-                    "filepath": full_path,
-                    "websiteUrl": website_url,
-                    "similarity": score / 100,
-                    "metadata": metadata
-                })
-
-            except Exception as img_err:
-                print(f"Error processing {full_path}: {img_err}")
+        # full paths for PDF gen
+        full_matched_paths = [os.path.join(image_directory, path) for path in matched_paths]
+        normalized_similarity_scores = [score / 100 for score in similarity_scores]
 
+        inline_images = bool(data.get("inline_images", False))
+        page_size = data.get("page_size")
 
-        pdf_path, pdf_base64 = generate_and_save_pdf(
-            full_matched_paths,
-            normalized_similarity_scores,
-            "text",
-            image_directory
-        )
+        job_id = pdf_jobs.submit(full_matched_paths, normalized_similarity_scores, image_directory)
 
-        return jsonify({
-            "results": results,
-            "pdf" : pdf_base64
-        })
+        return jsonify(ranked_response(
+            full_matched_paths, normalized_similarity_scores, job_id,
+            int(page_size) if page_size else None, inline_images
+        ))
 
     except Exception as e:
         print("Text search error:", e)
@@ -187,76 +393,205 @@ def search():
             return jsonify({'error': 'No image provided'}), 400
         image_file = request.files['image']
         k = int(request.form.get('k', 100))
+        # exact=true bypasses the ANN and quantized indexes; nprobe tunes ANN recall/latency
+        exact = request.form.get('exact', 'false').lower() == 'true'
+        nprobe = request.form.get('nprobe', type=int)
+        # inline_images=true returns full images as base64 instead of URLs
+        inline_images = request.form.get('inline_images', 'false').lower() == 'true'
+        # page_size returns only the first page; fetch the rest from /api/results/<token>
+        page_size = request.form.get('page_size', type=int)
+
+        # identical uploads hit the cache without re-encoding the image
+        image_bytes = image_file.read()
+        cache_key = ("image", hashlib.sha1(image_bytes).hexdigest(), k, exact, nprobe)
+        cached = query_cache.get(cache_key, search_engine.version)
+        if cached is None:
+            # save img temporarily
+            with tempfile.NamedTemporaryFile(delete = False, suffix = ".jpg") as tmp:
+                image_path = tmp.name
+                tmp.write(image_bytes)
+
+            # query top k images
+            try:
+                top_filepaths, _, top_scores = search_engine.query(image_path, k, exact=exact, nprobe=nprobe)
+            finally:
+                os.remove(image_path)
+            cached = (top_filepaths, [float(score) for score in top_scores])
+            query_cache.put(cache_key, search_engine.version, cached)
+        top_filepaths, top_scores = cached
+
+        # filepaths for PDF generation
+        matched_img_paths = [filepath or "/unknown.jpg" for filepath in top_filepaths]
+
+        job_id = pdf_jobs.submit(matched_img_paths, top_scores)
 
-        # save img temporarily
+        return jsonify(ranked_response(matched_img_paths, top_scores, job_id, page_size, inline_images))
+
+    except Exception as e:
+        print("Error:", e)
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/search/hybrid", methods=["POST"])
+def search_hybrid():
+    """Rank labels by CLIP similarity and OCR text similarity together. Form
+    fields: image, text (optional, OCRed from the image if missing), k,
+    clip_weight, clip_candidates, text_candidates, exact, nprobe, page_size,
+    inline_images. The response includes per-stage timings in ms"""
+    try:
+        if 'image' not in request.files:
+            return jsonify({'error': 'No image provided'}), 400
+        image_file = request.files['image']
+        text = request.form.get('text')
+        k = int(request.form.get('k', 100))
+        clip_weight = float(request.form.get('clip_weight', 0.6))
+        clip_candidates = int(request.form.get('clip_candidates', 200))
+        text_candidates = int(request.form.get('text_candidates', 200))
+        exact = request.form.get('exact', 'false').lower() == 'true'
+        nprobe = request.form.get('nprobe', type=int)
+        inline_images = request.form.get('inline_images', 'false').lower() == 'true'
+        page_size = request.form.get('page_size', type=int)
+        if not 0 <= clip_weight <= 1:
+            return jsonify({'error': 'clip_weight must be between 0 and 1'}), 400
+
+        timings = {}
         with tempfile.NamedTemporaryFile(delete = False, suffix = ".jpg") as tmp:
             image_path = tmp.name
-            image_file.save(image_path)
-
-        # query top k images
-        similar_images, similarity_scores = model.query_image(image_path, clustered_dataset, k)
+            tmp.write(image_file.read())
+        try:
+            start = time.perf_counter()
+            query_embedding = search_engine.encode_image(image_path)
+            timings["encode"] = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            if text:
+                query_phrases = [" ".join(line.split()).lower() for line in text.splitlines()]
+            else:
+                _, query_phrases = ocr_image(image_path)
+            timings["ocr"] = (time.perf_counter() - start) * 1000
+        finally:
+            os.remove(image_path)
+
+        filepaths, scores, search_timings = hybrid_searcher.search(
+            query_embedding, query_phrases, k=k, clip_weight=clip_weight,
+            clip_candidates=clip_candidates, text_candidates=text_candidates,
+            exact=exact, nprobe=nprobe,
+        )
+        timings.update(search_timings)
 
-        results = []
-        sample_ids = clustered_dataset.values("id")
-        sorted_indices = np.argsort(similarity_scores)[::-1][:k]
+        job_id = pdf_jobs.submit(filepaths, scores)
 
-        top_samples = [clustered_dataset[sample_ids[i]] for i in sorted_indices]
-        top_scores = similarity_scores[sorted_indices]
-        
-        # filepaths for PDF generation
-        matched_img_paths = []
+        start = time.perf_counter()
+        response = ranked_response(filepaths, scores, job_id, page_size, inline_images)
+        timings["hydrate"] = (time.perf_counter() - start) * 1000
+        response["queryPhrases"] = query_phrases
+        response["timings"] = {stage: round(ms, 2) for stage, ms in timings.items()}
+        return jsonify(response)
 
-        for i, (sample, sim_score) in enumerate(zip(top_samples, top_scores)):
-            filepath = sample.filepath if hasattr(sample, "filepath") else "/unknown.jpg"
-            filename = os.path.basename(filepath)
-            matched_img_paths.append(filepath)
-
-            # convert img
-            buffered = BytesIO()
-            similar_images[i].save(buffered, format = "JPEG")
-            img_str = base64.b64encode(buffered.getvalue()).decode()
-            
-            # extract bdr code
-            code_match = re.search(r"(\d+)", filename)
-            bdr_code = code_match.group(1) if code_match else "000000"
-            website_url = f"https://repository.library.brown.edu/studio/item/bdr:{bdr_code}/"
+    except Exception as e:
+        print("Hybrid search error:", e)
+        return jsonify({"error": str(e)}), 500
 
-            metadata = fetch_catalog_metadata(bdr_code)
-            if not metadata.get("dwc_catalog_number_ssi"):
-                metadata["dwc_catalog_number_ssi"] = f"PBRU {bdr_code}"
+@app.route("/api/search/region", methods=["POST"])
+def search_region():
+    """Match a crop of a label (e.g. a signature) against every part of every
+    label. Labels are ranked by their best matching tile; each result has the
+    tile's "box" [x0, y0, x1, y1] in pixels of the label and the label's
+    "imageSize" [width, height]. Form fields: image, k, page_size, inline_images"""
+    try:
+        if tile_index is None:
+            return jsonify({'error': 'Tile index has not been built'}), 404
+        if 'image' not in request.files:
+            return jsonify({'error': 'No image provided'}), 400
+        image_file = request.files['image']
+        k = int(request.form.get('k', 100))
+        inline_images = request.form.get('inline_images', 'false').lower() == 'true'
+        page_size = request.form.get('page_size', type=int)
 
-            if not metadata.get("dwc_accepted_name_usage_ssi"):
-                name_parts = filename.split("_")
-                if len(name_parts) >= 2:
-                    metadata["dwc_accepted_name_usage_ssi"] = " ".join(name_parts[1:]).replace(".jpg", "").title()
-                else:
-                    metadata["dwc_accepted_name_usage_ssi"] = filename.replace(".jpg", "").title()
+        image_bytes = image_file.read()
+        cache_key = ("region", hashlib.sha1(image_bytes).hexdigest(), k)
+        cached = query_cache.get(cache_key, search_engine.version)
+        if cached is None:
+            with Image.open(io.BytesIO(image_bytes)) as img:
+                rows, scores, boxes = tile_index.search(search_engine.encode_image(img), k)
+            details = [{"box": box, "imageSize": tile_index.sizes[row].tolist()}
+                       for row, box in zip(rows.tolist(), boxes.tolist())]
+            cached = (tile_index.filepaths[rows].tolist(), [float(score) for score in scores], details)
+            query_cache.put(cache_key, search_engine.version, cached)
+        top_filepaths, top_scores, details = cached
 
-            results.append({
-                "image": img_str,
-                "similarity": float(sim_score),
-                "filepath": filepath,
-                "websiteUrl": website_url,
-                "metadata": metadata,
-            })
+        job_id = pdf_jobs.submit(top_filepaths, top_scores)
 
-        os.remove(image_path)
+        return jsonify(ranked_response(top_filepaths, top_scores, job_id, page_size, inline_images, details))
 
-        pdf_filename, pdf = generate_and_save_pdf(
-            matched_img_paths,
-            [float(score) for score in top_scores], 
-            "image"
-        )
+    except Exception as e:
+        print("Region search error:", e)
+        return jsonify({"error": str(e)}), 500
 
-        # print(pdf); 
+# upper bound on images per batch request
+MAX_BATCH_IMAGES = 256
 
-        return jsonify({
-            "results": results,
-            "pdf": pdf,
-        })
+@app.route("/api/search/batch", methods=["POST"])
+def search_batch():
+    """Match a whole set of label images at once. All uploads are encoded in
+    batched CLIP passes and scored with one similarity product. Form fields:
+    images (repeated), k, exact, nprobe, format=json|csv"""
+    try:
+        image_files = request.files.getlist("images")
+        if not image_files:
+            return jsonify({'error': 'No images provided'}), 400
+        if len(image_files) > MAX_BATCH_IMAGES:
+            return jsonify({'error': f'At most {MAX_BATCH_IMAGES} images per batch'}), 400
+        k = int(request.form.get('k', 10))
+        exact = request.form.get('exact', 'false').lower() == 'true'
+        nprobe = request.form.get('nprobe', type=int)
+        output_format = request.form.get('format', 'json').lower()
+
+        query_names, images = [], []
+        for image_file in image_files:
+            try:
+                img = Image.open(io.BytesIO(image_file.read()))
+                img.load()
+            except OSError:
+                return jsonify({'error': f'Could not read image {image_file.filename!r}'}), 400
+            query_names.append(image_file.filename)
+            images.append(img)
+
+        grouped = search_engine.query_batch(images, k, exact=exact, nprobe=nprobe)
+        grouped_paths = [filepaths for filepaths, _, _ in grouped]
+        grouped_scores = [[float(score) for score in scores] for _, _, scores in grouped]
+
+        # metadata for every match of every query in one bulk call
+        all_metadata = fetch_catalog_metadata_bulk(
+            [extract_bdr_code(path) for paths in grouped_paths for path in paths])
+        grouped_metadata, start = [], 0
+        for paths in grouped_paths:
+            grouped_metadata.append(all_metadata[start:start + len(paths)])
+            start += len(paths)
+
+        if output_format == "csv":
+            output = io.StringIO()
+            generate_output.generate_csv_file(query_names, grouped_paths, grouped_scores, grouped_metadata, output)
+            return Response(output.getvalue(), mimetype="text/csv",
+                            headers={"Content-Disposition": "attachment; filename=batch_search_results.csv"})
+
+        queries = []
+        for name, paths, scores, metadata_list in zip(query_names, grouped_paths, grouped_scores, grouped_metadata):
+            # full results (images included) are paged from /api/results/<token>
+            token = result_sets.add(ResultSet(paths, scores))
+            results = []
+            for path, score, metadata in zip(paths, scores, metadata_list):
+                thumbnail_urls = thumbnail_store.urls_for(path)
+                results.append({
+                    "filepath": path,
+                    "similarity": score,
+                    "thumbnailUrl": thumbnail_urls["small"] if thumbnail_urls else None,
+                    "metadata": metadata,
+                })
+            queries.append({"query": name, "resultSet": token, "total": len(paths), "results": results})
+        return jsonify({"queries": queries})
 
     except Exception as e:
-        print("Error:", e)
+        print("Batch search error:", e)
         return jsonify({"error": str(e)}), 500
     
 if __name__ == "__main__":
@@ -0,0 +1,133 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from tqdm import tqdm
+
+"""
+Offline thumbnail pipeline for search results.
+
+Every label image is resized once to each size in THUMBNAIL_SIZES and stored
+as <content hash>_<size>.jpg in THUMBNAIL_DIR. Because the filename is derived
+from the image bytes, a thumbnail URL never changes meaning and can be cached
+by browsers forever. manifest.json maps each source image (by real path) to
+its hash so the server can turn a result filepath into a URL.
+
+Usage (from the server folder):
+    python thumbnails.py --source segmented_images ../clustering/datasets/data
+"""
+
+THUMBNAIL_DIR = "thumbnails"
+THUMBNAIL_SIZES = {"small": 256, "large": 768}
+MANIFEST_FILENAME = "manifest.json"
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+THUMBNAIL_NAME = re.compile(r"^[0-9a-f]{20}_[0-9]+\.jpg$")
+
+
+def content_hash(file_path):
+    """Short SHA-1 of the file contents"""
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:20]
+
+
+def thumbnail_name(image_hash, size):
+    return f"{image_hash}_{size}.jpg"
+
+
+def make_thumbnails(file_path, out_dir=THUMBNAIL_DIR, sizes=tuple(THUMBNAIL_SIZES.values())):
+    """Write all thumbnail sizes for one image (skipping existing ones) and
+    return (real source path, content hash)"""
+    image_hash = content_hash(file_path)
+    missing = [size for size in sizes
+               if not os.path.exists(os.path.join(out_dir, thumbnail_name(image_hash, size)))]
+    if missing:
+        with Image.open(file_path) as img:
+            # let the JPEG decoder downscale while decoding when it can
+            img.draft("RGB", (max(missing), max(missing)))
+            img = img.convert("RGB")
+            for size in sorted(missing, reverse=True):
+                img.thumbnail((size, size), Image.LANCZOS)
+                tmp_path = os.path.join(out_dir, f".{thumbnail_name(image_hash, size)}.tmp")
+                img.save(tmp_path, format="JPEG", quality=85, optimize=True)
+                os.replace(tmp_path, os.path.join(out_dir, thumbnail_name(image_hash, size)))
+    return os.path.realpath(file_path), image_hash
+
+
+def build_thumbnails(source_dirs, out_dir=THUMBNAIL_DIR, workers=None):
+    """Generate thumbnails for every image in source_dirs and update the manifest.
+    Returns the number of images in the manifest"""
+    os.makedirs(out_dir, exist_ok=True)
+    file_paths = [os.path.join(source_dir, f)
+                  for source_dir in source_dirs
+                  for f in sorted(os.listdir(source_dir))
+                  if f.lower().endswith(IMAGE_EXTENSIONS)]
+
+    manifest = load_manifest(out_dir)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(make_thumbnails, file_paths, [out_dir] * len(file_paths), chunksize=16)
+        for real_path, image_hash in tqdm(results, total=len(file_paths)):
+            manifest[real_path] = image_hash
+
+    tmp_path = os.path.join(out_dir, f"{MANIFEST_FILENAME}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({"sizes": THUMBNAIL_SIZES, "images": manifest}, f)
+    os.replace(tmp_path, os.path.join(out_dir, MANIFEST_FILENAME))
+    return len(manifest)
+
+
+def load_manifest(out_dir=THUMBNAIL_DIR):
+    try:
+        with open(os.path.join(out_dir, MANIFEST_FILENAME)) as f:
+            return json.load(f)["images"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+class ThumbnailStore:
+    """Maps result filepaths to thumbnail URLs using the pipeline's manifest"""
+
+    def __init__(self, out_dir=THUMBNAIL_DIR, url_prefix="/api/images/"):
+        self.out_dir = out_dir
+        self.url_prefix = url_prefix
+        self.hashes = load_manifest(out_dir)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def urls_for(self, filepath):
+        """Return {"small": url, "large": url} for an image, or None if it has no thumbnails"""
+        image_hash = self.hashes.get(os.path.realpath(filepath))
+        if image_hash is None:
+            return None
+        return {name: self.url_prefix + thumbnail_name(image_hash, size)
+                for name, size in THUMBNAIL_SIZES.items()}
+
+    def path_for(self, name):
+        """Return the file path of a thumbnail by name, or None if the name is not valid"""
+        if not THUMBNAIL_NAME.match(name):
+            return None
+        path = os.path.join(self.out_dir, name)
+        return path if os.path.exists(path) else None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", nargs="+", default=["segmented_images", "../clustering/datasets/data"],
+                        help="Folders of label images")
+    parser.add_argument("--out", default=THUMBNAIL_DIR, help="Folder to write thumbnails to")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    args = parser.parse_args()
+
+    num_images = build_thumbnails([d for d in args.source if os.path.isdir(d)], args.out, args.workers)
+    print(f"Thumbnails for {num_images} images are in {args.out}")
+
+
+if __name__ == "__main__":
+    main()